@@ -0,0 +1,287 @@
+import collections
+import email.parser
+import email.policy
+import io
+import itertools
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+
+
+class FakeBotApi:
+    """ Local Bot API: serves scripted updates by getUpdates, stores files,
+        answers sends and edits. Tracks each request message from update
+        to result edit of its placeholder """
+
+    def __init__(self, api_latency:float=0, photo_size:tuple=(768, 768), error_caption:str='Error', busy_text:str='Too many',
+                 draft_caption:str='Draft', result_caption:str='Generated') -> None:
+        self.api_latency = api_latency
+        self.result_caption = result_caption
+        self.error_caption = error_caption
+        self.busy_text = busy_text
+        self.draft_caption = draft_caption
+        self.cond = threading.Condition()
+        self.updates = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1000)
+        self.closed = False
+        self.dead = set()       # tokens of crashed bot instances
+        self.calls = collections.Counter()
+        self.placeholders = {}  # placeholder message_id -> request key
+        self.pushed = {}        # request key -> time update was available
+        self.finished = {}      # request key -> (time, ok)
+        self.rejected = {}      # request key -> time bot answered it's busy
+        self.drafts = {}        # request key -> time draft was shown
+        self.uploaded = collections.Counter()  # method -> request body bytes
+
+        # camera-like JPEG, flat image would decode unrealistically fast
+        photo = io.BytesIO()
+        Image.effect_noise(photo_size, 32).convert('RGB').save(photo, format='jpeg', quality=90)
+        self.photo_size = photo_size
+        self.photo = photo.getvalue()
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.__handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def __handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def __answer(self, status:int, body:bytes, content_type:str):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def __body(self) -> bytes:
+                if self.headers.get('Transfer-Encoding') == 'chunked':
+                    body = b''
+                    while True:
+                        size = int(self.rfile.readline().split(b';')[0], 16)
+                        chunk = self.rfile.read(size + 2)[:size]
+                        if not size:
+                            return body
+                        body += chunk
+                return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+            def __params(self, url, body:bytes) -> dict:
+                """ Query string of requests, urlencoded or multipart form of aiohttp """
+                params = dict(urllib.parse.parse_qsl(url.query))
+                content_type = self.headers.get('Content-Type', '')
+                if content_type.startswith('application/x-www-form-urlencoded'):
+                    params.update(urllib.parse.parse_qsl(body.decode()))
+                elif content_type.startswith('multipart/form-data'):
+                    form = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                        f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+                    for part in form.iter_parts():
+                        if part.get_filename() is None:
+                            params[part.get_param('name', header='content-disposition')] = part.get_content()
+                return params
+
+            def __handle(self):
+                url = urllib.parse.urlsplit(self.path)
+                body = self.__body()
+                length = len(body)
+                parts = url.path.strip('/').split('/')
+                with api.cond:
+                    api.uploaded[parts[-1]] += length
+                token = parts[1][3:] if parts[0] == 'file' else parts[0][3:]
+                if token in api.dead:
+                    body = {'ok': False, 'error_code': 401, 'description': 'Unauthorized'}
+                    self.__answer(401, json.dumps(body).encode(), 'application/json')
+                    return
+                if parts[0] == 'file':
+                    self.__answer(200, api.photo, 'image/png')
+                    return
+                params = self.__params(url, body)
+                result = api.call(parts[-1], params, token)
+                self.__answer(200, json.dumps({'ok': True, 'result': result}).encode(), 'application/json')
+
+            do_GET = __handle
+            do_POST = __handle
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def __message(self, chat_id:int, **fields) -> dict:
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'},
+        }
+        message.update(fields)
+        return message
+
+    def __photo(self, file_id:str=None) -> list:
+        file_id = file_id or f'photo{next(self.message_ids)}'
+        return [{'file_id': file_id, 'file_unique_id': file_id,
+                 'width': self.photo_size[0], 'height': self.photo_size[1]}]
+
+    def push(self, chat_id:int, text:str, reply_photo:bool=False, same_photo:bool=False) -> tuple:
+        """ Make update with message from user, returns request key.
+            same_photo - replies of a chat are to one photo, as when user iterates on prompts """
+        fields = {'text': text}
+        if reply_photo:
+            fields['reply_to_message'] = self.__message(chat_id, photo=self.__photo(f'chat{chat_id}' if same_photo else None))
+        message = self.__message(chat_id, **fields)
+        key = (chat_id, message['message_id'])
+        with self.cond:
+            self.updates.append({'update_id': next(self.update_ids), 'message': message})
+            self.pushed[key] = time.monotonic()
+            self.cond.notify_all()
+        return key
+
+    def push_album(self, chat_id:int, text:str, photos:int) -> tuple:
+        """ Updates with album of photos, text is caption of first one, returns request key """
+        group_id = f'album{next(self.message_ids)}'
+        messages = [self.__message(chat_id, photo=self.__photo(), media_group_id=group_id) for _ in range(photos)]
+        messages[0]['caption'] = text
+        key = (chat_id, messages[0]['message_id'])
+        with self.cond:
+            for message in messages:
+                self.updates.append({'update_id': next(self.update_ids), 'message': message})
+            self.pushed[key] = time.monotonic()
+            self.cond.notify_all()
+        return key
+
+    def call(self, method:str, params:dict, token:str=None):
+        if self.api_latency:
+            time.sleep(self.api_latency)
+        with self.cond:
+            self.calls[method] += 1
+
+        if method == 'getUpdates':
+            return self.__get_updates(int(params.get('offset', 0)), float(params.get('timeout', 0)), token)
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getFile':
+            return {'file_id': params['file_id'], 'file_unique_id': params['file_id'],
+                    'file_size': len(self.photo), 'file_path': f"photos/{params['file_id']}.jpg"}
+
+        chat_id = int(params.get('chat_id', 0))
+        reply_to = params.get('reply_to_message_id')
+        if 'reply_parameters' in params:
+            reply_to = json.loads(params['reply_parameters'])['message_id']
+        if method == 'sendPhoto':
+            caption = params.get('caption', '')
+            message = self.__message(chat_id, photo=self.__photo(), caption=caption)
+            if reply_to:
+                with self.cond:
+                    key = (chat_id, int(reply_to))
+                    if not caption.startswith(self.result_caption):
+                        self.placeholders[message['message_id']] = key
+                    elif key not in self.finished:
+                        # result of equal request, sent by its file_id
+                        self.finished[key] = (time.monotonic(), True)
+                        self.cond.notify_all()
+            return message
+        if method == 'sendMediaGroup':
+            media = json.loads(params.get('media', '[]'))
+            if reply_to:
+                with self.cond:
+                    key = (chat_id, int(reply_to))
+                    if key not in self.finished:
+                        self.finished[key] = (time.monotonic(), True)
+                        self.cond.notify_all()
+            return [self.__message(chat_id, photo=self.__photo(), caption=item.get('caption', '')) for item in media]
+        if method == 'sendMessage':
+            text = params.get('text', '')
+            if reply_to and text.startswith(self.busy_text):
+                with self.cond:
+                    self.rejected[(chat_id, int(reply_to))] = time.monotonic()
+                    self.cond.notify_all()
+            elif reply_to and text.startswith(self.error_caption):
+                with self.cond:
+                    self.finished.setdefault((chat_id, int(reply_to)), (time.monotonic(), False))
+                    self.cond.notify_all()
+            return self.__message(chat_id, text=text)
+        if method in ('editMessageMedia', 'editMessageCaption'):
+            message_id = int(params['message_id'])
+            caption = params.get('caption', '')
+            if method == 'editMessageCaption' and caption.startswith(self.error_caption):
+                self.__finish(message_id, False)
+            elif method == 'editMessageMedia':
+                caption = json.loads(params.get('media', '{}')).get('caption', '')
+                if caption.startswith(self.draft_caption):
+                    self.__draft(message_id)
+                else:
+                    self.__finish(message_id, True)
+            message = self.__message(chat_id, photo=self.__photo(), caption=caption)
+            message['message_id'] = message_id
+            return message
+        return True
+
+    def __draft(self, message_id:int):
+        with self.cond:
+            key = self.placeholders.get(message_id)
+            if key and key not in self.drafts and key not in self.finished:
+                self.drafts[key] = time.monotonic()
+
+    def __finish(self, message_id:int, ok:bool):
+        with self.cond:
+            key = self.placeholders.get(message_id)
+            if key and key not in self.finished:
+                self.finished[key] = (time.monotonic(), ok)
+                self.cond.notify_all()
+
+    def __get_updates(self, offset:int, timeout:float, token:str) -> list:
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            # updates below offset are confirmed
+            self.updates = [u for u in self.updates if u['update_id'] >= offset]
+            while not self.updates and not self.closed and token not in self.dead:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            if token in self.dead:
+                return []
+            return list(self.updates)
+
+    def wait_finished(self, count:int, timeout:float) -> bool:
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while len(self.finished) + len(self.rejected) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def kill(self, token:str):
+        """ Bot instance crashed: its calls fail from now on, pending polls return nothing """
+        with self.cond:
+            self.dead.add(token)
+            self.cond.notify_all()
+
+    def release_polls(self):
+        """ Answer pending long polls, lets the bot notice stop """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def stop(self):
+        self.release_polls()
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,121 @@
+import base64
+import io
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+import fake_webui
+
+
+class FakeSdApi:
+    """ Local stand-in for other WebUI instance started with --api,
+        one generation at a time, sampling is a sleep scaled like in fake_webui """
+
+    def __init__(self, sampling_time:float, switch_time:float=0) -> None:
+        self.sampling_time = sampling_time
+        self.switch_time = switch_time
+        self.model = 'bench'
+        self.gpu_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.generated = 0
+        self.started = 0.0
+        self.duration = 0.0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.__handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def generate(self, payload:dict) -> dict:
+        count = int(payload.get('batch_size', 1))
+        duration = self.sampling_time * fake_webui.work(
+            payload.get('steps', fake_webui.BASE_STEPS), payload.get('width', 512), payload.get('height', 512),
+            payload.get('denoising_strength')) * count
+        with self.gpu_lock:
+            self.switch((payload.get('override_settings') or {}).get('sd_model_checkpoint'))
+            self.started = time.monotonic()
+            self.duration = duration
+            time.sleep(duration)
+            self.started = 0.0
+            with self.lock:
+                self.generated += 1
+        size = (int(payload.get('width', 512)), int(payload.get('height', 512)))
+        data = io.BytesIO()
+        Image.new('RGB', size, (30, 90, 160)).save(data, format='png')
+        seed = int(payload.get('seed', -1))
+        info = {'infotexts': [f"{payload.get('prompt', '')}\nSteps: {payload.get('steps')}, Seed: {seed + i}" for i in range(count)]}
+        return {'images': [base64.b64encode(data.getvalue()).decode()] * count, 'info': json.dumps(info)}
+
+    def switch(self, model:str):
+        """ Checkpoint load, call with gpu_lock """
+        if model and model != self.model:
+            time.sleep(self.switch_time)
+            self.model = model
+
+    def options(self, payload:dict) -> dict:
+        with self.gpu_lock:
+            self.switch(payload.get('sd_model_checkpoint'))
+        return {}
+
+    def progress(self) -> dict:
+        started = self.started
+        if not started:
+            return {'progress': 0, 'eta_relative': 0}
+        elapsed = time.monotonic() - started
+        return {'progress': min(elapsed / self.duration, 1) if self.duration else 1,
+                'eta_relative': max(self.duration - elapsed, 0)}
+
+    def __handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def __answer(self, status:int, result:dict):
+                body = json.dumps(result).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path.split('?')[0] == '/sdapi/v1/progress':
+                    self.__answer(200, api.progress())
+                else:
+                    self.__answer(404, {'detail': 'Not Found'})
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                if self.path in ('/sdapi/v1/txt2img', '/sdapi/v1/img2img'):
+                    self.__answer(200, api.generate(payload))
+                elif self.path == '/sdapi/v1/options':
+                    self.__answer(200, api.options(payload))
+                else:
+                    self.__answer(404, {'detail': 'Not Found'})
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def dead_url() -> str:
+    """ Url of a port nobody listens on, stands for crashed node """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    return f'http://127.0.0.1:{port}'
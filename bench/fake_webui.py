@@ -0,0 +1,238 @@
+import sys
+import threading
+import time
+import types
+import numpy
+from PIL import Image, ImageFilter
+
+# Minimal stand-ins for WebUI modules used by the bot, sampling is a sleep
+
+# sampling_time is for generation of this size, other sizes and steps scale it
+BASE_STEPS = 35
+BASE_PIXELS = 512 * 512
+
+
+class Options:
+    def __init__(self, data:dict) -> None:
+        self.data = data
+        self.outdir_samples = ''
+        self.outdir_txt2img_samples = ''
+        self.outdir_grids = ''
+        self.outdir_txt2img_grids = ''
+
+    def add_option(self, key, info):
+        pass
+
+
+class State:
+    def __init__(self) -> None:
+        self.job_count = 0
+        self.job_no = 0
+        self.sampling_steps = 0
+        self.sampling_step = 0
+        self.time_start = time.time()
+
+    def begin(self):
+        self.job_count = 0
+        self.job_no = 0
+        self.sampling_steps = 0
+        self.sampling_step = 0
+        self.time_start = time.time()
+
+    def end(self):
+        self.job_count = 0
+
+
+class ScriptRunner:
+    def __init__(self) -> None:
+        self.scripts = []
+
+    def run(self, p, *args):
+        return None
+
+
+class StableDiffusionProcessing:
+    def __init__(self, **kwargs) -> None:
+        self.batch_size = 1
+        self.n_iter = 1
+        self.steps = 20
+        self.width = 512
+        self.height = 512
+        self.scripts = None
+        self.script_args = None
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+
+class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
+    pass
+
+
+class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
+    pass
+
+
+class Processed:
+    def __init__(self, p:StableDiffusionProcessing, images:list) -> None:
+        self.images = images
+        self.index_of_first_image = 0
+        self.prompt = p.prompt
+
+    def infotext(self, p, index:int) -> str:
+        return f'Steps: {p.steps}, Seed: {p.seed}, Size: {p.width}x{p.height}'
+
+
+def result_image(size:tuple) -> Image.Image:
+    """ Noisy image, encodes to realistic size unlike a flat one """
+    image = result_images.get(size)
+    if image is None:
+        bands = [Image.effect_noise(size, 24 + 8 * i).point(lambda v, i=i: v // 2 + 40 * i) for i in range(3)]
+        image = result_images[size] = Image.merge('RGB', bands)
+    return image
+
+
+result_images = {}
+
+
+def work(steps:int, width:int, height:int, denoising:float=None) -> float:
+    """ Generation work relative to BASE_STEPS at 512x512 """
+    if denoising is not None:
+        steps = max(int(steps * denoising), 1)
+    return steps / BASE_STEPS * width * height / BASE_PIXELS
+
+
+class CheckpointInfo:
+    def __init__(self, title:str) -> None:
+        self.title = title
+        self.name = title
+        self.model_name = title
+
+
+class ControlNetUnit:
+    def __init__(self, **kwargs) -> None:
+        self.__dict__.update(kwargs)
+
+
+def install_controlnet(annotator_time:float):
+    """ Fake ControlNet extension, its only preprocessor (canny) sleeps annotator_time.
+        Generation with unit of other module than none runs the preprocessor too, as ControlNet does """
+    def canny(img, res=512, thr_a=100, thr_b=200, **kwargs):
+        time.sleep(annotator_time)
+        return numpy.array(Image.fromarray(img).convert('L').filter(ImageFilter.FIND_EDGES)), True
+
+    def update_cn_script_in_processing(p, units):
+        p.controlnet_units = units
+
+    external_code = types.ModuleType('external_code')
+    external_code.ControlNetUnit = ControlNetUnit
+    external_code.update_cn_script_in_processing = update_cn_script_in_processing
+    global_state = types.ModuleType('global_state')
+    global_state.cn_preprocessor_modules = {'canny': canny}
+
+    names = ['extensions', 'extensions.sd-webui-controlnet', 'extensions.sd-webui-controlnet.scripts']
+    for name in names:
+        package = types.ModuleType(name)
+        package.__path__ = []
+        sys.modules[name] = package
+    sys.modules[names[-1] + '.external_code'] = external_code
+    sys.modules[names[-1] + '.global_state'] = global_state
+
+
+def install(sampling_time:float, per_image_time:float=0, options:dict=None, annotator_time:float=None,
+            models:tuple=(), switch_time:float=0) -> types.ModuleType:
+    """ Register fake `modules` package (and gradio if missing) in sys.modules.
+        One generation of BASE_STEPS at 512x512 sleeps sampling_time, scaled by steps * pixels
+        (img2img runs steps * denoising), plus per_image_time for every image after first.
+        annotator_time - install fake ControlNet, see install_controlnet.
+        models - checkpoints besides loaded 'bench', loading one sleeps switch_time. Returns shared module """
+    gpu_lock = threading.Lock()
+    if annotator_time is not None:
+        install_controlnet(annotator_time)
+
+    shared = types.ModuleType('modules.shared')
+    shared.opts = Options(dict(options or {}))
+    shared.state = State()
+    checkpoints = {title: CheckpointInfo(title) for title in ('bench',) + tuple(models)}
+    shared.sd_model = types.SimpleNamespace(sd_model_hash='bench', sd_checkpoint_info=checkpoints['bench'])
+    shared.OptionInfo = lambda *args, **kwargs: None
+    shared.list_samplers = lambda: [types.SimpleNamespace(name='Euler a')]
+
+    def process_images(p:StableDiffusionProcessing) -> Processed:
+        state = shared.state
+        state.sampling_steps = p.steps
+        for unit in getattr(p, 'controlnet_units', []):
+            if unit.module != 'none':
+                time.sleep(annotator_time)
+        duration = sampling_time * work(p.steps, p.width, p.height, getattr(p, 'denoising_strength', None)) \
+            + per_image_time * (p.batch_size - 1)
+        state.job_count = p.n_iter
+        for iteration in range(p.n_iter):
+            state.job_no = iteration
+            for step in range(p.steps):
+                state.sampling_step = step
+                time.sleep(duration / p.steps)
+        state.job_no = p.n_iter
+        size = (int(p.width), int(p.height))
+        return Processed(p, [result_image(size).copy() for _ in range(p.batch_size * p.n_iter)])
+
+    processing = types.ModuleType('modules.processing')
+    processing.StableDiffusionProcessing = StableDiffusionProcessing
+    processing.StableDiffusionProcessingTxt2Img = StableDiffusionProcessingTxt2Img
+    processing.StableDiffusionProcessingImg2Img = StableDiffusionProcessingImg2Img
+    processing.Processed = Processed
+    processing.process_images = process_images
+
+    def reload_model_weights(sd_model=None, info=None):
+        if info is not shared.sd_model.sd_checkpoint_info:
+            time.sleep(switch_time)
+            shared.sd_model = types.SimpleNamespace(sd_model_hash=info.title, sd_checkpoint_info=info)
+
+    sd_models = types.ModuleType('modules.sd_models')
+    sd_models.get_closet_checkpoint_match = checkpoints.get
+    sd_models.reload_model_weights = reload_model_weights
+
+    scripts = types.ModuleType('modules.scripts')
+    scripts.scripts_txt2img = ScriptRunner()
+    scripts.scripts_img2img = ScriptRunner()
+
+    def wrap_queued_call(func):
+        def f(*args, **kwargs):
+            with gpu_lock:
+                return func(*args, **kwargs)
+        return f
+
+    call_queue = types.ModuleType('modules.call_queue')
+    call_queue.wrap_queued_call = wrap_queued_call
+
+    script_callbacks = types.ModuleType('modules.script_callbacks')
+    script_callbacks.on_ui_settings = lambda callback: None
+    script_callbacks.on_app_started = lambda callback: None
+
+    package = types.ModuleType('modules')
+    package.__path__ = []
+    submodules = {
+        'shared': shared,
+        'processing': processing,
+        'scripts': scripts,
+        'sd_models': sd_models,
+        'call_queue': call_queue,
+        'script_callbacks': script_callbacks,
+        'devices': types.ModuleType('modules.devices'),
+        'masking': types.ModuleType('modules.masking'),
+        'images': types.ModuleType('modules.images'),
+    }
+    sys.modules['modules'] = package
+    for name, module in submodules.items():
+        setattr(package, name, module)
+        sys.modules['modules.' + name] = module
+
+    try:
+        import gradio
+    except ImportError:
+        # only component classes are referenced, in option definitions
+        gradio = types.ModuleType('gradio')
+        for name in ('Text', 'Radio', 'Slider', 'Number', 'Checkbox', 'CheckboxGroup', 'Dropdown'):
+            setattr(gradio, name, object)
+        sys.modules['gradio'] = gradio
+
+    return shared
@@ -0,0 +1,344 @@
+""" Offline benchmark: SdTgBot against local fake Bot API and fake WebUI.
+
+    python bench/run.py                       all scenarios
+    python bench/run.py mix --sampling-time 1 --json out.json --fail-p99 30
+    python bench/run.py txt2img_burst --remote 2 --dead-remote 1   fan-out with failover
+    python bench/run.py mix --crash-after 5                     resume from job journal
+    python bench/run.py mix --queue-order shortest-first --wait-slo 20
+    python bench/run.py img2img_replies --trace traces.jsonl    job traces of scenario
+    python bench/run.py txt2img_burst --duplicates 0.5          equal requests share generation
+    python bench/run.py mix --engine asyncio                    AsyncSdTgBot instead of SdTgBot
+"""
+import argparse
+import collections
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_sdapi
+import fake_webui
+from fake_api import FakeBotApi
+
+# jobs - requests in scenario, rate - requests per second (0 - all at once),
+# img2img - share of img2img requests replying to a photo
+SCENARIOS = {
+    'txt2img_burst': {'jobs': 32, 'chats': 4, 'img2img': 0.0, 'rate': 0},
+    'img2img_replies': {'jobs': 16, 'chats': 8, 'img2img': 1.0, 'rate': 4},
+    'many_chats': {'jobs': 64, 'chats': 64, 'img2img': 0.0, 'rate': 8},
+    'mix': {'jobs': 48, 'chats': 12, 'img2img': 0.4, 'rate': 6},
+}
+
+
+def percentile(values:list, q:float) -> float:
+    """ Nearest rank """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values) + 0.5)) - 1))]
+
+
+def traffic(scenario:dict, rnd:random.Random) -> list:
+    """ (seconds from start, chat_id, is img2img) """
+    at = 0.0
+    requests = []
+    for _ in range(scenario['jobs']):
+        if scenario['rate']:
+            at += rnd.expovariate(scenario['rate'])
+        requests.append((at, rnd.randrange(scenario['chats']) + 1, rnd.random() < scenario['img2img']))
+    return requests
+
+
+def run_scenario(name:str, scenario:dict, args, remotes:list) -> dict:
+    import telebot
+    import telebot.asyncio_helper
+    from src import main, metrics, tracing
+    from src.journal import JobJournal
+    from src.scheduler import GenScheduler
+    from src.telegram_bot import SdTgBot
+    from src.async_bot import AsyncSdTgBot
+    engine = AsyncSdTgBot if args.engine == 'asyncio' else SdTgBot
+
+    class RecordingHistogram(metrics.Histogram):
+        __slots__ = ('samples',)
+
+        def __init__(self, *args, **kwargs) -> None:
+            super().__init__(*args, **kwargs)
+            self.samples = collections.defaultdict(list)
+
+        def observe(self, value:float, *labels):
+            self.samples[labels[0]].append(value)
+            super().observe(value, *labels)
+
+    stages = metrics.STAGE_SECONDS = RecordingHistogram(
+        metrics.STAGE_SECONDS.name, metrics.STAGE_SECONDS.help, metrics.STAGE_SECONDS.labelnames)
+    main.update_overrides()
+    # update ids of fake api start from 1 in every scenario
+    main.journal = JobJournal(os.path.join(tempfile.mkdtemp(prefix='tgbench'), 'jobs.db'))
+    if args.trace:
+        # traces of this scenario only, no rotation
+        open(args.trace, 'w').close()
+        tracing.configure(args.trace, 1 << 40)
+
+    # predicted wait of each request, compared with time it really took
+    predictions = {}
+    predict_wait = GenScheduler.predict_wait
+
+    def recording_predict_wait(scheduler, job):
+        wait = predict_wait(scheduler, job)
+        predictions.setdefault((job.chat_id, job.message.message_id), (time.monotonic(), wait))
+        return wait
+
+    GenScheduler.predict_wait = recording_predict_wait
+
+    api = FakeBotApi(api_latency=args.api_latency,
+                     photo_size=(args.photo_size, args.photo_size * 3 // 4),
+                     error_caption=main.get_msg('telegram_bot_generated_error_msg'),
+                     busy_text=main.get_msg('telegram_bot_busy_msg', wait='')[:16],
+                     draft_caption=main.get_msg('telegram_bot_draft_msg'),
+                     result_caption=main.get_msg('telegram_bot_generated_msg', gen_data='').strip())
+    api.start()
+    telebot.apihelper.API_URL = f'http://127.0.0.1:{api.port}/bot{{0}}/{{1}}'
+    telebot.apihelper.FILE_URL = f'http://127.0.0.1:{api.port}/file/bot{{0}}/{{1}}'
+    telebot.asyncio_helper.API_URL = telebot.apihelper.API_URL
+    telebot.asyncio_helper.FILE_URL = telebot.apihelper.FILE_URL
+
+    bot = engine(token='1:bench')
+    bot_th = threading.Thread(target=bot.run, daemon=True)
+    bot_th.start()
+
+    def crash():
+        """ Old instance loses telegram and its queue, new one of same bot resumes from journal """
+        nonlocal bot, bot_th
+        api.kill(bot.bot.token)
+        bot.stop()
+        bot = engine(token='1:bench-restarted')
+        bot_th = threading.Thread(target=bot.run, daemon=True)
+        bot_th.start()
+
+    if args.crash_after:
+        crash_timer = threading.Timer(args.crash_after, crash)
+        crash_timer.start()
+
+    requests = traffic(scenario, random.Random(args.seed))
+    remote_before = [remote.generated for remote in remotes]
+    model_batches_before = dict(metrics.MODEL_BATCHES.values)
+    coalesced_before = sum(metrics.JOBS_COALESCED.values.values())
+    model_rnd = random.Random(args.seed + 1)
+    prompt_rnd = random.Random(args.seed + 2)
+    prompt = 0
+    start = time.monotonic()
+    for at, chat_id, img2img in requests:
+        delay = start + at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        count = f'--count {args.count} ' if args.count > 1 else ''
+        model = f'--model m{model_rnd.randrange(args.models)} ' if args.models else ''
+        # duplicate repeats previous prompt, as users of a group chat do
+        if prompt_rnd.random() >= args.duplicates:
+            prompt += 1
+        if img2img and args.album > 1:
+            api.push_album(chat_id, f'/img2img {model}bench prompt {prompt}', args.album)
+        elif img2img:
+            api.push(chat_id, f'/img2img {model}{count}bench prompt {prompt}', reply_photo=True, same_photo=args.same_photo)
+        else:
+            api.push(chat_id, f'/text2img {model}{count}bench prompt {prompt}')
+
+    completed = api.wait_finished(len(requests), args.timeout)
+    wall = time.monotonic() - start
+    if args.crash_after:
+        crash_timer.cancel()
+        crash_timer.join()
+
+    bot.stop()
+    api.release_polls()
+    bot_th.join(10)
+    bot.shutdown()
+    api.stop()
+
+    GenScheduler.predict_wait = predict_wait
+    traces = []
+    if args.trace:
+        tracing.configure(None, 0)
+        with open(args.trace, encoding='utf-8') as f:
+            traces = [json.loads(line) for line in f]
+
+    e2e = [api.finished[key][0] - pushed for key, pushed in api.pushed.items() if key in api.finished]
+    # first image user sees, draft or final
+    first = [min(api.drafts.get(key, api.finished[key][0]), api.finished[key][0]) - pushed
+             for key, pushed in api.pushed.items() if key in api.finished]
+    wait_errors = [abs(api.finished[key][0] - at - wait) for key, (at, wait) in predictions.items()
+                   if wait is not None and key in api.finished]
+    calls = {method: count for method, count in api.calls.items() if method not in ('getUpdates', 'getMe', 'setWebhook', 'deleteWebhook')}
+    done = len(api.finished)
+    model_batches = collections.Counter()
+    for (_, result), value in metrics.MODEL_BATCHES.values.items():
+        model_batches[result] += value
+    for (_, result), value in model_batches_before.items():
+        model_batches[result] -= value
+    report = {
+        'scenario': name,
+        'jobs': len(requests),
+        'completed': done,
+        'rejected': len(api.rejected),
+        'coalesced': int(sum(metrics.JOBS_COALESCED.values.values()) - coalesced_before),
+        'failed': sum(1 for _, ok in api.finished.values() if not ok),
+        'timed_out': not completed,
+        'wall_s': round(wall, 3),
+        'throughput_jobs_s': round(done / wall, 3) if wall else None,
+        'e2e_p50_s': percentile(e2e, 50),
+        'e2e_p99_s': percentile(e2e, 99),
+        'first_image_p50_s': percentile(first, 50),
+        'first_image_p99_s': percentile(first, 99),
+        'drafts': len(api.drafts),
+        'wait_error_p50_s': percentile(wait_errors, 50),
+        'wait_error_p90_s': percentile(wait_errors, 90),
+        'predicted': len(wait_errors),
+        'api_calls_per_job': round(sum(calls.values()) / max(done, 1), 2),
+        'api_calls': calls,
+        'upload_kb_per_job': round(sum(api.uploaded.values()) / 1024 / max(done, 1), 1),
+        # of the bench process so far, run one scenario to compare
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'model_switches': model_batches['switch'],
+        'model_hit_rate': round(model_batches['hit'] / max(sum(model_batches.values()), 1), 3),
+        'traces': len(traces),
+        'trace_spans_per_job': round(sum(len(t['spans']) for t in traces) / max(len(traces), 1), 1),
+        'remote_generated': [remote.generated - before for remote, before in zip(remotes, remote_before)],
+        'stages': {stage: {'p50_s': percentile(values, 50), 'p99_s': percentile(values, 99), 'count': len(values)}
+                   for stage, values in sorted(stages.samples.items())},
+    }
+    return report
+
+
+def print_report(report:dict):
+    def fmt(value):
+        return '-' if value is None else f'{value:.3f}'
+
+    print(f"== {report['scenario']}: {report['completed']}/{report['jobs']} done, "
+          f"{report['failed']} failed{', TIMED OUT' if report['timed_out'] else ''}")
+    print(f"   wall {report['wall_s']:.2f}s, throughput {report['throughput_jobs_s']} jobs/s, peak RSS {report['peak_rss_mb']} MB")
+    print(f"   e2e p50 {fmt(report['e2e_p50_s'])}s, p99 {fmt(report['e2e_p99_s'])}s")
+    print(f"   first image p50 {fmt(report['first_image_p50_s'])}s, p99 {fmt(report['first_image_p99_s'])}s, "
+          f"drafts shown {report['drafts']}")
+    print(f"   predicted wait error p50 {fmt(report['wait_error_p50_s'])}s, p90 {fmt(report['wait_error_p90_s'])}s, "
+          f"n={report['predicted']}, rejected {report['rejected']}, coalesced {report['coalesced']}")
+    print(f"   api calls per job {report['api_calls_per_job']} {report['api_calls']}, "
+          f"uploaded {report['upload_kb_per_job']} KB per job")
+    if report['model_switches']:
+        print(f"   checkpoint switches {report['model_switches']}, hit rate {report['model_hit_rate']}")
+    if report['traces']:
+        print(f"   traces {report['traces']}, spans per job {report['trace_spans_per_job']}")
+    if report['remote_generated']:
+        print(f"   generated by remotes {report['remote_generated']}")
+    for stage, values in report['stages'].items():
+        print(f"   {stage:<11} p50 {fmt(values['p50_s'])}s, p99 {fmt(values['p99_s'])}s, n={values['count']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline bot benchmark on fake Telegram API and fake WebUI')
+    parser.add_argument('scenarios', nargs='*', help=f"{', '.join(SCENARIOS)} (default - all)")
+    parser.add_argument('--sampling-time', type=float, default=0.5, help='seconds per generation')
+    parser.add_argument('--per-image-time', type=float, default=0.1, help='extra seconds per image in batch')
+    parser.add_argument('--api-latency', type=float, default=0.02, help='seconds per fake API call')
+    parser.add_argument('--global-rate', type=float, default=30, help='telegram_bot_api_global_rate')
+    parser.add_argument('--chat-rate', type=float, default=1, help='telegram_bot_api_chat_rate')
+    parser.add_argument('--batch-size', type=int, default=4, help='telegram_bot_batch_size')
+    parser.add_argument('--photo-size', type=int, default=768, help='width of incoming img2img photos, 4:3')
+    parser.add_argument('--input-memory-mb', type=int, default=512, help='telegram_bot_input_memory_mb')
+    parser.add_argument('--same-photo', action='store_true', help='img2img replies of a chat are to one photo')
+    parser.add_argument('--controlnet', type=float, help='telegram_bot_img2img_controlnet with fake annotator of seconds')
+    parser.add_argument('--controlnet-cache', type=int, default=32, help='telegram_bot_img2img_controlnet_cache_size')
+    parser.add_argument('--models', type=int, default=0, help='requests choose one of checkpoints m0..mN-1')
+    parser.add_argument('--switch-time', type=float, default=3, help='seconds to load other checkpoint')
+    parser.add_argument('--model-wait', type=float, default=60, help='telegram_bot_model_max_wait')
+    parser.add_argument('--input-cache-mb', type=int, default=0, help='telegram_bot_input_cache_mb')
+    parser.add_argument('--remote', type=int, default=0, help='fake remote WebUI backends')
+    parser.add_argument('--dead-remote', type=int, default=0, help='remote backends that refuse connections')
+    parser.add_argument('--no-local', action='store_true', help='generate on remote backends only')
+    parser.add_argument('--crash-after', type=float, help='replace bot instance without handover after seconds')
+    parser.add_argument('--queue-order', choices=('round-robin', 'shortest-first'), default='round-robin', help='telegram_bot_queue_order')
+    parser.add_argument('--wait-slo', type=float, default=0, help='telegram_bot_wait_slo')
+    parser.add_argument('--count', type=int, default=1, help='images per request, sent as album')
+    parser.add_argument('--album', type=int, default=1, help='img2img requests are albums of photos')
+    parser.add_argument('--draft', action='store_true', help='telegram_bot_draft')
+    parser.add_argument('--size', type=int, default=512, help='telegram_bot_img_width and height')
+    parser.add_argument('--image-format', choices=('jpeg', 'webp', 'png'), default='jpeg', help='telegram_bot_image_format')
+    parser.add_argument('--target-kb', type=int, default=0, help='telegram_bot_image_target_kb')
+    parser.add_argument('--encode-workers', type=int, default=2, help='telegram_bot_encode_workers')
+    parser.add_argument('--png-document', action='store_true', help='telegram_bot_png_document')
+    parser.add_argument('--duplicates', type=float, default=0, help='share of requests repeating previous prompt')
+    parser.add_argument('--no-coalesce', action='store_true', help='telegram_bot_coalesce off')
+    parser.add_argument('--trace', help='write job traces (telegram_bot_trace_mb) of scenario to file')
+    parser.add_argument('--engine', choices=('threads', 'asyncio'), default='threads', help='telegram_bot_engine')
+    parser.add_argument('--seed', type=int, default=1, help='traffic random seed')
+    parser.add_argument('--timeout', type=float, default=300, help='max seconds per scenario')
+    parser.add_argument('--json', help='write reports to file')
+    parser.add_argument('--fail-p99', type=float, help='exit 1 if e2e p99 of any scenario is above, seconds')
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f'unknown scenario {name}')
+
+    remotes = [fake_sdapi.FakeSdApi(args.sampling_time, args.switch_time) for _ in range(args.remote)]
+    for remote in remotes:
+        remote.start()
+    urls = [remote.url for remote in remotes] + [fake_sdapi.dead_url() for _ in range(args.dead_remote)]
+
+    fake_webui.install(args.sampling_time, args.per_image_time, {
+        'telegram_bot_api_global_rate': args.global_rate,
+        'telegram_bot_api_chat_rate': args.chat_rate,
+        'telegram_bot_batch_size': args.batch_size,
+        'telegram_bot_max_count': max(args.count, args.album, 1),
+        'telegram_bot_draft': args.draft,
+        'telegram_bot_img_width': args.size,
+        'telegram_bot_img_height': args.size,
+        'telegram_bot_image_format': args.image_format,
+        'telegram_bot_image_target_kb': args.target_kb,
+        'telegram_bot_encode_workers': args.encode_workers,
+        'telegram_bot_png_document': args.png_document,
+        'telegram_bot_input_cache_mb': args.input_cache_mb,
+        'telegram_bot_input_memory_mb': args.input_memory_mb,
+        'telegram_bot_result_cache_size': 0,
+        'telegram_bot_coalesce': not args.no_coalesce,
+        'telegram_bot_queue_order': args.queue_order,
+        'telegram_bot_wait_slo': args.wait_slo,
+        'telegram_bot_local_backend': not args.no_local,
+        'telegram_bot_backends': ';'.join(urls),
+        'telegram_bot_img2img_controlnet': args.controlnet is not None,
+        'telegram_bot_img2img_controlnet_module': 'canny',
+        'telegram_bot_img2img_controlnet_cache_size': args.controlnet_cache,
+        'telegram_bot_models': ';'.join(f'm{i}' for i in range(args.models)),
+        'telegram_bot_model_max_wait': args.model_wait,
+    }, annotator_time=args.controlnet, models=tuple(f'm{i}' for i in range(args.models)), switch_time=args.switch_time)
+    from src import utils
+    # learned costs and caches of bench runs don't go to the extension cache
+    utils.set_cache_dir(tempfile.mkdtemp(prefix='tgbench'))
+
+    reports = []
+    for name in args.scenarios or list(SCENARIOS):
+        report = run_scenario(name, SCENARIOS[name], args, remotes)
+        print_report(report)
+        reports.append(report)
+
+    for remote in remotes:
+        remote.stop()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(reports, f, indent=2)
+
+    failed = [r for r in reports if r['timed_out'] or r['failed']
+              or (args.fail_p99 is not None and r['e2e_p99_s'] is not None and r['e2e_p99_s'] > args.fail_p99)]
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
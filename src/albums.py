@@ -0,0 +1,37 @@
+import collections
+import threading
+from telebot import types
+from src import utils
+
+# seconds to wait for the rest of album after the photo with command
+WINDOW = 1.0
+# albums remembered for replies to them
+MAX_ALBUMS = 256
+
+
+class AlbumCollector:
+    """ Photos of recent albums by media_group_id. Telegram sends each photo
+        of an album as separate message, command is in caption of one of them """
+    __slots__ = ('albums', 'lock')
+
+    def __init__(self) -> None:
+        self.albums = collections.OrderedDict()  # media_group_id -> {message_id: PhotoSize or Document}
+        self.lock = threading.Lock()
+
+    def add(self, message:types.Message):
+        img = utils.get_arg_img(message)
+        if not message.media_group_id or not img:
+            return
+        with self.lock:
+            album = self.albums.get(message.media_group_id)
+            if album is None:
+                album = self.albums[message.media_group_id] = {}
+                while len(self.albums) > MAX_ALBUMS:
+                    self.albums.popitem(last=False)
+            album[message.message_id] = img
+
+    def get(self, media_group_id:str) -> list:
+        """ Photos in album order """
+        with self.lock:
+            album = self.albums.get(media_group_id) or {}
+            return [album[k] for k in sorted(album)]
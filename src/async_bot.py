@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import threading
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+from src import main
+from src.bot_base import BotBase
+from src.outbound import AsyncOutboundQueue
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(level=logging.DEBUG)
+
+sout_h = logging.StreamHandler()
+sout_h.setLevel(level=logging.DEBUG)
+LOGGER.addHandler(sout_h)
+
+# seconds to close http session of stopped bot
+CLOSE_TIMEOUT = 10
+
+
+class AsyncSdTgBot(BotBase):
+    """ Bot engine on AsyncTeleBot: updates, handlers and all Telegram I/O run concurrently
+        on one event loop. The loop has own thread from run until shutdown,
+        so results of the last batches are sent after stop too.
+        Generation runs in the scheduler backend threads """
+    __slots__ = ('loop', 'loop_thread', 'stopped')
+
+    def register(self, callback, **kwargs):
+        async def handle(message:types.Message):
+            callback(message)
+        self.bot.register_message_handler(callback=handle, **kwargs)
+
+    def __call(self, coro):
+        """ Result of coroutine run on the loop, for other threads """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def get_file(self, file_id:str) -> types.File:
+        return self.__call(self.bot.get_file(file_id))
+
+    def download_file(self, file_path:str) -> bytes:
+        return self.__call(self.bot.download_file(file_path))
+
+    def last_update_id(self) -> int:
+        return self.bot.offset - 1 if self.bot.offset else 0
+
+    def set_last_update_id(self, update_id:int):
+        self.bot.offset = update_id + 1 if update_id else None
+
+    async def __receive(self):
+        """ Runs until stopped """
+        webhook = None
+        if main.get_conf('telegram_bot_mode') == 'webhook':
+            webhook = self.webhook_server(
+                lambda updates: self.__call(self.bot.process_new_updates(updates)))
+        if webhook:
+            webhook.start()
+            try:
+                while True:
+                    try:
+                        await self.bot.set_webhook(
+                            url=main.get_conf('telegram_bot_webhook_url'),
+                            secret_token=main.get_conf('telegram_bot_webhook_secret') or None)
+                        break
+                    except Exception as e:
+                        LOGGER.warning("Telegram set webhook error - %s", e)
+                        await asyncio.sleep(1)
+                await asyncio.Event().wait()
+            finally:
+                # server threads wait for loop, stop them outside of it
+                await self.loop.run_in_executor(None, webhook.stop)
+
+        try:
+            # getUpdates doesn't work while webhook is set
+            await self.bot.remove_webhook()
+        except Exception as e:
+            LOGGER.warning("Telegram remove webhook error - %s", e)
+
+        # polling returns when cancelled
+        while not self.stopped.done():
+            await asyncio.sleep(1)
+            try:
+                await self.bot.polling(non_stop=True)
+            except Exception as e:
+                LOGGER.warning("Telegram polling error - %s", e)
+
+    async def __main(self):
+        """ Receives updates until stop """
+        task = asyncio.ensure_future(self.__receive())
+        try:
+            await self.stopped
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def receive(self):
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, name='tg_loop')
+        self.loop_thread.daemon = True
+        self.loop_thread.start()
+        self.__call(self.__main())
+
+    def __set_stopped(self):
+        if not self.stopped.done():
+            self.stopped.set_result(None)
+
+    def stop(self):
+        super().stop()
+        # seen by __main when the loop runs, also if it doesn't run yet
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.__set_stopped)
+
+    def shutdown(self):
+        """ After handover: finish running batch and deliver results, then stop the loop """
+        try:
+            super().shutdown()
+        finally:
+            if self.loop_thread:
+                try:
+                    asyncio.run_coroutine_threadsafe(self.bot.close_session(), self.loop).result(CLOSE_TIMEOUT)
+                except Exception as e:
+                    LOGGER.warning("Cant close telegram session - %s", e)
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self.loop_thread.join()
+            self.loop.close()
+
+    def __init__(self, token:str, handover:dict=None) -> None:
+        """ handover - state of previous instance of the same bot """
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = None
+        # stop before the loop runs is kept too
+        self.stopped = self.loop.create_future()
+        super().__init__(AsyncTeleBot(token=token), AsyncOutboundQueue(
+            global_rate=float(main.get_conf('telegram_bot_api_global_rate')),
+            chat_rate=float(main.get_conf('telegram_bot_api_chat_rate')),
+            loop=self.loop), handover)
+        process_new_updates = self.bot.process_new_updates
+
+        async def process_updates(updates:list):
+            await process_new_updates(self.new_updates(updates))
+
+        self.bot.process_new_updates = process_updates
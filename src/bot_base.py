@@ -0,0 +1,894 @@
+import concurrent.futures
+import functools
+import threading
+import time
+import logging
+import pathlib
+from telebot import types, util
+from src import main, utils, generation, outbound, metrics, backends, encoder, albums, controlnet, tracing, profiler, delivery
+from src.result_cache import ResultCache
+from src.input_cache import InputCache
+from src.inflight import InFlight
+from src.memory_budget import MemoryBudget
+from src.delivery import DeliveryPool
+from src.scheduler import GenJob, GenScheduler
+from src.settings import Settings
+from src.webhook import WebhookServer
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(level=logging.DEBUG)
+
+sout_h = logging.StreamHandler()
+sout_h.setLevel(level=logging.DEBUG)
+LOGGER.addHandler(sout_h)
+
+LOADING_PHOTO = pathlib.Path(pathlib.Path(__file__).parent.parent, 'res', 'loading.png')
+# seconds between progress edits of placeholders
+PROGRESS_INTERVAL = 3
+
+
+class BotBase:
+    """ Jobs, handlers and delivery of the bot. Engines give the transport:
+        Telegram client with outbound queue for its calls, blocking file download,
+        handler registration and receiving of updates.
+        API calls are queued as partials of client methods, the engine's queue runs them """
+    __slots__ = ('bot', 'running', 'finished', 'waiting_image_id', 'scheduler', 'outbound', 'result_cache', 'input_cache', 'delivery',
+                 'journal', 'resume', 'albums', 'input_memory', 'inflight')
+
+    def register(self, callback, **kwargs):
+        """ Add message handler, callback is a blocking function which doesn't wait for API calls """
+        raise NotImplementedError
+
+    def get_file(self, file_id:str) -> types.File:
+        """ Blocking, called in pre-processing threads """
+        raise NotImplementedError
+
+    def download_file(self, file_path:str) -> bytes:
+        """ Blocking, called in pre-processing threads """
+        raise NotImplementedError
+
+    def last_update_id(self) -> int:
+        raise NotImplementedError
+
+    def set_last_update_id(self, update_id:int):
+        """ Updates up to update_id are not received """
+        raise NotImplementedError
+
+    def receive(self):
+        """ Receive updates until stop """
+        raise NotImplementedError
+
+    def __send(self, method:str, priority=outbound.PRIORITY_NORMAL, key=None, skip=None, **kwargs):
+        """ Rate limited call of client method, returns future """
+        future = self.outbound.submit(kwargs['chat_id'], functools.partial(getattr(self.bot, method), **kwargs),
+                                      priority, key, method, skip)
+        future.add_done_callback(outbound.log_error)
+        return future
+
+    @staticmethod
+    def __then(future:concurrent.futures.Future, call):
+        """ call() after future succeeded """
+        def done(future):
+            if not future.cancelled() and future.exception() is None:
+                call()
+        future.add_done_callback(tracing.wrap(done))
+
+    @staticmethod
+    def __waiting_key(waiting:types.Message):
+        """ Progress edits of placeholder are replaced by newer ones and by result """
+        return ('waiting', waiting.chat.id, waiting.message_id)
+
+    def __send_waiting(self, incoming:types.Message, caption:str, on_sent):
+        """ Placeholder photo replying to request, handler doesn't wait for it.
+            on_sent gets the sent message, None if it failed """
+        def send(photo):
+            future = self.outbound.submit(incoming.chat.id,
+                                          functools.partial(
+                                              self.bot.send_photo,
+                                              photo=photo,
+                                              chat_id=incoming.chat.id,
+                                              reply_to_message_id=incoming.id,
+                                              caption=caption),
+                                          method='send_photo')
+            future.add_done_callback(tracing.wrap(functools.partial(sent, uploaded=not isinstance(photo, str))))
+
+        def sent(future, uploaded:bool):
+            try:
+                message = future.result()
+            except Exception as e:
+                if not uploaded and getattr(e, 'error_code', None) == 400:
+                    # saved file_id is not valid anymore, upload again
+                    LOGGER.warning("Loading image file_id rejected - %s", e)
+                    self.waiting_image_id = None
+                    send(LOADING_PHOTO.read_bytes())
+                    return
+                LOGGER.warning("Cant send placeholder to chat %s - %s", incoming.chat.id, e)
+                on_sent(None)
+                return
+            if uploaded and message.photo:
+                self.waiting_image_id = message.photo[0].file_id
+                utils.save_state(utils.waiting_image_state_key(self.bot.token), self.waiting_image_id)
+            on_sent(message)
+
+        send(self.waiting_image_id or LOADING_PHOTO.read_bytes())
+
+    def __update_waiting(self, job:GenJob, progress, eta):
+        waiting = job.waiting
+        # placeholder of draft is shared with its full job, which is the one delivered
+        final = job.draft_of or job
+        if final.delivered:
+            return
+        job.trace.add('progress', time.time(), 0, progress=progress, eta=eta)
+        with tracing.activate([job.trace]):
+            # result may land while the edit waits, it must not be overwritten
+            self.__send('edit_message_caption',
+                        outbound.PRIORITY_PROGRESS,
+                        self.__waiting_key(waiting),
+                        lambda: final.delivered,
+                        message_id=waiting.message_id,
+                        chat_id=waiting.chat.id,
+                        caption=job.settings.get_msg('telegram_bot_waiting_progress_msg', progress=progress, eta=eta))
+
+    @staticmethod
+    def __step(job:GenJob, name:str, call):
+        """ Delivery thread: part of result delivery, done once per job.
+            Transient errors of call are retried, its result is kept by job """
+        if name not in job.steps:
+            job.steps[name] = delivery.retry(call)
+        return job.steps[name]
+
+    def __finish_waiting(self, job:GenJob, supports_read_img, comment_data) -> str:
+        """ Delivery thread: result replaces placeholder, returns file_id of uploaded photo """
+        waiting = job.waiting
+        settings = job.settings
+        msg_send, msg_post = utils.split_caption(
+            settings.get_msg('telegram_bot_generated_msg', gen_data = comment_data))
+
+        sent = self.__step(job, 'result', lambda: self.__send(
+            'edit_message_media',
+            outbound.PRIORITY_RESULT,
+            self.__waiting_key(waiting),
+            message_id=waiting.message_id,
+            chat_id=waiting.chat.id,
+            media=types.InputMediaPhoto(supports_read_img, caption=msg_send)).result())
+        file_id = sent.photo[-1].file_id if isinstance(sent, types.Message) and sent.photo else None
+        # stored under checkpoint the job ran with, it may differ from the one loaded at enqueue
+        result_key = generation.result_key(job.cache_key, job.checkpoint)
+        if result_key and file_id:
+            self.result_cache.put(result_key, file_id, comment_data)
+        if msg_post:
+            self.__step(job, 'post', lambda: self.__send(
+                'send_message', outbound.PRIORITY_RESULT, chat_id=waiting.chat.id, text=msg_post).result())
+        return file_id
+
+    def __finish_draft(self, job:GenJob, supports_read_img):
+        """ Delivery thread: draft shows in placeholder until the full image replaces it.
+            Same key with lower priority than result, so pending result is never replaced by draft """
+        waiting = job.waiting
+        final = job.draft_of
+        # full image may be done first on other backend
+        if final.delivered:
+            return
+        self.__step(job, 'result', lambda: self.__send(
+            'edit_message_media',
+            outbound.PRIORITY_NORMAL,
+            self.__waiting_key(waiting),
+            lambda: final.delivered,
+            message_id=waiting.message_id,
+            chat_id=waiting.chat.id,
+            media=types.InputMediaPhoto(supports_read_img,
+                                        caption=job.settings.get_msg('telegram_bot_draft_msg'))).result())
+        if not final.delivered:
+            tracing.observe('draft', final.enqueued, time.time() - final.enqueued, [final.trace])
+
+    def __finish_group(self, job:GenJob, datas:list, comments:list):
+        """ Delivery thread: images of request with count as one album replying to the request,
+            placeholder photo can't become an album, it is deleted """
+        waiting = job.waiting
+        captions = [utils.split_caption(job.settings.get_msg('telegram_bot_generated_msg', gen_data=comment))
+                    for comment in comments]
+
+        # album, its long captions and the deletion are separate steps, failed one doesn't send the album again
+        self.__step(job, 'result', lambda: self.__send(
+            'send_media_group',
+            outbound.PRIORITY_RESULT,
+            self.__waiting_key(waiting),
+            chat_id=waiting.chat.id,
+            media=[types.InputMediaPhoto(data, caption=caption) for data, (caption, _) in zip(datas, captions)],
+            reply_to_message_id=job.message.message_id).result())
+        msg_post = '\n\n'.join(post for _, post in captions if post)
+        if msg_post:
+            self.__step(job, 'post', lambda: self.__send(
+                'send_message', outbound.PRIORITY_RESULT, chat_id=waiting.chat.id, text=msg_post).result())
+        try:
+            self.__step(job, 'delete', lambda: self.__send(
+                'delete_message', outbound.PRIORITY_RESULT, chat_id=waiting.chat.id, message_id=waiting.message_id).result())
+        except Exception as e:
+            # album is sent, placeholder just stays
+            LOGGER.warning("Cant delete placeholder - %s", e)
+
+    def __cached(self, cache_key:str, params:dict) -> tuple:
+        """ (result_key, cached result) of request made with checkpoint that would run it now """
+        result_key = generation.result_key(cache_key, params.get('model') or generation.loaded_model())
+        return result_key, self.result_cache.get(result_key)
+
+    def __send_cached(self, settings:Settings, incoming:types.Message, cached:tuple, result_key:str=None, on_rejected=None):
+        """ Answer with already uploaded result.
+            Rejected file_id (deleted file, other bot) is evicted and on_rejected is called """
+        file_id, comment_data = cached
+        msg_send, msg_post = utils.split_caption(
+            settings.get_msg('telegram_bot_generated_msg', gen_data = comment_data))
+
+        sent = self.__send('send_photo',
+                           outbound.PRIORITY_RESULT,
+                           photo=file_id,
+                           chat_id=incoming.chat.id,
+                           reply_to_message_id=incoming.id,
+                           caption=msg_send)
+        if msg_post:
+            self.__then(sent, lambda: self.__send('send_message', outbound.PRIORITY_RESULT, chat_id=incoming.chat.id, text=msg_post))
+
+        def rejected(future):
+            if future.cancelled() or getattr(future.exception(), 'error_code', None) != 400:
+                return
+            LOGGER.info("Cached result %s rejected, generating it again", file_id)
+            self.result_cache.remove(result_key)
+            if on_rejected:
+                on_rejected()
+
+        if result_key:
+            sent.add_done_callback(tracing.wrap(rejected))
+
+    def __attach(self, settings:Settings, message:types.Message, flight_key:str) -> bool:
+        """ Request equal to queued or running one gets its result, True if attached """
+        job = self.inflight.attach(flight_key, (settings, message))
+        if job is None:
+            return False
+        metrics.JOBS_COALESCED.inc()
+        job.trace.add('follower', time.time(), 0, chat_id=message.chat.id)
+        return True
+
+    @staticmethod
+    def __error_msg(settings:Settings, error:Exception=None) -> str:
+        """ Text of failed request, error - why it failed if known """
+        if isinstance(error, generation.InputTooLarge):
+            return settings.get_msg('telegram_bot_input_too_large_msg',
+                                    max_mb=settings.get_conf('telegram_bot_input_max_mb'),
+                                    max_mpix=settings.get_conf('telegram_bot_input_max_mpix'))
+        return settings.get_msg('telegram_bot_generated_error_msg')
+
+    def __land(self, job:GenJob, file_id:str=None, comment_data:str='', error:Exception=None):
+        """ Answer followers of done job with its result, of failed one (no file_id) with error """
+        for settings, message in self.inflight.land(job):
+            if file_id:
+                self.__send_cached(settings, message, (file_id, comment_data))
+                continue
+            self.__send('send_message',
+                        outbound.PRIORITY_RESULT,
+                        chat_id=message.chat.id,
+                        reply_to_message_id=message.id,
+                        text=self.__error_msg(settings, error))
+
+    def __error_waiting(self, job:GenJob, error:Exception=None):
+        if job.draft_of:
+            # full job still runs, placeholder stays as is
+            tracing.finish(job.trace, 'error')
+            return
+        waiting = job.waiting
+        bot_id = utils.bot_id(self.bot.token)
+        job.delivered = True
+        self.__land(job, error=error)
+        if 'result' in job.steps:
+            # result is shown, a message after it failed
+            self.journal.remove(bot_id, job)
+            tracing.finish(job.trace, 'error')
+            return
+        # placeholder is a photo, it has caption instead of text
+        with tracing.activate([job.trace]):
+            sent = self.__send('edit_message_caption',
+                               outbound.PRIORITY_RESULT,
+                               self.__waiting_key(waiting),
+                               message_id=waiting.message_id,
+                               chat_id=waiting.chat.id,
+                               caption=self.__error_msg(job.settings, error))
+
+        def answered(future):
+            # bot that can't tell the user (revoked token) keeps the job, next instance resumes it
+            if not future.cancelled() and future.exception() is None:
+                self.journal.remove(bot_id, job)
+            tracing.finish(job.trace, 'error')
+
+        sent.add_done_callback(answered)
+
+    def __progress(self):
+        """ One updater of placeholders of the running batches, until shutdown is done """
+        while not self.finished.wait(PROGRESS_INTERVAL):
+            for backend, jobs in self.scheduler.active():
+                try:
+                    # remote backends are asked over http
+                    progress, eta = backend.progress()
+                except Exception as e:
+                    LOGGER.warning("Cant get progress of %s - %s", backend.name, e)
+                    continue
+                # learned cost of the batch, extrapolation of progress when unknown or overdue
+                remaining = self.scheduler.remaining(backend)
+                if remaining is not None:
+                    eta = remaining
+                for job in jobs:
+                    self.__update_waiting(job, progress, eta)
+
+    def __finish_jobs(self, jobs:list, results:list):
+        """ Send result images back to each job placeholder """
+        # encoding and upload don't hold the GPU worker
+        for job, images in zip(jobs, results):
+            self.delivery.submit(
+                functools.partial(self.__deliver, job, images),
+                on_fail=lambda e, job=job: self.__error_waiting(job))
+
+    def __deliver(self, job:GenJob, images:list):
+        """ Delivery thread, each API call is a step retried on transient errors.
+            images - (image, comment) pairs of job """
+        with tracing.activate([job.trace]):
+            datas = [encoder.encode(job.settings, img) for img, _ in images]
+            if job.draft_of:
+                self.__finish_draft(job, datas[0])
+                tracing.finish(job.trace, 'draft')
+                return
+            job.delivered = True
+            with tracing.stage('upload'):
+                if len(images) == 1:
+                    file_id = self.__finish_waiting(job, datas[0], images[0][1])
+                else:
+                    file_id = None
+                    self.__finish_group(job, datas, [comment for _, comment in images])
+            self.__land(job, file_id, images[0][1])
+            self.journal.remove(utils.bot_id(self.bot.token), job)
+            if job.settings.get_conf('telegram_bot_png_document'):
+                sent = self.__send_documents(job, [encoder.encode_png(img) for img, _ in images])
+                # trace is written with the documents upload
+                sent.add_done_callback(lambda _: tracing.finish(job.trace, 'done'))
+                return
+        tracing.finish(job.trace, 'done')
+
+    def __send_documents(self, job:GenJob, datas:list):
+        """ Lossless copies of result images as files, after the photos """
+        chat_id = job.message.chat.id
+        if len(datas) == 1:
+            return self.__send('send_document', chat_id=chat_id, document=datas[0], reply_to_message_id=job.message.message_id)
+        return self.__send('send_media_group',
+                           chat_id=chat_id,
+                           media=[types.InputMediaDocument(data) for data in datas],
+                           reply_to_message_id=job.message.message_id)
+
+    def __run_jobs(self, jobs:list, backend:backends.Backend):
+        bot_id = utils.bot_id(self.bot.token)
+        for job in jobs:
+            if not job.draft_of:
+                self.journal.set_state(bot_id, job, 'running')
+
+        try:
+            for job in jobs:
+                if job.prepared:
+                    job.prepared.result()
+            results = backend.generate(jobs)
+        except backends.BackendUnavailable:
+            # scheduler gives the rest to another backend
+            for job in jobs:
+                job.attempts += 1
+                if job.attempts >= backends.MAX_ATTEMPTS:
+                    self.__error_waiting(job)
+            raise
+        except Exception as e:
+            LOGGER.exception("Generation error: %s", e)
+            for job in jobs:
+                # input over limits is told to its own request only
+                prepared = job.prepared
+                self.__error_waiting(job, prepared.exception() if prepared and not prepared.cancelled() else None)
+            return
+
+        self.__finish_jobs(jobs, results)
+
+    def __bind(self, job:GenJob):
+        """ Set run and prepare of job by its kind, jobs handed over by old instance are bound again """
+        job.owner = self
+        job.run = self.__run_jobs
+        job.trace.kind = job.kind
+        job.prepare = {
+            'txt2img': None,
+            'img2img': self.__draft_prepare if job.draft_of else self.__img2img_prepare,
+        }[job.kind]
+        job.prepared = None
+
+    def __draft(self, job:GenJob) -> GenJob:
+        """ Quick preview job of single image request, None if drafts are off """
+        settings = job.settings
+        if not settings.get_conf('telegram_bot_draft') or job.count != 1:
+            return None
+        params = generation.draft_params(job.params,
+                                         int(settings.get_conf('telegram_bot_draft_steps')),
+                                         float(settings.get_conf('telegram_bot_draft_scale')))
+        if not params:
+            return None
+        draft = GenJob(job.chat_id, job.message, None, params,
+                       generation.txt2img_batch_key(params) if job.kind == 'txt2img' else None)
+        draft.kind = job.kind
+        draft.image = job.image
+        draft.settings = settings
+        draft.waiting = job.waiting
+        draft.draft_of = job
+        draft.trace = tracing.Trace(job.trace.job_id + '-draft', job.chat_id, job.trace.start)
+        self.__bind(draft)
+        return draft
+
+    def __enqueue(self, settings:Settings, message:types.Message, kind:str, params:dict=None, batch_key=None, image=None, cache_key=None,
+                  flight_key=None):
+        """ Send placeholder with queue position, put generation to scheduler.
+            Jobs with equal batch_key may be generated together,
+            requests with equal flight_key are attached to the job until it is done """
+        job = GenJob(message.chat.id, message, None, params, batch_key)
+        job.kind = kind
+        job.image = image
+        job.cache_key = cache_key
+        job.flight_key = flight_key
+        job.settings = settings
+        # telegram message date to handler, includes filters and auth check
+        job.trace.add('receipt', message.date, max(job.enqueued - message.date, 0))
+
+        with tracing.activate([job.trace]):
+            wait = self.scheduler.predict_wait(job)
+            slo = float(settings.get_conf('telegram_bot_wait_slo') or 0)
+            if slo and wait is not None and wait > slo:
+                # queue can't serve it in time, better to tell now
+                metrics.JOBS_REJECTED.inc()
+                sent = self.__send('send_message',
+                                   chat_id=message.chat.id,
+                                   reply_to_message_id=message.id,
+                                   text=settings.get_msg('telegram_bot_busy_msg', wait=utils.format_wait(wait)))
+                sent.add_done_callback(lambda _: tracing.finish(job.trace, 'rejected'))
+                return
+
+            position = self.scheduler.position(job)
+            self.__bind(job)
+            # followed already while its placeholder is sent
+            self.inflight.add(job)
+            # journaled before placeholder, job without one gets it on resume
+            self.journal.add(utils.bot_id(self.bot.token), job)
+            # counted in positions and waits of next requests, runs when placeholder is sent
+            self.scheduler.submit(job)
+            self.__send_waiting(
+                incoming=message,
+                caption=settings.get_msg('telegram_bot_queued_msg', position=position, wait=utils.format_wait(wait)),
+                on_sent=functools.partial(self.__start, job, True))
+
+    def __start(self, job:GenJob, draft:bool, waiting:types.Message):
+        """ Placeholder of queued job is sent, it can run.
+            Job handed over while its placeholder was sent is started by its new owner """
+        if job.owner is not self:
+            job.owner.__start(job, draft, waiting)
+            return
+        bot_id = utils.bot_id(self.bot.token)
+        if job.delivered:
+            # failed while the placeholder was sent, user got the error
+            if waiting is not None:
+                self.__send('delete_message', chat_id=waiting.chat.id, message_id=waiting.message_id)
+            return
+        if waiting is None:
+            job.delivered = True
+            self.scheduler.cancel(job)
+            self.journal.remove(bot_id, job)
+            self.__land(job)
+            tracing.finish(job.trace, 'error')
+            return
+        job.waiting = waiting
+        self.journal.set_waiting(bot_id, job)
+        # stopped instance doesn't run new jobs, handed over job starts without draft
+        draft = draft and self.running and self.__draft(job)
+        if draft:
+            self.scheduler.submit(draft)
+        self.scheduler.ready(job)
+
+    def __fail_queued(self, job:GenJob):
+        """ Job which can't run on this bot. Error replaces its placeholder,
+            without one the error is a message and placeholder is deleted when it comes """
+        if job.waiting is not None or job.draft_of:
+            self.__error_waiting(job)
+            return
+        job.delivered = True
+        self.scheduler.cancel(job)
+        self.journal.remove(utils.bot_id(self.bot.token), job)
+        self.__land(job)
+        sent = self.__send('send_message',
+                           outbound.PRIORITY_RESULT,
+                           chat_id=job.message.chat.id,
+                           reply_to_message_id=job.message.id,
+                           text=job.settings.get_msg('telegram_bot_generated_error_msg'))
+        sent.add_done_callback(lambda _: tracing.finish(job.trace, 'error'))
+
+    def __resume(self):
+        """ Submit jobs left unfinished by previous webui run """
+        settings = main.get_settings()
+        for entry in self.resume:
+            message = types.Message.de_json(entry.message)
+            job = GenJob(entry.chat_id, message, None, entry.params, entry.batch_key)
+            job.kind = entry.kind
+            job.image = utils.get_arg_img(message)
+            job.cache_key = entry.cache_key
+            job.settings = settings
+            self.__bind(job)
+            if entry.waiting:
+                job.waiting = types.Message.de_json(entry.waiting)
+            self.scheduler.submit(job)
+            if job.waiting:
+                continue
+            self.__send_waiting(
+                incoming=message,
+                caption=settings.get_msg('telegram_bot_queued_msg',
+                                         position=self.scheduler.position(job),
+                                         wait=utils.format_wait(self.scheduler.predict_wait(job))),
+                on_sent=functools.partial(self.__start, job, False))
+        if self.resume:
+            LOGGER.info(f"Resumed {len(self.resume)} unfinished job(s)")
+        self.resume = []
+
+    def new_updates(self, updates:list) -> list:
+        """ Drop updates telegram delivers again after restart, they were handled before """
+        bot_id = utils.bot_id(self.bot.token)
+        return [u for u in updates if self.journal.new_update(bot_id, u.update_id)]
+
+    def filter_msgs(self, msg:types.Message):
+        return main.is_chat_authorized(msg.chat.id)
+
+    def filter_cmd(self, msg:types.Message, mode:str, cmd_code:str=None):
+        """ Commands and their names are checked against current settings,
+            changes apply without registering handlers again """
+        settings = main.get_settings()
+        if mode not in settings.commands or not settings.is_chat_authorized(msg.chat.id):
+            return False
+        cmd = settings.get_cmd(cmd_code) if cmd_code else mode
+        return util.extract_command(utils.get_text(msg)) == cmd
+
+    def filter_admin(self, msg:types.Message, cmd:str):
+        return main.get_settings().is_chat_admin(msg.chat.id) and util.extract_command(utils.get_text(msg)) == cmd
+
+    def on_cmd_start(self, message:types.Message):
+        self.__send('send_message',
+                    chat_id=message.chat.id,
+                    reply_to_message_id=message.id,
+                    text="Hello!")
+
+    def on_profile(self, message:types.Message):
+        """ /profile <seconds> - sample stacks of bot threads, admin gets top functions and stacks file """
+        arg = utils.get_arg(message.text)
+        seconds = float(arg) if arg and arg.replace('.', '', 1).isdigit() else 30
+        # handlers are profiled too, they must not wait for it
+        th = threading.Thread(target=self.__profile, args=(message, seconds), name='profiler')
+        th.daemon = True
+        th.start()
+
+    def __profile(self, message:types.Message, seconds:float):
+        chat_id = message.chat.id
+        path = utils.get_cache_dir() / f'profile-{int(time.time())}.txt'
+        summary = profiler.capture(seconds, str(path))
+        if summary is None:
+            self.__send('send_message', chat_id=chat_id, text=main.get_msg('telegram_bot_profile_busy_msg'))
+            return
+
+        self.__send('send_message', chat_id=chat_id, reply_to_message_id=message.id, text=summary[:4096]).result()
+        if path.stat().st_size:
+            self.__send('send_document', chat_id=chat_id, document=path.read_bytes(), visible_file_name=path.name)
+
+    def on_photo(self, message:types.Message):
+        """ Album photos are remembered, photo with img2img command in caption is generated """
+        self.albums.add(message)
+        if not self.filter_cmd(message, 'img2img', 'telegram_bot_img2img_cmd'):
+            return
+        if message.media_group_id:
+            # rest of album comes in next messages
+            timer = threading.Timer(albums.WINDOW, self.on_img2img, (message,))
+            timer.daemon = True
+            timer.start()
+        else:
+            self.on_img2img(message)
+
+    def on_img2img(self, message:types.Message):
+        settings = main.get_settings()
+        metrics.STAGE_SECONDS.observe(max(time.time() - message.date, 0), 'receipt')
+        max_count = int(settings.get_conf('telegram_bot_max_count'))
+        name, arg = utils.split_model(utils.get_arg(utils.get_text(message)))
+        found, model = self.__find_model(settings, message, name)
+        if not found:
+            return
+        count, prompt = utils.split_count(arg, max_count)
+        if not prompt:
+            prompt = settings.img2img_default_prompt
+
+        album = self.albums.get(utils.get_album_id(message))
+        if len(album) > max_count:
+            self.__send('send_message',
+                        chat_id=message.chat.id,
+                        reply_to_message_id=message.id,
+                        text=settings.get_msg('telegram_bot_album_truncated_msg', count=len(album), max_count=max_count))
+            album = album[:max_count]
+        img = utils.get_arg_img(message)
+
+        if not img and not album:
+            self.__send('send_message', chat_id=message.chat.id, text=settings.get_msg('telegram_bot_invalid_prompt_msg'))
+            return
+
+        max_bytes, max_pixels = generation.input_limits(settings)
+        if any(utils.is_input_too_large(i, max_bytes, max_pixels) for i in album or [img]):
+            self.__send('send_message',
+                        chat_id=message.chat.id,
+                        text=self.__error_msg(settings, generation.InputTooLarge()))
+            return
+
+        if len(album) > 1:
+            self.__enqueue(settings, message, 'img2img', generation.album_params(settings, prompt, album, model),
+                           image=album[0])
+            return
+
+        params = generation.img2img_params(settings, prompt, count, model)
+        # cache keeps single results only
+        cache_key = generation.cache_key(settings, params, img.file_unique_id) if count == 1 else None
+
+        def generate():
+            flight_key = generation.flight_key(settings, params, img.file_unique_id)
+            if self.__attach(settings, message, flight_key):
+                return
+
+            self.__enqueue(settings, message, 'img2img', params,
+                           image=img,
+                           cache_key=cache_key,
+                           flight_key=flight_key)
+
+        result_key, cached = self.__cached(cache_key, params)
+        if cached:
+            self.__send_cached(settings, message, cached, result_key, generate)
+            return
+        generate()
+
+    def __load_input(self, job:GenJob, file_id:str, file_unique_id:str, file_size:int=0):
+        """ Downloaded and decoded inputs are held within input memory budget """
+        box = (job.params['width'], job.params['height'])
+        input_key = generation.input_key(job.params, file_unique_id)
+        img_pil = self.input_cache.get(input_key)
+        if img_pil is not None:
+            tracing.record('input_cache', time.time(), 0, file=file_unique_id)
+            return img_pil
+
+        max_bytes, max_pixels = generation.input_limits(job.settings)
+        reserved = self.input_memory.acquire(file_size or 0)
+        try:
+            with tracing.stage('download', file=file_unique_id):
+                file_props = self.get_file(file_id)
+                if max_bytes and (file_props.file_size or 0) > max_bytes:
+                    raise generation.InputTooLarge(f'Input {file_unique_id} is above {max_bytes} bytes')
+                data = self.download_file(file_props.file_path)
+            # size may be unknown before download
+            if max_bytes and len(data) > max_bytes:
+                raise generation.InputTooLarge(f'Input {file_unique_id} is above {max_bytes} bytes')
+
+            img_pil = generation.open_input(data, box, max_pixels)
+            # downloaded bytes stay counted while waiting for decoding memory
+            reserved = self.input_memory.grow(reserved, len(data) + generation.input_memory(img_pil, box))
+            img_pil = generation.load_input(img_pil, box)
+            self.input_cache.put(input_key, img_pil)
+        finally:
+            self.input_memory.release(reserved)
+        return img_pil
+
+    def __img2img_prepare(self, job:GenJob):
+        """ Pre-processing thread: job.image (PhotoSize or Document) or album photos to job.input """
+        album = job.params.get('album')
+        if not album:
+            job.input = [self.__load_input(job, job.image.file_id, job.image.file_unique_id, job.image.file_size)]
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(len(album), thread_name_prefix='tg_album') as pool:
+            images = list(pool.map(tracing.wrap(lambda ids: self.__load_input(job, *ids)), album))
+        job.input = generation.album_inputs(images, (job.params['width'], job.params['height']))
+
+    def __draft_prepare(self, job:GenJob):
+        """ Pre-processing thread: draft input is downscaled input of the full job, downloaded once """
+        final = job.draft_of
+        if final.prepared:
+            final.prepared.result()
+        else:
+            self.__img2img_prepare(final)
+        img = final.input[0]
+        job.input = [img.resize(generation.input_size(img.size, (job.params['width'], job.params['height'])))]
+
+    def __find_model(self, settings:Settings, message:types.Message, name:str) -> tuple:
+        """ (found, checkpoint title) of --model argument, user is told when it isn't allowed """
+        if name is None:
+            return True, None
+        model = generation.find_model(settings, name)
+        if model is None:
+            self.__send('send_message',
+                        chat_id=message.chat.id,
+                        text=settings.get_msg('telegram_bot_unknown_model_msg',
+                                              models=', '.join(generation.model_names(settings)) or '-'))
+            return False, None
+        return True, model
+
+    def on_txt2img(self, message:types.Message):
+        settings = main.get_settings()
+        metrics.STAGE_SECONDS.observe(max(time.time() - message.date, 0), 'receipt')
+        name, arg = utils.split_model(utils.get_arg(message.text))
+        found, model = self.__find_model(settings, message, name)
+        if not found:
+            return
+        count, prompt = utils.split_count(arg, int(settings.get_conf('telegram_bot_max_count')))
+        if not prompt:
+            self.__send('send_message', chat_id=message.chat.id, text=settings.get_msg('telegram_bot_invalid_prompt_msg'))
+            return
+
+        params = generation.txt2img_params(settings, prompt, count, model)
+
+        cache_key = generation.cache_key(settings, params) if count == 1 else None
+
+        def generate():
+            flight_key = generation.flight_key(settings, params)
+            if self.__attach(settings, message, flight_key):
+                return
+
+            self.__enqueue(settings, message, 'txt2img', params,
+                           batch_key=generation.txt2img_batch_key(params),
+                           cache_key=cache_key,
+                           flight_key=flight_key)
+
+        result_key, cached = self.__cached(cache_key, params)
+        if cached:
+            self.__send_cached(settings, message, cached, result_key, generate)
+            return
+        generate()
+
+    def init_msgs(self):
+        self.register(
+            callback=self.on_cmd_start,
+            func=lambda x : self.filter_cmd(x, 'start'))
+
+        self.register(
+            callback=self.on_profile,
+            func=lambda x : self.filter_admin(x, 'profile'))
+
+        self.register(
+            callback=self.on_txt2img,
+            func=lambda x : self.filter_cmd(x, 'text2img', 'telegram_bot_text2img_cmd'))
+
+        self.register(
+            callback=self.on_img2img,
+            content_types=['text'],
+            func=lambda x : self.filter_cmd(x, 'img2img', 'telegram_bot_img2img_cmd'))
+
+        self.register(
+            callback=self.on_photo,
+            content_types=['photo', 'document'],
+            func=self.filter_msgs)
+
+    def webhook_server(self, process_updates) -> WebhookServer:
+        """ Server for webhook mode, process_updates is blocking.
+            None if it can't listen, bot falls back to polling then """
+        host = main.get_conf('telegram_bot_webhook_host')
+        port = int(main.get_conf('telegram_bot_webhook_port'))
+        try:
+            return WebhookServer(
+                process_updates,
+                host=host,
+                port=port,
+                secret=main.get_conf('telegram_bot_webhook_secret'),
+                queue_size=int(main.get_conf('telegram_bot_webhook_queue_size')))
+        except OSError as e:
+            LOGGER.warning("Cant start webhook server on %s:%s, using polling - %s", host, port, e)
+            return None
+
+    def run(self):
+        if self.running:
+            raise Exception('Bot already running')
+
+        self.running = True
+        self.outbound.start()
+        self.delivery.start()
+        self.scheduler.start()
+        progress = threading.Thread(target=self.__progress, name='tg_progress')
+        progress.daemon = True
+        progress.start()
+        self.__resume()
+        self.receive()
+
+    def stop(self):
+        """ Stop receiving updates, run returns. Queued jobs stay for handover """
+        self.running = False
+        self.scheduler.stop()
+
+    def reconfigure(self):
+        """ Apply changed rates and batching to running bot """
+        self.outbound.configure(
+            global_rate=float(main.get_conf('telegram_bot_api_global_rate')),
+            chat_rate=float(main.get_conf('telegram_bot_api_chat_rate')))
+        self.scheduler.configure(
+            batch_size=int(main.get_conf('telegram_bot_batch_size')),
+            batch_window=float(main.get_conf('telegram_bot_batch_window')),
+            shortest_first=main.get_conf('telegram_bot_queue_order') == 'shortest-first',
+            model_wait=float(main.get_conf('telegram_bot_model_max_wait')))
+        encoder.configure(int(main.get_conf('telegram_bot_encode_workers')))
+        controlnet.configure(int(main.get_conf('telegram_bot_img2img_controlnet_cache_size') or 0))
+        self.input_memory.configure(int(main.get_conf('telegram_bot_input_memory_mb')) * 1024 * 1024)
+
+    def handover(self, token:str) -> dict:
+        """ State for new instance after stop: queued jobs and polling offset.
+            Placeholders can be edited only by the same bot, for other bot jobs fail here """
+        jobs = self.scheduler.detach()
+        if not token or utils.bot_id(token) != utils.bot_id(self.bot.token):
+            for job in jobs:
+                self.__fail_queued(job)
+            return None
+        return {
+            'jobs': jobs,
+            'last_update_id': self.last_update_id(),
+            'waiting_image_id': self.waiting_image_id,
+        }
+
+    def shutdown(self):
+        """ After handover: finish running batch and deliver results """
+        try:
+            self.scheduler.join()
+            self.delivery.join()
+            self.outbound.flush(timeout=30)
+            self.outbound.stop()
+        finally:
+            self.finished.set()
+
+    def __init__(self, bot, outbound_queue:outbound.OutboundQueue, handover:dict=None) -> None:
+        """ bot - client of engine, outbound_queue runs its calls.
+            handover - state of previous instance of the same bot """
+        token = bot.token
+        self.bot = bot
+        self.running = False
+        self.finished = threading.Event()
+        self.waiting_image_id = utils.load_state(utils.waiting_image_state_key(token))
+        self.outbound = outbound_queue
+        self.result_cache = ResultCache(
+            int(main.get_conf('telegram_bot_result_cache_size')),
+            # file_ids of other bot can't be sent
+            str(utils.get_cache_dir() / f'results_{utils.bot_id(token)}.json') if main.get_conf('telegram_bot_result_cache_persist') else None)
+        self.input_cache = InputCache(
+            utils.get_cache_dir() / 'inputs',
+            int(main.get_conf('telegram_bot_input_cache_mb')) * 1024 * 1024)
+        self.delivery = DeliveryPool(
+            workers=int(main.get_conf('telegram_bot_delivery_workers')),
+            queue_size=int(main.get_conf('telegram_bot_delivery_queue_size')))
+        self.journal = main.get_journal()
+        self.albums = albums.AlbumCollector()
+        self.inflight = InFlight()
+        self.input_memory = MemoryBudget(int(main.get_conf('telegram_bot_input_memory_mb')) * 1024 * 1024)
+        encoder.configure(int(main.get_conf('telegram_bot_encode_workers')))
+        controlnet.configure(int(main.get_conf('telegram_bot_img2img_controlnet_cache_size') or 0))
+        self.resume = []
+        self.scheduler = GenScheduler(
+            backends.create(
+                local=main.get_conf('telegram_bot_local_backend'),
+                remote_urls=main.get_conf('telegram_bot_backends')),
+            batch_size=int(main.get_conf('telegram_bot_batch_size')),
+            batch_window=float(main.get_conf('telegram_bot_batch_window')),
+            prepare_ahead=int(main.get_conf('telegram_bot_prepare_ahead')),
+            shortest_first=main.get_conf('telegram_bot_queue_order') == 'shortest-first',
+            model_wait=float(main.get_conf('telegram_bot_model_max_wait')))
+        self.init_msgs()
+
+        if handover:
+            # already processed updates are not received again
+            self.set_last_update_id(handover['last_update_id'])
+            self.waiting_image_id = handover['waiting_image_id'] or self.waiting_image_id
+            for job in handover['jobs']:
+                if job.delivered:
+                    # placeholder failed after the queue was detached
+                    continue
+                self.__bind(job)
+                self.inflight.add(job)
+                self.scheduler.submit(job)
+            LOGGER.info(f"Took over {len(handover['jobs'])} queued job(s)")
+        else:
+            # previous webui run: unfinished jobs are resumed, handled updates skipped
+            self.set_last_update_id(self.journal.last_update_id(utils.bot_id(token)))
+            self.resume = self.journal.pending(utils.bot_id(token))
@@ -0,0 +1,120 @@
+import collections
+import importlib
+import logging
+import threading
+import numpy
+from PIL import Image
+from src.settings import Settings
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(level=logging.DEBUG)
+
+sout_h = logging.StreamHandler()
+sout_h.setLevel(level=logging.DEBUG)
+LOGGER.addHandler(sout_h)
+
+EXTENSION = 'extensions.sd-webui-controlnet.scripts'
+# module of unit with ready control map
+NO_MODULE = 'none'
+
+
+def map_key(settings:Settings, input_id:str, image:Image.Image) -> tuple:
+    """ Control map depends on source photo, its resized size and preprocessor settings.
+        None if there is nothing to cache """
+    module = settings.get_conf('telegram_bot_img2img_controlnet_module')
+    if not input_id or not module or module == NO_MODULE:
+        return None
+    return (input_id, image.size, module,
+            settings.get_conf('telegram_bot_img2img_controlnet_processor_res'),
+            settings.get_conf('telegram_bot_img2img_controlnet_threshold_a'),
+            settings.get_conf('telegram_bot_img2img_controlnet_threshold_b'))
+
+
+class ControlNet:
+    """ ControlNet extension of this WebUI, resolved once, and annotator outputs (control maps)
+        of recent photos, so prompts iterating on one photo don't run the preprocessor again.
+        Least recently used maps are dropped above max_size, 0 - no cache """
+    __slots__ = ('external_code', 'preprocessors', 'aliases', 'max_size', 'maps', 'lock')
+
+    def __init__(self, max_size:int) -> None:
+        self.max_size = max(max_size, 0)
+        self.maps = collections.OrderedDict()  # map_key -> Image
+        self.lock = threading.Lock()
+        self.external_code = None
+        self.preprocessors = {}
+        self.aliases = {}
+        try:
+            self.external_code = importlib.import_module(EXTENSION + '.external_code')
+        except Exception as e:
+            LOGGER.info("ControlNet extension not available - %s", e)
+            return
+        try:
+            global_state = importlib.import_module(EXTENSION + '.global_state')
+            self.preprocessors = global_state.cn_preprocessor_modules
+            self.aliases = getattr(global_state, 'reverse_preprocessor_aliases', {})
+        except Exception as e:
+            LOGGER.info("ControlNet preprocessors not available, control maps are not cached - %s", e)
+
+    def configure(self, max_size:int):
+        with self.lock:
+            self.max_size = max(max_size, 0)
+            while len(self.maps) > self.max_size:
+                self.maps.popitem(last=False)
+
+    def get(self, key:tuple) -> Image.Image:
+        if key is None:
+            return None
+        with self.lock:
+            img = self.maps.get(key)
+            if img is not None:
+                self.maps.move_to_end(key)
+            return img
+
+    def put(self, key:tuple, img:Image.Image):
+        if key is None or not self.max_size:
+            return
+        with self.lock:
+            self.maps[key] = img
+            self.maps.move_to_end(key)
+            while len(self.maps) > self.max_size:
+                self.maps.popitem(last=False)
+
+    def preprocess(self, settings:Settings, image:Image.Image, key:tuple) -> Image.Image:
+        """ Control map of image by preprocessor of this WebUI, cached. Blocking, runs
+            on GPU worker as ControlNet itself would. None if preprocessor isn't available """
+        control_map = self.get(key)
+        if control_map is not None or key is None or not self.max_size:
+            return control_map
+        module = settings.get_conf('telegram_bot_img2img_controlnet_module')
+        preprocessor = self.preprocessors.get(self.aliases.get(module, module))
+        if preprocessor is None:
+            return None
+        result = preprocessor(numpy.array(image),
+                              res=settings.get_conf('telegram_bot_img2img_controlnet_processor_res'),
+                              thr_a=settings.get_conf('telegram_bot_img2img_controlnet_threshold_a'),
+                              thr_b=settings.get_conf('telegram_bot_img2img_controlnet_threshold_b'))
+        if isinstance(result, tuple):
+            result, is_image = result[0], result[1]
+            if not is_image:
+                # embeddings of reference like preprocessors are not maps
+                return None
+        control_map = Image.fromarray(result)
+        self.put(key, control_map)
+        return control_map
+
+
+controlnet = None
+controlnet_lock = threading.Lock()
+
+
+def get_controlnet() -> ControlNet:
+    """ Extension is imported on first use, after WebUI loaded it """
+    global controlnet
+    with controlnet_lock:
+        if controlnet is None:
+            controlnet = ControlNet(0)
+        return controlnet
+
+
+def configure(cache_size:int):
+    get_controlnet().configure(cache_size)
@@ -0,0 +1,105 @@
+import threading
+
+# weight of older batches after each new one
+DECAY = 0.95
+# pixels of one work unit
+MEGAPIXEL = 512 * 512
+# cost of another image in batch relative to first one, until batches were measured
+BATCH_PRIOR = 0.5
+
+
+def features(jobs:list) -> tuple:
+    """ (work of one image, work of the other images in batch).
+        Work is sampling steps * megapixels in 512x512 units """
+    params = jobs[0].params
+    steps = params['steps']
+    # img2img runs steps * denoising sampling steps
+    if jobs[0].kind == 'img2img':
+        steps = max(int(steps * params['denoising_strength']), 1)
+    work = steps * params['width'] * params['height'] / MEGAPIXEL
+    images = sum(job.params.get('count', 1) for job in jobs)
+    return (work, work * (images - 1))
+
+
+def model_key(jobs:list) -> str:
+    params = jobs[0].params
+    return f"{jobs[0].kind}|{params['sampler_name']}|{int(bool(params.get('controlnet')))}"
+
+
+def solve(a:list, b:list) -> list:
+    """ Gaussian elimination for small systems, None if singular """
+    n = len(b)
+    m = [list(a[i]) + [b[i]] for i in range(n)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(m[r][col]))
+        if abs(m[pivot][col]) < 1e-9:
+            return None
+        m[col], m[pivot] = m[pivot], m[col]
+        for r in range(n):
+            if r != col:
+                f = m[r][col] / m[col][col]
+                for c in range(col, n + 1):
+                    m[r][c] -= f * m[col][c]
+    return [m[i][n] / m[i][i] for i in range(n)]
+
+
+class CostModel:
+    """ Batch generation seconds learned from finished batches of one backend:
+        seconds = overhead + first * work + other * work of other images in batch,
+        fitted per kind, sampler and ControlNet use by least squares with exponential forgetting.
+        Key '*' fits all batches, used for keys not seen yet """
+    __slots__ = ('fits', 'lock')
+    # decayed sums: n, x, z, y, xx, xz, zz, xy, zy
+    SIZE = 9
+
+    def __init__(self, state:dict=None) -> None:
+        self.fits = {k: list(v) for k, v in (state or {}).items() if len(v) == self.SIZE}
+        self.lock = threading.Lock()
+
+    def state(self) -> dict:
+        with self.lock:
+            return {k: list(v) for k, v in self.fits.items()}
+
+    def observe(self, jobs:list, seconds:float):
+        x, z = features(jobs)
+        y = seconds
+        with self.lock:
+            for key in (model_key(jobs), '*'):
+                fit = self.fits.setdefault(key, [0.0] * self.SIZE)
+                for i, value in enumerate((1, x, z, y, x * x, x * z, z * z, x * y, z * y)):
+                    fit[i] = fit[i] * DECAY + value
+
+    @staticmethod
+    def coefficients(fit:list) -> tuple:
+        """ (overhead, first, other) """
+        n, sx, sz, sy, sxx, sxz, szz, sxy, szy = fit
+        # n is decayed count of batches
+        if n > 2.5:
+            c = solve([[n, sx, sz], [sx, sxx, sxz], [sz, sxz, szz]], [sy, sxy, szy])
+            if c and c[0] >= 0 and c[1] > 0 and c[2] >= 0:
+                return tuple(c)
+        # batches of one size only, other images cost a prior share of first
+        sw = sx + BATCH_PRIOR * sz
+        sww = sxx + 2 * BATCH_PRIOR * sxz + BATCH_PRIOR ** 2 * szz
+        swy = sxy + BATCH_PRIOR * szy
+        if n > 1.5:
+            c = solve([[n, sw], [sw, sww]], [sy, swy])
+            if c and c[0] >= 0 and c[1] > 0:
+                return (c[0], c[1], BATCH_PRIOR * c[1])
+        per_unit = sy / sw if sw else 0.0
+        return (0.0, per_unit, BATCH_PRIOR * per_unit)
+
+    def learned(self) -> bool:
+        """ Any batch finished, predict gives seconds for every batch """
+        with self.lock:
+            return '*' in self.fits
+
+    def predict(self, jobs:list) -> float:
+        """ Seconds for batch, None before any batch finished """
+        with self.lock:
+            fit = self.fits.get(model_key(jobs)) or self.fits.get('*')
+            if not fit or fit[0] <= 0:
+                return None
+            overhead, first, other = self.coefficients(fit)
+        x, z = features(jobs)
+        return overhead + first * x + other * z
@@ -0,0 +1,92 @@
+import asyncio
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+from telebot import asyncio_helper
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(level=logging.DEBUG)
+
+sout_h = logging.StreamHandler()
+sout_h.setLevel(level=logging.DEBUG)
+LOGGER.addHandler(sout_h)
+
+RETRIES = 3
+RETRY_DELAY = 1
+
+
+def transient(e:Exception) -> bool:
+    """ Error of API call that may pass on retry: network errors, timeouts and server errors.
+        Flood limit errors are retried by the outbound queue """
+    if isinstance(e, (OSError, asyncio.TimeoutError, concurrent.futures.TimeoutError, asyncio_helper.RequestTimeout)):
+        return True
+    code = getattr(e, 'error_code', None) or getattr(getattr(e, 'result', None), 'status_code', None)
+    return isinstance(code, int) and code >= 500
+
+
+def retry(call):
+    """ Result of call, transient errors are retried. Other errors are raised at once,
+        the call may have done its part - retrying it would send the message twice """
+    for attempt in range(RETRIES + 1):
+        try:
+            return call()
+        except Exception as e:
+            if attempt == RETRIES or not transient(e):
+                raise
+            LOGGER.warning("Delivery error, retry %s - %s", attempt + 1, e)
+            time.sleep(RETRY_DELAY * 2 ** attempt)
+
+
+class DeliveryPool:
+    """ Post-processing workers: encode results and upload them after the GPU is released.
+        Queue is bounded - when uploads can't keep up, GPU worker waits on submit """
+    __slots__ = ('tasks', 'workers', 'running')
+
+    def __init__(self, workers:int, queue_size:int) -> None:
+        self.tasks = queue.Queue(maxsize=max(queue_size, 1))
+        self.workers = [threading.Thread(target=self.__work, name='tg_delivery', daemon=True)
+                        for _ in range(max(workers, 1))]
+        self.running = False
+
+    def submit(self, task, on_fail=None):
+        """ task - blocking callable, its steps retry own errors (see retry).
+            on_fail is called with the exception if task fails """
+        self.tasks.put((task, on_fail))
+
+    def __work(self):
+        while True:
+            item = self.tasks.get()
+            if item is None:
+                return
+            task, on_fail = item
+            try:
+                task()
+            except Exception as e:
+                LOGGER.exception("Delivery failed: %s", e)
+                if on_fail:
+                    try:
+                        on_fail(e)
+                    except Exception as fail_e:
+                        LOGGER.warning("Delivery fail handler error - %s", fail_e)
+
+    def start(self):
+        self.running = True
+        for th in self.workers:
+            th.start()
+
+    def stop(self):
+        self.running = False
+        for _ in self.workers:
+            self.tasks.put(None)
+
+    def join(self):
+        """ Deliver queued results and stop workers """
+        if not self.running:
+            return
+        for _ in self.workers:
+            self.tasks.put(None)
+        for th in self.workers:
+            th.join()
+        self.running = False
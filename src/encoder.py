@@ -0,0 +1,157 @@
+import concurrent.futures
+import concurrent.futures.process
+import io
+import logging
+import multiprocessing
+import threading
+from PIL import Image
+from src import tracing
+from src.settings import Settings
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(level=logging.DEBUG)
+
+sout_h = logging.StreamHandler()
+sout_h.setLevel(level=logging.DEBUG)
+LOGGER.addHandler(sout_h)
+
+# quality search for target size doesn't go below
+MIN_QUALITY = 30
+# tries of quality search, quality range is halved by each
+SEARCH_STEPS = 4
+# libwebp effort 0-6, default 4 is ~3x slower for few percent of size
+WEBP_METHOD = 2
+EXTENSIONS = {'jpeg': 'jpg', 'webp': 'webp', 'png': 'png'}
+
+
+def save(img:Image.Image, fmt:str, quality:int, progressive:bool) -> bytes:
+    data = io.BytesIO()
+    if fmt == 'png':
+        img.save(data, format='png')
+    elif fmt == 'webp':
+        img.save(data, format='webp', quality=quality, method=WEBP_METHOD)
+    else:
+        img.save(data, format='jpeg', quality=quality, progressive=progressive, optimize=progressive)
+    return data.getvalue()
+
+
+def encode_bytes(img:Image.Image, fmt:str, quality:int, target_bytes:int, progressive:bool) -> bytes:
+    """ Runs in encoder process. With target_bytes the best quality fitting it is searched,
+        smallest tried result is used when none fits """
+    data = save(img, fmt, quality, progressive)
+    if fmt == 'png' or not target_bytes or len(data) <= target_bytes:
+        return data
+
+    best = None
+    smallest = data
+    low, high = MIN_QUALITY, quality - 1
+    for _ in range(SEARCH_STEPS):
+        if low > high:
+            break
+        q = (low + high) // 2
+        candidate = save(img, fmt, q, progressive)
+        if len(candidate) <= target_bytes:
+            best = candidate
+            low = q + 1
+        else:
+            high = q - 1
+        if len(candidate) < len(smallest):
+            smallest = candidate
+    return best or smallest
+
+
+class Encoder:
+    """ Result images are encoded in worker processes, so encoding doesn't hold
+        the GIL for telegram I/O and sampling threads. workers 0 - encode in calling thread """
+    __slots__ = ('workers', 'pool', 'lock')
+
+    def __init__(self, workers:int) -> None:
+        self.workers = max(workers, 0)
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """ Spawn processes now, first results don't wait for interpreter start """
+        pool = self.__pool()
+        if pool:
+            for _ in range(self.workers):
+                pool.submit(int)
+
+    def __pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        with self.lock:
+            if self.pool is None and self.workers:
+                # fork of webui process would copy torch and CUDA state
+                self.pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self.pool
+
+    def __drop_pool(self, pool):
+        with self.lock:
+            if self.pool is pool:
+                self.pool = None
+        pool.shutdown(wait=False)
+
+    def encode(self, img:Image.Image, fmt:str, quality:int=95, target_bytes:int=0, progressive:bool=False) -> io.BytesIO:
+        """ Blocking, file object named by format for upload """
+        with tracing.stage('encode', format=fmt):
+            data = None
+            pool = self.__pool()
+            if pool:
+                try:
+                    data = pool.submit(encode_bytes, img, fmt, quality, target_bytes, progressive).result()
+                except concurrent.futures.process.BrokenProcessPool as e:
+                    # started again for next image
+                    LOGGER.warning("Encoder processes failed, encoding in thread - %s", e)
+                    self.__drop_pool(pool)
+            if data is None:
+                data = encode_bytes(img, fmt, quality, target_bytes, progressive)
+
+        output = io.BytesIO(data)
+        output.name = 'image.' + EXTENSIONS[fmt]
+        return output
+
+    def stop(self):
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool:
+            pool.shutdown(wait=False)
+
+
+encoder = None
+encoder_lock = threading.Lock()
+
+
+def configure(workers:int):
+    """ Start or resize encoder, its processes survive bot restarts """
+    global encoder
+    with encoder_lock:
+        if encoder and encoder.workers == max(workers, 0):
+            return
+        if encoder:
+            encoder.stop()
+        encoder = Encoder(workers)
+        encoder.start()
+
+
+def get_encoder() -> Encoder:
+    """ Encoder in calling thread until configured """
+    global encoder
+    with encoder_lock:
+        if encoder is None:
+            encoder = Encoder(0)
+        return encoder
+
+
+def encode(settings:Settings, img:Image.Image) -> io.BytesIO:
+    """ Result image for sending as photo, format and size by settings """
+    return get_encoder().encode(
+        img,
+        settings.get_conf('telegram_bot_image_format'),
+        int(settings.get_conf('telegram_bot_image_quality')),
+        int(settings.get_conf('telegram_bot_image_target_kb') or 0) * 1024,
+        bool(settings.get_conf('telegram_bot_image_progressive')))
+
+
+def encode_png(img:Image.Image) -> io.BytesIO:
+    """ Lossless copy for sending as document """
+    return get_encoder().encode(img, 'png')
@@ -0,0 +1,427 @@
+import base64
+import io
+import hashlib
+import json
+import logging
+import time
+import numpy
+from PIL import Image, ImageOps
+from modules import shared, scripts, sd_models
+from modules.processing import StableDiffusionProcessing, Processed, StableDiffusionProcessingTxt2Img, \
+    StableDiffusionProcessingImg2Img, process_images
+from src import utils, controlnet, tracing
+from src.settings import Settings
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(level=logging.DEBUG)
+
+sout_h = logging.StreamHandler()
+sout_h.setLevel(level=logging.DEBUG)
+LOGGER.addHandler(sout_h)
+
+opts = shared.opts
+
+# Generation code shared by bot engines, runs without any telegram I/O
+
+
+def get_seed(settings:Settings) -> int:
+    if settings.seed == -1:
+        return utils.get_seed()
+    return settings.seed
+
+
+def with_model(params:dict, model:str) -> dict:
+    """ model - checkpoint title chosen by user, without it the loaded one is used """
+    if model:
+        params['model'] = model
+    return params
+
+
+def txt2img_params(settings:Settings, prompt:str, count:int=1, model:str=None) -> dict:
+    """ count - images of request, generated with seeds seed, seed + 1, ... """
+    return with_model({
+        'prompt': prompt,
+        'count': count,
+        'seed': get_seed(settings),
+        'negative_prompt': settings.negative_prompt,
+        'sampler_name': settings.sampler,
+        'steps': settings.steps,
+        'cfg_scale': settings.cfg_scale,
+        'width': settings.width,
+        'height': settings.height,
+    }, model)
+
+
+def txt2img_batch_key(params:dict) -> tuple:
+    """ Jobs differing only by prompt, seed and count are generated as one batch """
+    return ('txt2img',) + tuple(v for k, v in sorted(params.items())
+                                if k not in ('prompt', 'seed', 'count'))
+
+
+def img2img_params(settings:Settings, prompt:str, count:int=1, model:str=None) -> dict:
+    """ width and height - box the input is fitted in """
+    return with_model({
+        'prompt': prompt,
+        'count': count,
+        'seed': get_seed(settings),
+        'negative_prompt': settings.negative_prompt,
+        'denoising_strength': settings.denoising,
+        'sampler_name': settings.sampler,
+        'steps': settings.steps,
+        'cfg_scale': settings.cfg_scale,
+        'width': settings.width,
+        'height': settings.height,
+        'controlnet': settings.controlnet,
+    }, model)
+
+
+def draft_params(params:dict, steps:int, scale:float) -> dict:
+    """ Quick preview of params - same prompt and seed, fewer steps and smaller size.
+        None if it wouldn't be cheaper """
+    draft = dict(params)
+    draft['steps'] = min(max(steps, 1), params['steps'])
+    # sizes stay multiple of 8 as webui needs
+    draft['width'] = max(int(params['width'] * scale) // 8 * 8, 64)
+    draft['height'] = max(int(params['height'] * scale) // 8 * 8, 64)
+    if draft == params:
+        return None
+    return draft
+
+
+def album_params(settings:Settings, prompt:str, album:list, model:str=None) -> dict:
+    """ img2img of each photo of album (PhotoSize or Document list), generated as one batch.
+        File ids are kept in params, so journaled jobs can download them again """
+    params = img2img_params(settings, prompt, len(album), model)
+    # ControlNet unit takes one control image, album photos differ
+    params['controlnet'] = False
+    params['album'] = [[img.file_id, img.file_unique_id] for img in album]
+    return params
+
+
+def model_names(settings:Settings) -> list:
+    """ Checkpoints users can choose, empty - choice is off """
+    return [name.strip() for name in (settings.get_conf('telegram_bot_models') or '').split(';') if name.strip()]
+
+
+def find_model(settings:Settings, name:str) -> str:
+    """ Title of allowed checkpoint by its name in settings, None if not allowed or not found """
+    for allowed in model_names(settings):
+        if allowed.lower() == name.lower():
+            info = sd_models.get_closet_checkpoint_match(allowed)
+            return info.title if info else None
+    return None
+
+
+def loaded_model() -> str:
+    """ Title of checkpoint loaded in this WebUI """
+    info = getattr(shared.sd_model, 'sd_checkpoint_info', None)
+    return getattr(info, 'title', None)
+
+
+def load_model(title:str):
+    """ Blocking checkpoint switch, call from the GPU worker only """
+    info = sd_models.get_closet_checkpoint_match(title)
+    if info is None:
+        raise Exception(f'Checkpoint {title} not found')
+    # WebUI option keeps the user's choice, processing of bot jobs names its checkpoint
+    sd_models.reload_model_weights(info=info)
+
+
+CONTROLNET_OPTIONS = ('model', 'module', 'processor_res', 'threshold_a', 'threshold_b')
+
+
+def controlnet_options(settings:Settings, params:dict) -> dict:
+    """ ControlNet options the image depends on, None when request doesn't use it """
+    if not params.get('controlnet'):
+        return None
+    return {name: settings.get_conf(f'telegram_bot_img2img_controlnet_{name}') for name in CONTROLNET_OPTIONS}
+
+
+def cache_key(settings:Settings, params:dict, input_id:str=None) -> str:
+    """ Key of request in result cache, None when results are not reproducible (random seed).
+        Checkpoint is added by result_key when it is known.
+        input_id - file_unique_id of img2img input """
+    if settings.seed == -1:
+        return None
+    data = {
+        'params': params,
+        'input': input_id,
+        'controlnet': controlnet_options(settings, params),
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def result_key(cache_key:str, model:str) -> str:
+    """ Result cache key of request run with checkpoint title, None if either is unknown """
+    if not cache_key or not model:
+        return None
+    return hashlib.sha256(f'{cache_key}:{model}'.encode()).hexdigest()
+
+
+def flight_key(settings:Settings, params:dict, input_id:str=None) -> str:
+    """ Key of equal in-flight requests, they share one generation. None when coalescing is off.
+        With random seed any seed is as good, it is left out. input_id - file_unique_id of img2img input """
+    if not settings.get_conf('telegram_bot_coalesce') or params.get('count', 1) != 1:
+        return None
+    if settings.seed == -1:
+        params = {k: v for k, v in params.items() if k != 'seed'}
+    data = {
+        'params': params,
+        'input': input_id,
+        'controlnet': controlnet_options(settings, params),
+        # other options outside of params
+        'settings': settings.version,
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def input_key(params:dict, input_id:str) -> str:
+    """ Input cache key - resized input depends on target box only """
+    return f"{input_id}_{params['width']}x{params['height']}"
+
+
+def input_size(size:tuple, box:tuple) -> tuple:
+    """ Size of img2img input fitted in box (width, height), keeps aspect ratio of incoming image """
+    # ex aspect radio 1024/512 = 0.5
+    # need 128 x 128
+    # x = 256
+    # y = 128
+    # y / aspect = x
+    # 128 / 0.5 = 256
+    xy = size[0] / size[1]
+    if xy >= 1 :
+        # width  > height
+        # incoming - 1000 x 500
+        # need - 512x512
+        # xy = 2
+        # calc - 512 x 256  y = (x / xy)
+        return (int(box[0]), int(box[0] / xy))
+    else :
+        # width < height
+        # incoming - 500 x 1000
+        # need - 512x512
+        # xy = 0.5
+        # calc - 256 x 512 (y * xy)
+        return (int(box[1] * xy)), int(box[1])
+
+
+class InputTooLarge(ValueError):
+    """ img2img input above limits, found when it's downloaded """
+
+
+def input_limits(settings:Settings) -> tuple:
+    """ (max_bytes, max_pixels) of img2img input, 0 - no limit """
+    return (int(float(settings.get_conf('telegram_bot_input_max_mb')) * 1024 * 1024),
+            int(float(settings.get_conf('telegram_bot_input_max_mpix')) * 1000 * 1000))
+
+
+def open_input(data:bytes, box:tuple, max_pixels:int=0) -> Image.Image:
+    """ Read header of downloaded photo, pixels aren't decoded yet.
+        JPEG is set to decode at reduced scale, down to the smallest not below the box.
+        InputTooLarge if image has more than max_pixels (0 - no limit) """
+    img_pil = Image.open(io.BytesIO(data))
+    LOGGER.debug(f"img2img incoming {img_pil.size[0]}x{img_pil.size[1]}")
+    if max_pixels and img_pil.size[0] * img_pil.size[1] > max_pixels:
+        raise InputTooLarge(f'Input {img_pil.size[0]}x{img_pil.size[1]} is above {max_pixels} pixels')
+    img_pil.draft('RGB', input_size(img_pil.size, box))
+    return img_pil
+
+
+def input_memory(img_pil:Image.Image, box:tuple) -> int:
+    """ Upper estimate of bytes for decoding opened input and its resized copy """
+    width, height = input_size(img_pil.size, box)
+    return img_pil.size[0] * img_pil.size[1] * 4 + width * height * 3
+
+
+def load_input(img_pil:Image.Image, box:tuple) -> Image.Image:
+    """ Decode opened photo and resize it for img2img """
+    with tracing.stage('decode', size=f'{img_pil.size[0]}x{img_pil.size[1]}'):
+        # reducing_gap - integer box reduction first, then resampling of near-target image
+        img_pil = img_pil.resize(input_size(img_pil.size, box), reducing_gap=3.0).convert("RGB")
+    LOGGER.debug(f"img2img resizied {img_pil.size[0]}x{img_pil.size[1]}")
+    return img_pil
+
+
+def album_size(sizes:list, box:tuple) -> tuple:
+    """ Common size of album inputs - median aspect ratio fitted in box, multiple of 8 """
+    aspects = sorted(w / h for w, h in sizes)
+    w, h = input_size((aspects[len(aspects) // 2], 1), box)
+    return (max(w // 8 * 8, 64), max(h // 8 * 8, 64))
+
+
+def album_inputs(images:list, box:tuple) -> list:
+    """ Album photos cropped to one size, they are generated as one batch """
+    size = album_size([img.size for img in images], box)
+    return [img if img.size == size else ImageOps.fit(img, size) for img in images]
+
+
+def fill_args(p: StableDiffusionProcessing):
+    last_arg_index = 1
+    for script in p.scripts.scripts:
+        if last_arg_index < script.args_to:
+            last_arg_index = script.args_to
+    p.script_args = [None] * last_arg_index
+    p.script_args[0] = 0
+
+
+def controlnet_args(settings:Settings, p: StableDiffusionProcessing, image:Image, input_id:str=None):
+    """ input_id - file_unique_id of source photo, its control map is cached """
+    cn = controlnet.get_controlnet()
+    if cn.external_code is None:
+        return
+    try:
+        module = settings.get_conf('telegram_bot_img2img_controlnet_module')
+        with tracing.span('control_map'):
+            control_map = cn.preprocess(settings, image, controlnet.map_key(settings, input_id, image))
+        if control_map is not None:
+            image, module = control_map, controlnet.NO_MODULE
+        units = [
+            cn.external_code.ControlNetUnit(
+                model=settings.get_conf('telegram_bot_img2img_controlnet_model'),
+                module=module,
+                processor_res=settings.get_conf('telegram_bot_img2img_controlnet_processor_res'),
+                threshold_a=settings.get_conf('telegram_bot_img2img_controlnet_threshold_a'),
+                threshold_b=settings.get_conf('telegram_bot_img2img_controlnet_threshold_b'),
+                guess_mode=False,
+                image={'image': numpy.array(image), 'mask' : None}
+            )
+        ]
+
+        cn.external_code.update_cn_script_in_processing(p, units)
+    except Exception as e:
+        LOGGER.warning("ControlNet args failed - %s", e)
+
+
+def controlnet_unit(settings:Settings, image:Image.Image, control_map:Image.Image=None) -> dict:
+    """ ControlNet unit for alwayson_scripts of WebUI API, control_map - ready annotator output """
+    data = io.BytesIO()
+    (control_map or image).save(data, format='png')
+    return {
+        'model': settings.get_conf('telegram_bot_img2img_controlnet_model'),
+        'module': controlnet.NO_MODULE if control_map else settings.get_conf('telegram_bot_img2img_controlnet_module'),
+        'processor_res': settings.get_conf('telegram_bot_img2img_controlnet_processor_res'),
+        'threshold_a': settings.get_conf('telegram_bot_img2img_controlnet_threshold_a'),
+        'threshold_b': settings.get_conf('telegram_bot_img2img_controlnet_threshold_b'),
+        'guess_mode': False,
+        'input_image': base64.b64encode(data.getvalue()).decode(),
+    }
+
+
+def images_count(jobs:list) -> int:
+    return sum(job.params.get('count', 1) for job in jobs)
+
+
+def job_seeds(params:dict) -> list:
+    """ Seed of each image of request """
+    return [params['seed'] + i for i in range(params.get('count', 1))]
+
+
+def batch_shape(images:int, max_batch:int) -> tuple:
+    """ (batch_size, n_iter) for images of one process_images call, batch_size up to max_batch """
+    if images <= max_batch:
+        return (images, 1)
+    size = max(d for d in range(1, max(max_batch, 1) + 1) if images % d == 0)
+    return (size, images // size)
+
+
+def txt2img_processing(jobs:list, max_batch:int) -> StableDiffusionProcessing:
+    """ One processing for batch of txt2img jobs with equal batch_key,
+        images of a job with count > 1 follow each other """
+    params = jobs[0].params
+    batch_size, n_iter = batch_shape(images_count(jobs), max_batch)
+    p = StableDiffusionProcessingTxt2Img(
+        sd_model=shared.sd_model,
+        outpath_samples=opts.outdir_samples or opts.outdir_txt2img_samples,
+        outpath_grids=opts.outdir_grids or opts.outdir_txt2img_grids,
+        prompt=[job.params['prompt'] for job in jobs for _ in range(job.params.get('count', 1))],
+        negative_prompt=params['negative_prompt'],
+        seed=[seed for job in jobs for seed in job_seeds(job.params)],
+        sampler_name=params['sampler_name'],
+        batch_size=batch_size,
+        n_iter=n_iter,
+        steps=params['steps'],
+        cfg_scale=params['cfg_scale'],
+        width=params['width'],
+        height=params['height'],
+        do_not_save_grid=True,
+    )
+
+    p.scripts = scripts.scripts_txt2img
+    fill_args(p)
+    return p
+
+
+def img2img_processing(settings:Settings, params:dict, inputs:list, max_batch:int=1, input_id:str=None) -> StableDiffusionProcessing:
+    """ inputs - one image for count results, or album - images of one size, result for each.
+        input_id - file_unique_id of single input """
+    count = params.get('count', 1)
+    if len(inputs) > 1:
+        batch_size, n_iter = len(inputs), 1
+    else:
+        batch_size, n_iter = batch_shape(count, max_batch)
+    img_pil = inputs[0]
+    p = StableDiffusionProcessingImg2Img(
+        init_images=inputs,
+        outpath_samples=opts.outdir_samples or opts.outdir_txt2img_samples,
+        outpath_grids=opts.outdir_grids or opts.outdir_txt2img_grids,
+        denoising_strength=params['denoising_strength'],
+        resize_mode=2,
+        prompt=params['prompt'] if count == 1 else [params['prompt']] * count,
+        negative_prompt=params['negative_prompt'],
+        seed=params['seed'] if count == 1 else job_seeds(params),
+        sampler_name=params['sampler_name'],
+        batch_size=batch_size,
+        n_iter=n_iter,
+        steps=params['steps'],
+        cfg_scale=params['cfg_scale'],
+        width=img_pil.size[0],
+        height=img_pil.size[1])
+
+    p.scripts = scripts.scripts_img2img
+    fill_args(p)
+
+    if params['controlnet']:
+        controlnet_args(settings, p, img_pil, input_id)
+    return p
+
+
+def process(p:StableDiffusionProcessing, checkpoint:str=None) -> Processed:
+    """ Blocking generation, call from the GPU worker only.
+        checkpoint - title the jobs run with. WebUI would load checkpoint of its option otherwise,
+        the option is set only for this processing """
+    LOGGER.debug(f'Gen {p.__class__} {p.prompt}, {p.width}x{p.height}')
+    if checkpoint:
+        p.override_settings = dict(getattr(p, 'override_settings', None) or {}, sd_model_checkpoint=checkpoint)
+        p.override_settings_restore_afterwards = True
+
+    shared.state.begin()
+    try:
+        processed = p.scripts.run(p, *p.script_args)
+        if processed is None:
+            processed = process_images(p)
+    finally:
+        seconds = time.time() - shared.state.time_start
+        steps = p.steps * p.n_iter
+        tracing.observe('sampling', shared.state.time_start, seconds,
+                        steps=p.steps, images=p.batch_size * p.n_iter, step_seconds=round(seconds / max(steps, 1), 4))
+        shared.state.end()
+    return processed
+
+
+def result_images(jobs:list, res:Processed) -> list:
+    """ Result images of each job (list per job), None if generation failed """
+    if not res or len(res.images) - res.index_of_first_image < images_count(jobs):
+        return None
+    result = []
+    index = res.index_of_first_image
+    for job in jobs:
+        count = job.params.get('count', 1)
+        result.append(res.images[index:index + count])
+        index += count
+    return result
+
+
+def gen_comment(settings:Settings, p:StableDiffusionProcessing, res:Processed, index:int) -> str:
+    if settings.comment_send:
+        return res.infotext(p, index)
+    return ''
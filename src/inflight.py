@@ -0,0 +1,37 @@
+import threading
+
+
+class InFlight:
+    """ Queued and running jobs by flight key. Request equal to one of them is attached
+        to it as follower and answered with its result, so a burst of same prompts costs
+        one generation. Followers are kept by the job, they go with it on handover """
+    __slots__ = ('jobs', 'lock')
+
+    def __init__(self) -> None:
+        self.jobs = {}  # flight_key -> GenJob
+        self.lock = threading.Lock()
+
+    def add(self, job):
+        """ Job without flight_key can't be followed """
+        if job.flight_key is None:
+            return
+        with self.lock:
+            self.jobs.setdefault(job.flight_key, job)
+
+    def attach(self, key:str, follower:tuple):
+        """ Job follower was attached to, None if no equal job is in flight """
+        if key is None:
+            return None
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is not None:
+                job.followers.append(follower)
+            return job
+
+    def land(self, job) -> list:
+        """ Job is done or failed, no more followers are attached. Returns its followers """
+        with self.lock:
+            if job.flight_key is not None and self.jobs.get(job.flight_key) is job:
+                del self.jobs[job.flight_key]
+            followers, job.followers = job.followers, []
+            return followers
@@ -0,0 +1,103 @@
+import collections
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+from PIL import Image
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(level=logging.DEBUG)
+
+sout_h = logging.StreamHandler()
+sout_h.setLevel(level=logging.DEBUG)
+LOGGER.addHandler(sout_h)
+
+
+class InputCache:
+    """ Decoded and resized img2img inputs on disk, key is built from file_unique_id.
+        Least recently used files are removed when total size exceeds max_bytes """
+    __slots__ = ('path', 'max_bytes', 'files', 'total', 'lock')
+
+    def __init__(self, path:pathlib.Path, max_bytes:int) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.files = collections.OrderedDict()  # key -> size
+        self.total = 0
+        self.lock = threading.Lock()
+        if max_bytes > 0:
+            self.path.mkdir(parents=True, exist_ok=True)
+            self.__scan()
+
+    def __scan(self):
+        # left by interrupted writes
+        for file in self.path.glob('*.tmp'):
+            try:
+                os.remove(file)
+            except OSError as e:
+                LOGGER.warning("Cant remove %s - %s", file, e)
+        entries = []
+        for file in self.path.glob('*.png'):
+            stat = file.stat()
+            entries.append((stat.st_mtime, file.stem, stat.st_size))
+        for _, key, size in sorted(entries):
+            self.files[key] = size
+            self.total += size
+        self.__evict()
+
+    def __file(self, key:str) -> pathlib.Path:
+        return pathlib.Path(self.path, key + '.png')
+
+    def __evict(self):
+        while self.total > self.max_bytes and self.files:
+            key, size = self.files.popitem(last=False)
+            self.total -= size
+            try:
+                os.remove(self.__file(key))
+            except OSError as e:
+                LOGGER.warning("Cant remove cached input %s - %s", key, e)
+
+    def get(self, key:str) -> Image.Image:
+        if self.max_bytes <= 0:
+            return None
+        with self.lock:
+            if key not in self.files:
+                return None
+            self.files.move_to_end(key)
+        file = self.__file(key)
+        try:
+            os.utime(file)
+            img = Image.open(file)
+            img.load()
+            return img
+        except Exception as e:
+            LOGGER.warning("Cant load cached input %s - %s", key, e)
+            return None
+
+    def put(self, key:str, img:Image.Image):
+        if self.max_bytes <= 0:
+            return
+        file = self.__file(key)
+        tmp = None
+        try:
+            # own temporary file of each writer, the same input may be saved by two jobs at once
+            with tempfile.NamedTemporaryFile(dir=self.path, prefix=key, suffix='.tmp', delete=False) as f:
+                tmp = f.name
+                # fast compression, cache is about decode and resize time
+                img.save(f, format='png', compress_level=1)
+            size = os.path.getsize(tmp)
+            os.replace(tmp, file)
+        except Exception as e:
+            LOGGER.warning("Cant save cached input %s - %s", key, e)
+            if tmp:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+            return
+
+        with self.lock:
+            self.total -= self.files.pop(key, 0)
+            self.files[key] = size
+            self.total += size
+            self.__evict()
@@ -0,0 +1,188 @@
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(level=logging.DEBUG)
+
+sout_h = logging.StreamHandler()
+sout_h.setLevel(level=logging.DEBUG)
+LOGGER.addHandler(sout_h)
+
+# writes of this interval go to one transaction
+COMMIT_INTERVAL = 0.05
+# handled update ids kept per bot for replay detection
+UPDATES_KEEP = 10000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    bot_id TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    state TEXT NOT NULL,
+    message TEXT NOT NULL,
+    waiting TEXT,
+    params TEXT NOT NULL,
+    batch_key TEXT,
+    cache_key TEXT,
+    created REAL NOT NULL,
+    PRIMARY KEY (bot_id, chat_id, message_id)
+);
+CREATE TABLE IF NOT EXISTS updates (
+    bot_id TEXT NOT NULL,
+    update_id INTEGER NOT NULL,
+    PRIMARY KEY (bot_id, update_id)
+);
+"""
+
+
+class JournalJob:
+    """ Unfinished job read from journal, message and waiting are raw telegram json """
+    __slots__ = ('chat_id', 'message_id', 'kind', 'state', 'message', 'waiting', 'params', 'batch_key', 'cache_key', 'created')
+
+    def __init__(self, row:tuple) -> None:
+        self.chat_id, self.message_id, self.kind, self.state = row[:4]
+        self.message = json.loads(row[4])
+        self.waiting = json.loads(row[5]) if row[5] else None
+        self.params = json.loads(row[6])
+        self.batch_key = tuple(json.loads(row[7])) if row[7] else None
+        self.cache_key = row[8]
+        self.created = row[9]
+
+
+class JobJournal:
+    """ Queued and running jobs in sqlite, unfinished ones are resumed after webui restart.
+        Callers only enqueue writes, one writer thread commits them in batches """
+    __slots__ = ('path', 'conn', 'lock', 'writes', 'writer', 'seen', 'seen_lock')
+
+    def __init__(self, path:str) -> None:
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # WAL with NORMAL sync survives process crash, last commits may be lost on power loss
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.writes = queue.SimpleQueue()
+        self.seen = {}  # bot_id -> set of handled update ids
+        self.seen_lock = threading.Lock()
+        self.writer = threading.Thread(target=self.__write, name='tg_journal')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def __write(self):
+        while True:
+            batch = [self.writes.get()]
+            deadline = time.monotonic() + COMMIT_INTERVAL
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.writes.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            flushed = [op for op in batch if isinstance(op, threading.Event)]
+            try:
+                with self.lock:
+                    self.conn.execute('BEGIN')
+                    for op in batch:
+                        if not isinstance(op, threading.Event):
+                            self.conn.execute(*op)
+                    self.conn.execute('COMMIT')
+            except Exception as e:
+                LOGGER.warning("Job journal write error - %s", e)
+                try:
+                    with self.lock:
+                        self.conn.execute('ROLLBACK')
+                except sqlite3.Error:
+                    pass
+            for event in flushed:
+                event.set()
+
+    def flush(self, timeout:float=None) -> bool:
+        """ Wait until enqueued writes are committed """
+        event = threading.Event()
+        self.writes.put(event)
+        return event.wait(timeout)
+
+    @staticmethod
+    def __dumps(value) -> str:
+        return None if value is None else json.dumps(value)
+
+    def add(self, bot_id:str, job):
+        """ job - GenJob, message json is stored to build job again """
+        self.writes.put((
+            'INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (bot_id, job.chat_id, job.message.message_id, job.kind, 'queued',
+             json.dumps(job.message.json), self.__dumps(job.waiting.json if job.waiting else None),
+             json.dumps(job.params), self.__dumps(job.batch_key), job.cache_key, job.enqueued)))
+
+    def set_waiting(self, bot_id:str, job):
+        self.writes.put((
+            'UPDATE jobs SET waiting = ? WHERE bot_id = ? AND chat_id = ? AND message_id = ?',
+            (json.dumps(job.waiting.json), bot_id, job.chat_id, job.message.message_id)))
+
+    def set_state(self, bot_id:str, job, state:str):
+        self.writes.put((
+            'UPDATE jobs SET state = ? WHERE bot_id = ? AND chat_id = ? AND message_id = ?',
+            (state, bot_id, job.chat_id, job.message.message_id)))
+
+    def remove(self, bot_id:str, job):
+        """ Job finished, result or error was sent """
+        self.writes.put((
+            'DELETE FROM jobs WHERE bot_id = ? AND chat_id = ? AND message_id = ?',
+            (bot_id, job.chat_id, job.message.message_id)))
+
+    def pending(self, bot_id:str) -> list:
+        """ Unfinished jobs of bot in enqueue order """
+        self.flush()
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT chat_id, message_id, kind, state, message, waiting, params, batch_key, cache_key, created '
+                'FROM jobs WHERE bot_id = ? ORDER BY created', (bot_id,)).fetchall()
+        jobs = []
+        for row in rows:
+            try:
+                jobs.append(JournalJob(row))
+            except Exception as e:
+                LOGGER.warning("Skip broken journal job %s:%s - %s", row[0], row[1], e)
+        return jobs
+
+    def __seen(self, bot_id:str) -> set:
+        """ Call with seen_lock """
+        seen = self.seen.get(bot_id)
+        if seen is None:
+            with self.lock:
+                rows = self.conn.execute(
+                    'SELECT update_id FROM updates WHERE bot_id = ? ORDER BY update_id DESC LIMIT ?',
+                    (bot_id, UPDATES_KEEP)).fetchall()
+            seen = self.seen[bot_id] = {row[0] for row in rows}
+        return seen
+
+    def last_update_id(self, bot_id:str) -> int:
+        """ Last handled update, polling continues after it """
+        with self.seen_lock:
+            seen = self.__seen(bot_id)
+            return max(seen) if seen else 0
+
+    def new_update(self, bot_id:str, update_id:int) -> bool:
+        """ Record update as handled, False if it already was - replayed by telegram """
+        with self.seen_lock:
+            seen = self.__seen(bot_id)
+            if update_id in seen:
+                return False
+            seen.add(update_id)
+            if len(seen) > UPDATES_KEEP * 2:
+                # old ids can't be replayed anymore
+                keep = sorted(seen)[-UPDATES_KEEP:]
+                seen.intersection_update(keep)
+                self.writes.put((
+                    'DELETE FROM updates WHERE bot_id = ? AND update_id < ?', (bot_id, keep[0])))
+        self.writes.put(('INSERT OR IGNORE INTO updates VALUES (?, ?)', (bot_id, update_id)))
+        return True
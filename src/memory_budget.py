@@ -0,0 +1,48 @@
+import threading
+
+
+class MemoryBudget:
+    """ Bytes of img2img inputs being downloaded and decoded at once. Pre-processing threads
+        wait until their input fits, one input is admitted anyway when nothing else is held,
+        so an input larger than the budget is delayed but not stuck. max_bytes 0 - no limit.
+        growing - bytes held by threads waiting in grow """
+    __slots__ = ('max_bytes', 'used', 'growing', 'cond')
+
+    def __init__(self, max_bytes:int) -> None:
+        self.max_bytes = max(max_bytes, 0)
+        self.used = 0
+        self.growing = 0
+        self.cond = threading.Condition()
+
+    def configure(self, max_bytes:int):
+        with self.cond:
+            self.max_bytes = max(max_bytes, 0)
+            self.cond.notify_all()
+
+    def acquire(self, size:int) -> int:
+        """ Blocks until size fits, returns size to release """
+        with self.cond:
+            while self.max_bytes and self.used and self.used + size > self.max_bytes:
+                self.cond.wait()
+            self.used += size
+            return size
+
+    def grow(self, held:int, size:int) -> int:
+        """ Blocks until held bytes can become size, returns size to release.
+            Held bytes stay counted while waiting. Holders waiting to grow don't wait
+            for each other - when they hold everything, one of them is admitted """
+        with self.cond:
+            self.growing += held
+            try:
+                while self.max_bytes and self.used > self.growing and self.used - held + size > self.max_bytes:
+                    self.cond.wait()
+            finally:
+                self.growing -= held
+            self.used += size - held
+            self.cond.notify_all()
+            return size
+
+    def release(self, size:int):
+        with self.cond:
+            self.used -= size
+            self.cond.notify_all()
@@ -0,0 +1,239 @@
+import bisect
+import contextlib
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(level=logging.DEBUG)
+
+sout_h = logging.StreamHandler()
+sout_h.setLevel(level=logging.DEBUG)
+LOGGER.addHandler(sout_h)
+
+# seconds, from telegram calls to full generations
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class Metric:
+    """ Values by label values tuple, rendered in Prometheus text format """
+    __slots__ = ('name', 'help', 'labelnames', 'values', 'lock')
+    type = 'untyped'
+
+    def __init__(self, name:str, help:str, labelnames:tuple=()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def labels_str(self, labels:tuple, extra:str='') -> str:
+        pairs = [f'{k}="{escape(v)}"' for k, v in zip(self.labelnames, labels)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def samples(self) -> list:
+        with self.lock:
+            return [(self.name + self.labels_str(labels), value) for labels, value in self.values.items()]
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        lines += [f'{name} {value}' for name, value in self.samples()]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    __slots__ = ()
+    type = 'counter'
+
+    def inc(self, *labels, value:float=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+
+class Gauge(Metric):
+    __slots__ = ()
+    type = 'gauge'
+
+    def set(self, value:float, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def inc(self, *labels, value:float=1) -> float:
+        with self.lock:
+            value = self.values[labels] = self.values.get(labels, 0) + value
+            return value
+
+    def dec(self, *labels, value:float=1) -> float:
+        return self.inc(*labels, value=-value)
+
+    def remove(self, *labels):
+        """ Drop series, for labels like chat id which come and go """
+        with self.lock:
+            self.values.pop(labels, None)
+
+
+class Histogram(Metric):
+    __slots__ = ('buckets',)
+    type = 'histogram'
+
+    def __init__(self, name:str, help:str, labelnames:tuple=(), buckets:tuple=BUCKETS) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value:float, *labels):
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                # per bucket counts, sum, count
+                state = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self) -> list:
+        result = []
+        with self.lock:
+            for labels, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    result.append((self.name + '_bucket' + self.labels_str(labels, f'le="{bound}"'), cumulative))
+                result.append((self.name + '_bucket' + self.labels_str(labels, 'le="+Inf"'), count))
+                result.append((self.name + '_sum' + self.labels_str(labels), total))
+                result.append((self.name + '_count' + self.labels_str(labels), count))
+        return result
+
+
+class Registry:
+    __slots__ = ('metrics',)
+
+    def __init__(self) -> None:
+        self.metrics = []
+
+    def add(self, metric:Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return '\n'.join(m.render() for m in self.metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+# stages: receipt (telegram message date to handler), download, decode, queue_wait,
+# sampling, encode, upload, draft (enqueue to draft sent)
+STAGE_SECONDS = REGISTRY.add(Histogram(
+    'tgbot_stage_seconds', 'Duration of request processing stages', ('stage',)))
+QUEUE_DEPTH = REGISTRY.add(Gauge(
+    'tgbot_queue_depth', 'Generation jobs waiting in scheduler'))
+CHAT_JOBS = REGISTRY.add(Gauge(
+    'tgbot_chat_jobs', 'Queued and running generation jobs of chat', ('chat_id',)))
+BATCH_SIZE = REGISTRY.add(Histogram(
+    'tgbot_batch_size', 'Jobs generated in one batch', buckets=(1, 2, 4, 8, 16)))
+API_SECONDS = REGISTRY.add(Histogram(
+    'tgbot_api_seconds', 'Telegram API call latency', ('method',)))
+API_ERRORS = REGISTRY.add(Counter(
+    'tgbot_api_errors_total', 'Failed Telegram API calls', ('method', 'code')))
+API_FLOOD = REGISTRY.add(Counter(
+    'tgbot_api_flood_total', 'Telegram API calls rejected with 429', ('method',)))
+API_PENDING = REGISTRY.add(Gauge(
+    'tgbot_api_pending', 'Telegram API calls waiting in outbound queue'))
+JOBS_REJECTED = REGISTRY.add(Counter(
+    'tgbot_jobs_rejected_total', 'Requests rejected because predicted wait was over limit'))
+JOBS_COALESCED = REGISTRY.add(Counter(
+    'tgbot_jobs_coalesced_total', 'Requests answered with result of equal queued or running job'))
+BACKEND_HEALTHY = REGISTRY.add(Gauge(
+    'tgbot_backend_healthy', 'Generation backend takes jobs', ('backend',)))
+BACKEND_SECONDS = REGISTRY.add(Histogram(
+    'tgbot_backend_seconds', 'Batch generation time on backend', ('backend',)))
+# result: hit - batch ran on loaded checkpoint, switch - checkpoint was loaded for it
+MODEL_BATCHES = REGISTRY.add(Counter(
+    'tgbot_model_batches_total', 'Batches by checkpoint state of backend', ('backend', 'result')))
+MODEL_SWITCH_SECONDS = REGISTRY.add(Histogram(
+    'tgbot_model_switch_seconds', 'Checkpoint load time on backend', ('backend',)))
+
+
+class MetricsServer:
+    """ Serves registry in Prometheus text format on GET /metrics """
+    __slots__ = ('server', 'thread')
+
+    def __init__(self, host:str, port:int, registry:Registry=REGISTRY) -> None:
+        self.server = ThreadingHTTPServer((host, port), self.__handler_class(registry))
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @staticmethod
+    def __handler_class(registry:Registry):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        LOGGER.info("Metrics server listening on %s:%s", *self.server.server_address[:2])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread:
+            self.thread.join()
+
+
+server = None
+server_address = None
+server_lock = threading.Lock()
+
+
+def serve(host:str, port:int):
+    """ Start, move or stop (port 0) metrics server, survives bot restarts """
+    global server
+    global server_address
+    with server_lock:
+        if server and server_address == (host, port):
+            return
+        if server:
+            server.stop()
+            server = None
+        server_address = (host, port)
+        if not port:
+            return
+        try:
+            server = MetricsServer(host, port)
+            server.start()
+        except OSError as e:
+            LOGGER.warning("Cant start metrics server on %s:%s - %s", host, port, e)
+            server = None
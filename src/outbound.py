@@ -0,0 +1,401 @@
+import asyncio
+import concurrent.futures
+import itertools
+import logging
+import threading
+import time
+from src import metrics, tracing
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(level=logging.DEBUG)
+
+sout_h = logging.StreamHandler()
+sout_h.setLevel(level=logging.DEBUG)
+LOGGER.addHandler(sout_h)
+
+# lower is sent first
+PRIORITY_RESULT = 0
+PRIORITY_NORMAL = 1
+PRIORITY_PROGRESS = 2
+
+MAX_RETRIES = 5
+# seconds between removals of idle chat buckets
+SWEEP_INTERVAL = 60
+
+
+def log_error(future:concurrent.futures.Future):
+    """ Done callback for requests nobody waits for """
+    if not future.cancelled() and future.exception():
+        LOGGER.warning("Telegram API error - %s", future.exception())
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'paused_until')
+
+    def __init__(self, rate:float, capacity:float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def wait_time(self, now:float) -> float:
+        """ Seconds until one token is available """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def idle(self, now:float) -> bool:
+        """ Full and not paused, same as a new bucket """
+        self.wait_time(now)
+        return self.tokens >= self.capacity and now >= self.paused_until
+
+    def pause(self, now:float, seconds:float):
+        self.paused_until = max(self.paused_until, now + seconds)
+
+
+class OutboundRequest:
+    """ traces - of jobs active when the call was queued, they get its span.
+        skip - True when the call is no longer needed, asked right before sending """
+    __slots__ = ('chat_id', 'call', 'method', 'priority', 'key', 'seq', 'future', 'retries', 'traces', 'submitted',
+                 'skip')
+
+    def __init__(self, chat_id, call, method:str, priority:int, key, seq:int, skip=None) -> None:
+        self.chat_id = chat_id
+        self.call = call
+        self.skip = skip
+        self.method = method
+        self.priority = priority
+        self.key = key
+        self.seq = seq
+        self.future = concurrent.futures.Future()
+        self.retries = 0
+        self.traces = tracing.current()
+        self.submitted = time.time()
+
+
+class OutboundQueue:
+    """ Rate limited Telegram API calls.
+        Token buckets per chat and global, 429 retry_after is honoured,
+        pending request with same key is replaced by newer one """
+    __slots__ = ('global_bucket', 'chat_rate', 'buckets', 'pending', 'keys', 'inflight', 'executing', 'swept', 'seq',
+                 'cond', 'running', 'pool', 'dispatcher')
+
+    def __init__(self, global_rate:float, chat_rate:float, workers:int=8) -> None:
+        self.global_bucket = TokenBucket(global_rate, max(global_rate, 1))
+        self.chat_rate = chat_rate
+        self.buckets = {}  # chat_id -> TokenBucket
+        self.pending = []  # OutboundRequest
+        self.keys = {}     # key -> pending OutboundRequest
+        self.inflight = set()  # keys of executing requests, same key is never sent concurrently
+        self.executing = 0     # all executing requests, flush waits for them
+        self.swept = time.monotonic()
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.running = False
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tg_outbound')
+        self.dispatcher = None
+
+    def submit(self, chat_id, call, priority:int=PRIORITY_NORMAL, key=None, method:str='other',
+               skip=None) -> concurrent.futures.Future:
+        """ Queue blocking API call. If request with same key is pending,
+            it is dropped (its future gets None), unless it has higher priority
+            - then the new one is dropped.
+            method - API method name for metrics.
+            skip - predicate, request is dropped the same way if it is True when its turn comes """
+        with self.cond:
+            req = OutboundRequest(chat_id, call, method, priority, key, next(self.seq), skip)
+            if key is not None:
+                old = self.keys.get(key)
+                if old and old.priority < priority:
+                    req.future.set_result(None)
+                    return req.future
+                if old:
+                    del self.keys[key]
+                    self.pending.remove(old)
+                    old.future.set_result(None)
+                self.keys[key] = req
+            self.pending.append(req)
+            metrics.API_PENDING.set(len(self.pending))
+            self.notify()
+        return req.future
+
+    def __bucket(self, chat_id) -> TokenBucket:
+        bucket = self.buckets.get(chat_id)
+        if not bucket:
+            # small burst, telegram allows ~1 msg/s per chat on average
+            bucket = self.buckets[chat_id] = TokenBucket(self.chat_rate, 3)
+        return bucket
+
+    def __next(self):
+        """ Returns (request, 0) or (None, seconds to wait) """
+        now = time.monotonic()
+        global_wait = self.global_bucket.wait_time(now)
+        if global_wait > 0:
+            return None, global_wait
+
+        best = None
+        wait = None
+        for req in self.pending:
+            if req.key is not None and req.key in self.inflight:
+                continue
+            chat_wait = self.__bucket(req.chat_id).wait_time(now)
+            if chat_wait > 0:
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+                continue
+            if best is None or (req.priority, req.seq) < (best.priority, best.seq):
+                best = req
+
+        if best is None:
+            return None, wait
+        return best, 0
+
+    def next_request(self):
+        """ Call with cond. Takes request to send now from queue, (None, seconds to wait) if none """
+        while True:
+            req, wait = self.__next()
+            if req is None:
+                return None, wait
+            self.pending.remove(req)
+            metrics.API_PENDING.set(len(self.pending))
+            if req.key is not None and self.keys.get(req.key) is req:
+                del self.keys[req.key]
+            if not self.skipped(req):
+                break
+        if req.key is not None:
+            self.inflight.add(req.key)
+        self.executing += 1
+        self.global_bucket.take()
+        self.__bucket(req.chat_id).take()
+        self.__sweep()
+        return req, 0
+
+    def __sweep(self):
+        """ Buckets of chats that went quiet are dropped, new one is the same """
+        now = time.monotonic()
+        if now - self.swept < SWEEP_INTERVAL:
+            return
+        self.swept = now
+        for chat_id in [chat_id for chat_id, bucket in self.buckets.items() if bucket.idle(now)]:
+            del self.buckets[chat_id]
+
+    def notify(self):
+        """ Call with cond. Queue changed, dispatcher looks again """
+        self.cond.notify_all()
+
+    @staticmethod
+    def skipped(req:OutboundRequest) -> bool:
+        """ Request isn't needed anymore, its future gets None """
+        try:
+            skip = req.skip is not None and req.skip()
+        except Exception as e:
+            LOGGER.warning("Telegram request skip check error - %s", e)
+            skip = False
+        if skip:
+            req.future.set_result(None)
+        return skip
+
+    def __dispatch(self):
+        while True:
+            with self.cond:
+                while True:
+                    if not self.running:
+                        return
+                    req, wait = self.next_request()
+                    if req:
+                        break
+                    self.cond.wait(wait)
+
+            self.pool.submit(self.__execute, req)
+
+    def __execute(self, req:OutboundRequest):
+        # state may change while the request waits for a pool thread
+        if self.skipped(req):
+            self.done(req)
+            return
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            result = req.call()
+        except Exception as e:
+            self.failed(req, started, time.perf_counter() - start, e)
+            return
+        self.succeeded(req, started, time.perf_counter() - start, result)
+
+    def succeeded(self, req:OutboundRequest, started:float, seconds:float, result):
+        metrics.API_SECONDS.observe(seconds, req.method)
+        self.__trace(req, started, seconds)
+        self.done(req)
+        req.future.set_result(result)
+
+    def failed(self, req:OutboundRequest, started:float, seconds:float, e:Exception):
+        """ Error of call, flood limit errors are sent again """
+        metrics.API_SECONDS.observe(seconds, req.method)
+        self.__trace(req, started, seconds, getattr(e, 'error_code', None) or type(e).__name__)
+        metrics.API_ERRORS.inc(req.method, getattr(e, 'error_code', None) or type(e).__name__)
+        retry_after = self.__retry_after(e)
+        if retry_after is not None:
+            metrics.API_FLOOD.inc(req.method)
+        if retry_after is None or req.retries >= MAX_RETRIES:
+            self.done(req)
+            req.future.set_exception(e)
+            return
+
+        LOGGER.warning("Telegram flood limit for chat %s, retry after %ss", req.chat_id, retry_after)
+        self.__retry(req, retry_after)
+
+    @staticmethod
+    def __trace(req:OutboundRequest, started:float, seconds:float, error=None):
+        """ queued - time in queue including rate limit waits """
+        if not req.traces:
+            return
+        attrs = {'method': req.method, 'queued': round(started - req.submitted, 4)}
+        if req.retries:
+            attrs['retries'] = req.retries
+        if error is not None:
+            attrs['error'] = error
+        tracing.record('api', started, seconds, req.traces, **attrs)
+
+    def done(self, req:OutboundRequest):
+        """ Request isn't executing anymore """
+        with self.cond:
+            self.inflight.discard(req.key)
+            self.executing -= 1
+            self.notify()
+
+    def __retry(self, req:OutboundRequest, retry_after:float):
+        with self.cond:
+            self.inflight.discard(req.key)
+            self.executing -= 1
+            req.retries += 1
+            self.__bucket(req.chat_id).pause(time.monotonic(), retry_after)
+            newer = self.keys.get(req.key) if req.key is not None else None
+            if newer and newer.priority <= req.priority:
+                # superseded while waiting
+                req.future.set_result(None)
+                self.notify()
+                return
+            if newer:
+                self.pending.remove(newer)
+                newer.future.set_result(None)
+            if req.key is not None:
+                self.keys[req.key] = req
+            self.pending.append(req)
+            self.notify()
+
+    @staticmethod
+    def __retry_after(e:Exception):
+        if getattr(e, 'error_code', None) != 429:
+            return None
+        try:
+            return float(e.result_json['parameters']['retry_after'])
+        except Exception:
+            return 1.0
+
+    def configure(self, global_rate:float, chat_rate:float):
+        """ Change rates of running queue """
+        with self.cond:
+            self.global_bucket.rate = global_rate
+            self.global_bucket.capacity = max(global_rate, 1)
+            self.chat_rate = chat_rate
+            for bucket in self.buckets.values():
+                bucket.rate = chat_rate
+            self.notify()
+
+    def flush(self, timeout:float):
+        """ Wait until queued and executing requests are done, False on timeout """
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.running and (self.pending or self.executing):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def start(self):
+        with self.cond:
+            if self.running:
+                return
+            self.running = True
+        self.dispatcher = threading.Thread(target=self.__dispatch, name='tg_dispatch')
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            for req in self.pending:
+                req.future.cancel()
+            self.pending = []
+            self.keys = {}
+            self.inflight = set()
+            self.notify()
+        self.pool.shutdown(wait=False)
+
+
+class AsyncOutboundQueue(OutboundQueue):
+    """ Same limits for coroutine API calls: dispatcher is a task of the loop and calls
+        are awaited there concurrently, no thread waits for them.
+        call of submit returns coroutine, submit is thread safe """
+    __slots__ = ('loop', 'wakeup', 'tasks')
+
+    def __init__(self, global_rate:float, chat_rate:float, loop:asyncio.AbstractEventLoop) -> None:
+        super().__init__(global_rate, chat_rate, workers=1)
+        self.loop = loop
+        self.wakeup = None
+        self.tasks = set()
+
+    def notify(self):
+        super().notify()
+        if self.wakeup is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    async def __dispatch(self):
+        self.wakeup = asyncio.Event()
+        while True:
+            self.wakeup.clear()
+            with self.cond:
+                if not self.running:
+                    return
+                req, wait = self.next_request()
+            if req is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = self.loop.create_task(self.__execute(req))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def __execute(self, req:OutboundRequest):
+        if self.skipped(req):
+            self.done(req)
+            return
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            result = await req.call()
+        except Exception as e:
+            self.failed(req, started, time.perf_counter() - start, e)
+            return
+        self.succeeded(req, started, time.perf_counter() - start, result)
+
+    def start(self):
+        """ Dispatcher starts when the loop runs """
+        with self.cond:
+            if self.running:
+                return
+            self.running = True
+        self.loop.call_soon_threadsafe(self.__start_dispatch)
+
+    def __start_dispatch(self):
+        self.dispatcher = self.loop.create_task(self.__dispatch())
@@ -0,0 +1,87 @@
+import collections
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(level=logging.DEBUG)
+
+sout_h = logging.StreamHandler()
+sout_h.setLevel(level=logging.DEBUG)
+LOGGER.addHandler(sout_h)
+
+# threads of the bot: own workers and telebot polling/handler threads
+THREAD_PREFIXES = ('tg_', 'WorkerThread', 'PollingThread')
+INTERVAL = 0.01
+MAX_SECONDS = 300
+# tg_outbound_3, WorkerThread2
+POOL_NUMBER = re.compile(r'(_\d+|(?<=WorkerThread)\d+)$')
+
+capture_lock = threading.Lock()
+
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+
+def sample(seconds:float, interval:float=INTERVAL, prefixes:tuple=THREAD_PREFIXES) -> collections.Counter:
+    """ Stacks of bot threads sampled every interval, collapsed format:
+        'thread;outer frame;...;inner frame' -> samples. Runs in caller thread.
+        Unlike cProfile it needs no hooks in already running threads, they only share GIL with sampler """
+    stacks = collections.Counter()
+    me = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {th.ident: th.name for th in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            name = names.get(ident, '')
+            if ident == me or not name.startswith(prefixes):
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(frame_name(frame))
+                frame = frame.f_back
+            # numbered pool threads are one group
+            stacks[';'.join([POOL_NUMBER.sub('', name)] + frames[::-1])] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def summary(stacks:collections.Counter, top:int=15) -> str:
+    """ Samples per thread and functions with most own samples, for chat """
+    total = sum(stacks.values())
+    if not total:
+        return 'No samples of bot threads'
+    threads = collections.Counter()
+    own = collections.Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(';')
+        threads[frames[0]] += count
+        own[frames[-1]] += count
+    lines = [f'{total} samples']
+    lines += [f'{count * 100 / total:5.1f}% {name}' for name, count in threads.most_common()]
+    lines.append('')
+    lines += [f'{count * 100 / total:5.1f}% {name}' for name, count in own.most_common(top)]
+    return '\n'.join(lines)
+
+
+def capture(seconds:float, path:str) -> str:
+    """ Sample bot threads for seconds, write collapsed stacks to path
+        (flamegraph.pl / speedscope input) and return summary.
+        None if other capture is running """
+    if not capture_lock.acquire(blocking=False):
+        return None
+    try:
+        seconds = min(max(seconds, 1), MAX_SECONDS)
+        LOGGER.info("Profiling bot threads for %ss", seconds)
+        stacks = sample(seconds)
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        return summary(stacks)
+    finally:
+        capture_lock.release()
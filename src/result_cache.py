@@ -0,0 +1,80 @@
+import collections
+import json
+import logging
+import os
+import threading
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(level=logging.DEBUG)
+
+sout_h = logging.StreamHandler()
+sout_h.setLevel(level=logging.DEBUG)
+LOGGER.addHandler(sout_h)
+
+
+class ResultCache:
+    """ LRU of generated results: cache key -> (telegram file_id, generation comment).
+        A hit is answered by resending the already uploaded photo,
+        file_id is valid for the bot that uploaded it only """
+    __slots__ = ('max_items', 'path', 'items', 'lock')
+
+    def __init__(self, max_items:int, path:str=None) -> None:
+        self.max_items = max_items
+        self.path = path
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        if path:
+            self.__load()
+
+    def __load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for key, value in json.load(f):
+                    self.items[key] = tuple(value)
+            self.__evict()
+            LOGGER.debug(f'Loaded {len(self.items)} cached results')
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            LOGGER.warning("Cant load results cache %s - %s", self.path, e)
+
+    def __save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(list(self.items.items()), f)
+        os.replace(tmp, self.path)
+
+    def __evict(self):
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+    def get(self, key:str) -> tuple:
+        if not key or self.max_items <= 0:
+            return None
+        with self.lock:
+            value = self.items.get(key)
+            if value:
+                self.items.move_to_end(key)
+            return value
+
+    def remove(self, key:str):
+        """ Cached file_id was rejected by Telegram """
+        with self.lock:
+            if self.items.pop(key, None) and self.path:
+                try:
+                    self.__save()
+                except Exception as e:
+                    LOGGER.warning("Cant save results cache %s - %s", self.path, e)
+
+    def put(self, key:str, file_id:str, comment:str):
+        if not key or self.max_items <= 0:
+            return
+        with self.lock:
+            self.items[key] = (file_id, comment)
+            self.items.move_to_end(key)
+            self.__evict()
+            if self.path:
+                try:
+                    self.__save()
+                except Exception as e:
+                    LOGGER.warning("Cant save results cache %s - %s", self.path, e)
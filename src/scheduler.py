@@ -0,0 +1,472 @@
+import collections
+import concurrent.futures
+import threading
+import logging
+import time
+from src import metrics, tracing
+from src.backends import BackendUnavailable, MAX_ATTEMPTS
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(level=logging.DEBUG)
+
+sout_h = logging.StreamHandler()
+sout_h.setLevel(level=logging.DEBUG)
+LOGGER.addHandler(sout_h)
+
+
+class GenJob:
+    """ Queued generation request of one chat.
+        run is called with list of jobs - the job itself
+        or batch of jobs with equal batch_key - and the backend running them.
+        prepare (optional) is called with the job in a pre-processing thread
+        shortly before the job runs, its future is stored in prepared.
+        input - img2img input images, one or album of images of one size.
+        settings - snapshot captured when the job was enqueued.
+        kind - generation type, used to bind run and prepare of handed over jobs.
+        attempts - runs failed by unavailable backends.
+        count - images of the job, batch size limits images, not jobs.
+        draft_of - for quick low quality preview, the full job it previews;
+        drafts of all chats run before full jobs.
+        delivered - result or error was handed to telegram, later drafts and progress are not shown.
+        model - checkpoint chosen by user, None - any loaded one.
+        checkpoint - title of checkpoint the job ran with, None if unknown.
+        trace - spans of the job, written to trace log when it is finished.
+        flight_key - equal requests coming while the job is queued or running become its
+        followers, (settings, message) pairs answered with its result.
+        waiting - placeholder message, queued job isn't taken until it is sent.
+        steps - delivery steps done, name -> result, they are not sent again.
+        owner - bot instance running the job, new one after handover """
+    __slots__ = ('chat_id', 'message', 'run', 'params', 'batch_key', 'waiting', 'image', 'cache_key',
+                 'prepare', 'prepared', 'input', 'enqueued', 'settings', 'kind', 'attempts', 'count',
+                 'draft_of', 'delivered', 'model', 'checkpoint', 'trace', 'flight_key', 'followers', 'steps', 'owner')
+
+    def __init__(self, chat_id, message, run, params:dict=None, batch_key=None) -> None:
+        self.chat_id = chat_id
+        self.message = message
+        self.run = run
+        self.params = params or {}
+        self.batch_key = batch_key
+        self.waiting = None
+        self.image = None
+        self.cache_key = None
+        self.prepare = None
+        self.prepared = None
+        self.input = None
+        self.enqueued = time.time()
+        self.settings = None
+        self.kind = None
+        self.attempts = 0
+        self.count = self.params.get('count', 1)
+        self.draft_of = None
+        self.delivered = False
+        self.model = self.params.get('model')
+        self.checkpoint = None
+        self.trace = tracing.Trace(tracing.job_id(chat_id, message), chat_id, getattr(message, 'date', None))
+        self.flight_key = None
+        self.followers = []
+        self.steps = {}
+        self.owner = None
+
+
+def images(jobs:list) -> int:
+    return sum(job.count for job in jobs)
+
+
+# with shortest-first order longer jobs are not skipped after waiting this long, seconds
+MAX_SKIPPED_WAIT = 120
+# queued jobs without placeholder are checked again after, seconds
+READY_POLL = 1
+
+
+class GenScheduler:
+    """ Worker per generation backend, jobs are taken round-robin by chat id
+        so one chat can't starve the others. With shortest_first the next job
+        is the first job of a chat with least predicted cost.
+        Drafts go before all full jobs in both orders.
+        Backend takes jobs for its loaded checkpoint first, so checkpoints switch less often;
+        a job for other checkpoint waits at most model_wait longer than jobs for loaded one """
+    __slots__ = ('queues', 'cond', 'running', 'backends', 'workers', 'current', 'started', 'batch_size', 'batch_window',
+                 'shortest_first', 'prepare_ahead', 'prepare_pool', 'model_wait')
+
+    def __init__(self, backends:list, batch_size:int=1, batch_window:float=0, prepare_ahead:int=2, shortest_first:bool=False,
+                 model_wait:float=0) -> None:
+        self.queues = collections.OrderedDict()  # chat_id -> deque[GenJob]
+        self.cond = threading.Condition()
+        self.running = False
+        self.backends = backends
+        self.workers = []
+        self.current = {}  # backend -> running batch
+        self.started = {}  # backend -> time running batch started
+        self.batch_size = max(batch_size, 1)
+        self.batch_window = batch_window
+        self.shortest_first = shortest_first
+        self.model_wait = model_wait
+        # download and decode of next jobs overlap with sampling of current
+        self.prepare_ahead = max(prepare_ahead, 0)
+        self.prepare_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(prepare_ahead, 1), thread_name_prefix='tg_prepare')
+
+    def __cost(self, jobs:list) -> float:
+        """ Predicted seconds of batch on the fastest healthy backend which learned it """
+        costs = [cost for cost in (b.cost.predict(jobs) for b in self.backends if b.healthy) if cost is not None]
+        return min(costs) if costs else None
+
+    def __order(self, extra:GenJob=None) -> list:
+        """ Queued jobs in order the worker will take them, extra - job not queued yet """
+        order = self.__chats_order(extra)
+        if any(job.draft_of for job in order):
+            return [job for job in order if job.draft_of] + [job for job in order if not job.draft_of]
+        return order
+
+    def __chats_order(self, extra:GenJob=None) -> list:
+        queues = [list(q) for q in self.queues.values()]
+        if extra is not None:
+            if extra.chat_id in self.queues:
+                queues[list(self.queues).index(extra.chat_id)].append(extra)
+            else:
+                queues.append([extra])
+        order = []
+        if self.shortest_first:
+            now = time.time()
+
+            def rank(index:int) -> tuple:
+                job = queues[index][0]
+                cost = self.__cost([job])
+                # long waiting first, then cheapest, then round-robin
+                return (now - job.enqueued < MAX_SKIPPED_WAIT, cost or 0, index)
+
+            while queues:
+                index = min(range(len(queues)), key=rank)
+                order.append(queues[index].pop(0))
+                if not queues[index]:
+                    del queues[index]
+            return order
+
+        depth = 0
+        while True:
+            layer = [q[depth] for q in queues if depth < len(q)]
+            if not layer:
+                return order
+            order.extend(layer)
+            depth += 1
+
+    def __pick(self, order:list, loaded:str) -> GenJob:
+        """ First job for loaded checkpoint, unless a job for other one waits model_wait longer
+            than the oldest job for loaded one. Relative to that job, not to now, so an overloaded
+            queue where all jobs wait long doesn't switch checkpoints on every batch """
+        ready = [job for job in order if not job.model or job.model == loaded]
+        if not ready:
+            return order[0]
+        oldest = min(job.enqueued for job in ready)
+        for job in order:
+            if job.model and job.model != loaded and oldest - job.enqueued >= self.model_wait:
+                return job
+        return ready[0]
+
+    @staticmethod
+    def __ready(job:GenJob) -> bool:
+        return job.waiting is not None
+
+    def __ready_count(self) -> int:
+        return sum(1 for q in self.queues.values() for job in q if self.__ready(job))
+
+    def __take(self, backend) -> GenJob:
+        drafts = models = pending = False
+        for q in self.queues.values():
+            for job in q:
+                drafts = drafts or job.draft_of is not None
+                models = models or job.model is not None
+                pending = pending or not self.__ready(job)
+        if self.shortest_first or drafts or models or pending:
+            order = [job for job in self.__order() if self.__ready(job)]
+            job = self.__pick(order, backend.loaded()) if models else order[0]
+            self.__remove(job)
+            if job.chat_id in self.queues:
+                self.queues.move_to_end(job.chat_id)
+            return job
+
+        chat_id, queue = next(iter(self.queues.items()))
+        job = queue.popleft()
+        if queue:
+            self.queues.move_to_end(chat_id)
+        else:
+            del self.queues[chat_id]
+        metrics.QUEUE_DEPTH.dec()
+        return job
+
+    def __remove(self, job:GenJob):
+        queue = self.queues[job.chat_id]
+        queue.remove(job)
+        if not queue:
+            del self.queues[job.chat_id]
+        metrics.QUEUE_DEPTH.dec()
+
+    def __requeue(self, jobs:list):
+        """ Put jobs of failed batch back to the front of their chat queues """
+        for job in reversed(jobs):
+            self.queues.setdefault(job.chat_id, collections.deque()).appendleft(job)
+            self.queues.move_to_end(job.chat_id, last=False)
+            metrics.QUEUE_DEPTH.inc()
+
+    def __preferred(self, backend) -> bool:
+        """ Queued jobs go to idle healthy backends, fastest first.
+            Not measured backends count as fastest, so they get measured """
+        faster = 0
+        for other in self.backends:
+            if other is backend or not other.healthy or other in self.current:
+                continue
+            if other.speed < backend.speed or (other.speed == backend.speed
+                                               and self.backends.index(other) < self.backends.index(backend)):
+                faster += 1
+        return self.__ready_count() > faster
+
+    @staticmethod
+    def __chat_done(job:GenJob):
+        if metrics.CHAT_JOBS.dec(job.chat_id) <= 0:
+            metrics.CHAT_JOBS.remove(job.chat_id)
+
+    def __collect(self, batch:list, limit:int):
+        """ Add queued jobs with same batch_key to batch up to limit images,
+            waits up to batch_window for new ones """
+        deadline = time.time() + self.batch_window
+        while True:
+            for job in self.__order():
+                if images(batch) >= limit:
+                    return
+                if job.batch_key == batch[0].batch_key and images(batch) + job.count <= limit and self.__ready(job):
+                    self.__remove(job)
+                    batch.append(job)
+
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self.running:
+                return
+            self.cond.wait(remaining)
+
+    def __prepare(self, jobs:list):
+        for job in jobs:
+            if job.draft_of:
+                # draft input is made from input of its full job, submitted first
+                self.__prepare([job.draft_of])
+            if job.prepare and not job.prepared:
+                job.prepared = self.prepare_pool.submit(tracing.wrap(job.prepare, [job.trace]), job)
+
+    def __prefetch(self):
+        # stopped scheduler only keeps queued jobs for handover, new instance prepares them
+        if self.prepare_ahead and self.running:
+            self.__prepare(self.__order()[:self.prepare_ahead])
+
+    def position(self, job:GenJob) -> int:
+        """ Position in queue the job would get (1 - next to run) """
+        with self.cond:
+            return self.__order(job).index(job) + 1
+
+    def predict_wait(self, job:GenJob) -> float:
+        """ Seconds until the job would be generated if queued now, None while no backend learned costs.
+            Queue is played on healthy backends with learned costs and batching. Backends not measured
+            yet are left out, so the wait is an upper bound until each one finished a batch """
+        with self.cond:
+            now = time.time()
+            free = {}     # backend -> seconds until idle
+            planned = {}  # backend -> last planned batch
+            models = {}   # backend -> checkpoint after planned batches
+            for backend in self.backends:
+                if not backend.healthy or not backend.cost.learned():
+                    continue
+                free[backend] = 0.0
+                batch = self.current.get(backend)
+                models[backend] = batch[0].model if batch and batch[0].model else backend.loaded()
+                if batch:
+                    cost = backend.cost.predict(batch)
+                    if cost is None:
+                        return None
+                    free[backend] = max(cost - (now - self.started[backend]), 0)
+            if not free:
+                return None
+
+            for queued in self.__order(job):
+                joined = None
+                if queued.batch_key is not None:
+                    for backend, batch in planned.items():
+                        limit = min(self.batch_size, backend.max_batch or self.batch_size)
+                        if batch[0].batch_key == queued.batch_key and images(batch) + queued.count <= limit:
+                            joined = backend
+                            break
+                if joined:
+                    batch = planned[joined]
+                    before = joined.cost.predict(batch)
+                    batch.append(queued)
+                    after = joined.cost.predict(batch)
+                    backend = joined
+                    cost = None if before is None or after is None else after - before
+                else:
+                    backend = min(free, key=free.get)
+                    planned[backend] = [queued]
+                    cost = backend.cost.predict([queued])
+                    if cost is not None and queued.model and queued.model != models[backend]:
+                        cost += backend.switch_seconds
+                        models[backend] = queued.model
+                if cost is None:
+                    return None
+                free[backend] += cost
+                if queued is job:
+                    return free[backend]
+
+    def remaining(self, backend) -> float:
+        """ Predicted seconds left of running batch, None when unknown or overdue """
+        with self.cond:
+            batch = self.current.get(backend)
+            if not batch:
+                return None
+            cost = backend.cost.predict(batch)
+            if cost is None:
+                return None
+            left = cost - (time.time() - self.started[backend])
+            return left if left > 0 else None
+
+    def submit(self, job:GenJob):
+        with self.cond:
+            self.queues.setdefault(job.chat_id, collections.deque()).append(job)
+            metrics.QUEUE_DEPTH.inc()
+            metrics.CHAT_JOBS.inc(job.chat_id)
+            self.__prefetch()
+            self.cond.notify_all()
+
+    def ready(self, job:GenJob):
+        """ Placeholder of queued job was sent """
+        with self.cond:
+            self.cond.notify_all()
+
+    def cancel(self, job:GenJob) -> bool:
+        """ Remove queued job, False if it isn't queued """
+        with self.cond:
+            queue = self.queues.get(job.chat_id)
+            if not queue or job not in queue:
+                return False
+            self.__remove(job)
+            self.__chat_done(job)
+            self.cond.notify_all()
+            return True
+
+    def configure(self, batch_size:int, batch_window:float, shortest_first:bool, model_wait:float):
+        with self.cond:
+            self.batch_size = max(batch_size, 1)
+            self.batch_window = batch_window
+            self.shortest_first = shortest_first
+            self.model_wait = model_wait
+
+    def detach(self) -> list:
+        """ Remove and return queued jobs in run order, used to hand them to new bot instance """
+        with self.cond:
+            jobs = self.__order()
+            self.queues.clear()
+            metrics.QUEUE_DEPTH.dec(value=len(jobs))
+            for job in jobs:
+                self.__chat_done(job)
+            return jobs
+
+    def active(self) -> list:
+        """ (backend, batch) pairs being generated now """
+        with self.cond:
+            return list(self.current.items())
+
+    def size(self) -> int:
+        with self.cond:
+            return sum(len(q) for q in self.queues.values())
+
+    def __probe(self, backend):
+        """ Unhealthy backend is asked again after its retry delay """
+        if backend.probe():
+            with self.cond:
+                backend.healthy = True
+                self.cond.notify_all()
+            LOGGER.info("Backend %s is back", backend.name)
+        else:
+            backend.failed('probe failed')
+
+    def __work(self, backend):
+        while True:
+            with self.cond:
+                while self.running and (not backend.healthy or not self.queues or not self.__preferred(backend)):
+                    if not backend.healthy:
+                        remaining = backend.retry_at - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.cond.wait(remaining)
+                    else:
+                        # handed over jobs get their placeholder from previous instance
+                        self.cond.wait(READY_POLL if self.queues else None)
+                if not self.running:
+                    return
+                if not backend.healthy:
+                    probe = True
+                else:
+                    probe = False
+                    job = self.__take(backend)
+                    batch = [job]
+                    limit = min(self.batch_size, backend.max_batch or self.batch_size)
+                    if job.batch_key is not None and job.count < limit:
+                        self.__collect(batch, limit)
+                    self.current[backend] = batch
+                    self.started[backend] = time.time()
+                    self.__prepare(batch)
+                    self.__prefetch()
+
+            if probe:
+                self.__probe(backend)
+                continue
+
+            # don't hold webui queue while inputs are downloading,
+            # run gets prepare errors from job.prepared
+            concurrent.futures.wait([j.prepared for j in batch if j.prepared])
+
+            now = time.time()
+            LOGGER.debug(f'Run {len(batch)} job(s) {", ".join(j.trace.job_id for j in batch)} on {backend.name}, waited {now - job.enqueued:.2f}s')
+            for j in batch:
+                tracing.observe('queue_wait', j.enqueued, now - j.enqueued, [j.trace], backend=backend.name, batch=len(batch))
+            metrics.BATCH_SIZE.observe(len(batch))
+            requeued = []
+            try:
+                with tracing.activate([j.trace for j in batch]):
+                    backend.run(job.run, batch)
+                backend.succeeded()
+            except BackendUnavailable as e:
+                backend.failed(e)
+                # jobs over the attempts limit are failed by run
+                requeued = [j for j in batch if j.attempts < MAX_ATTEMPTS]
+            except Exception as e:
+                LOGGER.exception("Job %s failed: %s", job.trace.job_id, e)
+            finally:
+                with self.cond:
+                    self.current.pop(backend, None)
+                    self.started.pop(backend, None)
+                    if requeued:
+                        self.__requeue(requeued)
+                    self.cond.notify_all()
+                for j in batch:
+                    if j not in requeued:
+                        self.__chat_done(j)
+
+    def start(self):
+        with self.cond:
+            if self.running:
+                return
+            self.running = True
+        for backend in self.backends:
+            worker = threading.Thread(target=self.__work, args=(backend,), name=f'tg_gen_{backend.name}')
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+    def join(self):
+        """ Wait for the running batches, then save what backends learned """
+        for worker in self.workers:
+            worker.join()
+        # late submits after stop don't prepare, pool isn't needed anymore
+        self.prepare_pool.shutdown(wait=False)
+        for backend in self.backends:
+            backend.save()
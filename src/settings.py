@@ -0,0 +1,76 @@
+import types
+
+
+class Settings:
+    """ Immutable snapshot of bot settings. Rebuilt by main.update_overrides,
+        jobs keep the snapshot they were created with """
+    __slots__ = ('version', 'conf', 'msgs', 'cmds', 'commands', 'auth_all', 'auth_chats', 'admin_chats',
+                 'negative_prompt', 'img2img_default_prompt', 'sampler', 'steps', 'cfg_scale',
+                 'width', 'height', 'denoising', 'seed', 'comment_send', 'controlnet')
+
+    def __init__(self, version:int, conf:dict, msgs_overrides:dict, cmds_overrides:dict) -> None:
+        """ conf - all telegram_bot_* options with defaults applied """
+        set_ = super().__setattr__
+        set_('version', version)
+        set_('conf', types.MappingProxyType(dict(conf)))
+
+        # templates resolved once, get_msg only formats
+        msgs = {}
+        for code, value in conf.items():
+            if isinstance(value, str):
+                msgs[code] = value
+        for code, value in (msgs_overrides or {}).items():
+            if value:
+                msgs[code] = str(value)
+        set_('msgs', types.MappingProxyType(msgs))
+
+        cmds = {}
+        for code, value in conf.items():
+            if isinstance(value, str):
+                cmds[code] = value
+        for code, value in (cmds_overrides or {}).items():
+            if value:
+                cmds[code] = value
+        set_('cmds', types.MappingProxyType(cmds))
+        set_('commands', frozenset(conf.get('telegram_bot_commands') or ()))
+
+        auth_chats = conf.get('telegram_bot_autorized_chats') or ''
+        set_('auth_all', auth_chats == 'ALL')
+        set_('auth_chats', frozenset(x.strip() for x in auth_chats.split(';') if x.strip()))
+        admin_chats = conf.get('telegram_bot_admin_chats') or ''
+        set_('admin_chats', frozenset(x.strip() for x in admin_chats.split(';') if x.strip()))
+
+        set_('negative_prompt', conf['telegram_bot_negative_prompt'])
+        set_('img2img_default_prompt', conf['telegram_bot_img2img_default_prompt'])
+        set_('sampler', conf['telegram_bot_sampler'])
+        set_('steps', int(conf['telegram_bot_steps']))
+        set_('cfg_scale', float(conf['telegram_bot_cfg_scale']))
+        set_('width', int(conf['telegram_bot_img_width']))
+        set_('height', int(conf['telegram_bot_img_height']))
+        set_('denoising', float(conf['telegram_bot_img2img_denoising']))
+        set_('seed', int(conf['telegram_bot_seed']))
+        set_('comment_send', bool(conf['telegram_bot_comment_send']))
+        set_('controlnet', bool(conf['telegram_bot_img2img_controlnet']))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Settings snapshot is immutable')
+
+    def get_conf(self, code:str):
+        return self.conf.get(code)
+
+    def get_msg(self, code:str, **kwargs) -> str:
+        """ Get message by code, format by kwargs """
+        strs = self.msgs.get(code)
+        if strs:
+            return str.format(strs, **kwargs)
+        return ''
+
+    def get_cmd(self, code:str):
+        return self.cmds.get(code)
+
+    def is_chat_authorized(self, chat_id) -> bool:
+        if self.auth_all: return True
+        return f'{chat_id}' in self.auth_chats
+
+    def is_chat_admin(self, chat_id) -> bool:
+        return f'{chat_id}' in self.admin_chats
@@ -0,0 +1,178 @@
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from src import metrics
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(level=logging.DEBUG)
+
+sout_h = logging.StreamHandler()
+sout_h.setLevel(level=logging.DEBUG)
+LOGGER.addHandler(sout_h)
+
+# traces of jobs the current thread or asyncio task works on
+active = contextvars.ContextVar('tg_traces', default=())
+
+
+def job_id(chat_id, message) -> str:
+    """ Id of job in logs and traces, <chat id>-<message id> of the request """
+    return f'{chat_id}-{getattr(message, "message_id", None)}'
+
+
+class Trace:
+    """ Timeline of one job: spans of its stages and Telegram API calls,
+        written as one JSON line when the job is finished.
+        start - unix time the request was sent by user """
+    __slots__ = ('job_id', 'chat_id', 'kind', 'start', 'spans', 'finished', 'lock')
+
+    def __init__(self, job_id:str, chat_id=None, start:float=None) -> None:
+        self.job_id = job_id
+        self.chat_id = chat_id
+        self.kind = None
+        self.start = start or time.time()
+        self.spans = []
+        self.finished = False
+        self.lock = threading.Lock()
+
+    def add(self, name:str, start:float, seconds:float, **attrs):
+        """ start - unix time, seconds - duration, 0 for events """
+        span = {'name': name, 'start': round(start, 4), 'seconds': round(seconds, 4)}
+        span.update(attrs)
+        with self.lock:
+            self.spans.append(span)
+
+    def finish(self, result:str) -> str:
+        """ JSON line of the trace, None if it was finished before """
+        now = time.time()
+        with self.lock:
+            if self.finished:
+                return None
+            self.finished = True
+            spans = sorted(self.spans, key=lambda span: span['start'])
+        return json.dumps({
+            'job': self.job_id,
+            'chat_id': self.chat_id,
+            'kind': self.kind,
+            'result': result,
+            'start': round(self.start, 4),
+            'seconds': round(now - self.start, 4),
+            'spans': spans,
+        }, default=str)
+
+
+def current() -> tuple:
+    return active.get()
+
+
+@contextlib.contextmanager
+def activate(traces):
+    """ Spans recorded in this thread or task go to traces of the jobs it works on """
+    token = active.set(tuple(traces))
+    try:
+        yield
+    finally:
+        active.reset(token)
+
+
+def wrap(fn, traces=None):
+    """ fn for other thread, records to traces active here or given ones """
+    traces = current() if traces is None else tuple(traces)
+    if not traces:
+        return fn
+
+    def run(*args, **kwargs):
+        with activate(traces):
+            return fn(*args, **kwargs)
+    return run
+
+
+def record(name:str, start:float, seconds:float, traces=None, **attrs):
+    for trace in current() if traces is None else traces:
+        trace.add(name, start, seconds, **attrs)
+
+
+def observe(name:str, start:float, seconds:float, traces=None, **attrs):
+    """ Stage duration metric and span in traces """
+    metrics.STAGE_SECONDS.observe(seconds, name)
+    record(name, start, seconds, traces, **attrs)
+
+
+@contextlib.contextmanager
+def span(name:str, **attrs):
+    """ Span of block in active traces, failed block gets error attribute """
+    traces = current()
+    start = time.time()
+    perf = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        attrs['error'] = type(e).__name__
+        raise
+    finally:
+        if traces:
+            record(name, start, time.perf_counter() - perf, traces, **attrs)
+
+
+@contextlib.contextmanager
+def stage(name:str, **attrs):
+    """ Like span, also observed as stage duration metric """
+    start = time.perf_counter()
+    try:
+        with span(name, **attrs):
+            yield
+    finally:
+        metrics.STAGE_SECONDS.observe(time.perf_counter() - start, name)
+
+
+class TraceLog:
+    """ Finished traces appended to JSONL file, rotated to <file>.1 above max_bytes """
+    __slots__ = ('path', 'max_bytes', 'lock')
+
+    def __init__(self, path:str, max_bytes:int) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def write(self, line:str):
+        with self.lock:
+            try:
+                if os.path.getsize(self.path) + len(line) > self.max_bytes:
+                    os.replace(self.path, self.path + '.1')
+            except FileNotFoundError:
+                pass
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+
+
+trace_log = None
+trace_log_lock = threading.Lock()
+
+
+def configure(path:str, max_bytes:int):
+    """ Start, move or stop (max_bytes 0) writing of finished traces """
+    global trace_log
+    with trace_log_lock:
+        if not max_bytes:
+            trace_log = None
+        elif trace_log and trace_log.path == path:
+            trace_log.max_bytes = max_bytes
+        else:
+            trace_log = TraceLog(path, max_bytes)
+
+
+def finish(trace:Trace, result:str):
+    """ Job is done - delivered, draft shown, failed or rejected """
+    log = trace_log
+    if log is None:
+        return
+    line = trace.finish(result)
+    if line is None:
+        return
+    try:
+        log.write(line)
+    except OSError as e:
+        LOGGER.warning("Cant write trace of job %s - %s", trace.job_id, e)
@@ -1,4 +1,8 @@
 import modules.shared as shared
+import json
+import pathlib
+import threading
+import random
 import time
 
 def get_eta() -> tuple: 
@@ -22,9 +26,131 @@ def get_eta() -> tuple:
     progress = min(progress, 1)
     return (progress, eta_relative)
 
+def get_arg_img(message):
+    """PhotoSize or Document of message or replied message"""
+    img = None
+    if message.photo: 
+        img = message.photo[-1]
+
+    if not img and message.document:
+        img = message.document
+    
+    if not img and message.reply_to_message:
+        msg_old = message.reply_to_message
+        
+        if msg_old.photo:
+            img = msg_old.photo[-1]
+
+        if not img and msg_old.document:
+            img = msg_old.document
+    return img
+
+def is_input_too_large(img, max_bytes:int, max_pixels:int) -> bool:
+    """PhotoSize or Document above limits known before download, 0 - no limit.
+    Documents have no pixel size until downloaded"""
+    if max_bytes and (img.file_size or 0) > max_bytes:
+        return True
+    pixels = (getattr(img, 'width', 0) or 0) * (getattr(img, 'height', 0) or 0)
+    return bool(max_pixels) and pixels > max_pixels
+
+def get_text(message) -> str:
+    """Text of message, photos have it in caption"""
+    return message.text or message.caption
+
+def get_album_id(message) -> str:
+    """media_group_id of message or replied message, None if not in album"""
+    if message.media_group_id:
+        return message.media_group_id
+    if message.reply_to_message:
+        return message.reply_to_message.media_group_id
+    return None
+
 def get_arg(msg_text:str) -> str:
     if msg_text:
         args = msg_text.split(" ", maxsplit=1)
         if len(args) == 2:
             return args[1]
     return None
+
+
+def split_model(prompt:str) -> tuple:
+    """(model, prompt) - leading checkpoint choice, /text2img --model anime a cat"""
+    if prompt and prompt.startswith('--model '):
+        args = prompt.split(" ", maxsplit=2)
+        return args[1], args[2] if len(args) == 3 else ''
+    return None, prompt
+
+
+def split_count(prompt:str, max_count:int) -> tuple:
+    """(count, prompt) - leading number of images, /text2img --count 4 a cat.
+    Only the option is a count, numbers in prompt (1girl 4, 2024) are prompt"""
+    if prompt and prompt.startswith('--count '):
+        args = prompt.split(" ", maxsplit=2)
+        if args[1].isdigit():
+            return min(max(int(args[1]), 1), max(max_count, 1)), args[2] if len(args) == 3 else ''
+    return 1, prompt
+
+
+def get_seed() -> int:
+    """Random seed, same range as webui uses for -1"""
+    return int(random.randrange(4294967294))
+
+def format_wait(seconds) -> str:
+    """Predicted wait for messages, '?' while unknown"""
+    if seconds is None:
+        return '?'
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f'{seconds}s'
+    return f'{seconds // 60}m {seconds % 60:02d}s'
+
+def split_caption(msg:str) -> tuple:
+    """(caption, text to send after) - photo caption is limited by 1024 chars"""
+    if len(msg) > 1024:
+        return msg[:1023], msg[1023:]
+    return msg, ''
+
+cache_dir = None
+
+def set_cache_dir(path):
+    """Cache in other place than <extension>/cache, None - default one. Bench uses temporary dir"""
+    global cache_dir
+    cache_dir = pathlib.Path(path) if path else None
+
+def get_cache_dir() -> pathlib.Path:
+    """<extension>/cache or set by set_cache_dir, created on demand"""
+    path = cache_dir or pathlib.Path(pathlib.Path(__file__).parent.parent, 'cache')
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+state_lock = threading.Lock()
+
+def bot_id(token:str) -> str:
+    """Bot id part of token, same for revoked and new token of one bot"""
+    return token.split(':')[0]
+
+def waiting_image_state_key(token:str) -> str:
+    """file_id is valid only for the bot which uploaded it"""
+    return 'waiting_image_id_' + bot_id(token)
+
+def load_state(key:str):
+    """Value saved by save_state, survives bot and webui restarts"""
+    with state_lock:
+        try:
+            with open(pathlib.Path(get_cache_dir(), 'state.json'), 'r', encoding='utf-8') as f:
+                return json.load(f).get(key)
+        except (FileNotFoundError, ValueError):
+            return None
+
+def save_state(key:str, value):
+    with state_lock:
+        file = pathlib.Path(get_cache_dir(), 'state.json')
+        try:
+            with open(file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            state = {}
+        state[key] = value
+        with open(file.with_suffix('.tmp'), 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        file.with_suffix('.tmp').replace(file)
@@ -0,0 +1,111 @@
+import hmac
+import json
+import queue
+import threading
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telebot import types
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(level=logging.DEBUG)
+
+sout_h = logging.StreamHandler()
+sout_h.setLevel(level=logging.DEBUG)
+LOGGER.addHandler(sout_h)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# larger request isn't read, updates are a few kilobytes
+MAX_BODY = 1024 * 1024
+
+
+class WebhookServer:
+    """ Receives updates from Telegram by HTTP POST,
+        passes them to bot handlers from a single dispatch thread """
+    __slots__ = ('process_updates', 'secret', 'updates', 'server', 'threads')
+
+    def __init__(self, process_updates, host:str, port:int, secret:str, queue_size:int) -> None:
+        """ process_updates - blocking callable receiving list of updates """
+        self.process_updates = process_updates
+        self.secret = secret
+        self.updates = queue.Queue(maxsize=max(queue_size, 1))
+        self.server = ThreadingHTTPServer((host, port), self.__handler_class())
+        self.server.daemon_threads = True
+        self.threads = []
+
+    def __handler_class(self):
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    status = 400
+                elif length > MAX_BODY:
+                    LOGGER.warning("Webhook request of %s bytes rejected", length)
+                    status = 413
+                else:
+                    status = receiver.receive(self.headers.get(SECRET_HEADER, ''), self.rfile.read(length))
+                if status in (400, 413):
+                    # body may be left unread
+                    self.close_connection = True
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                LOGGER.debug("Webhook %s", format % args)
+
+        return Handler
+
+    def receive(self, secret:str, body:bytes) -> int:
+        """ Validate and enqueue one update, returns HTTP status """
+        if self.secret and not hmac.compare_digest(secret.encode(), self.secret.encode()):
+            LOGGER.warning("Webhook request with invalid secret token")
+            return 403
+
+        try:
+            update = types.Update.de_json(json.loads(body))
+        except Exception as e:
+            LOGGER.warning("Webhook invalid update - %s", e)
+            return 400
+
+        try:
+            self.updates.put_nowait(update)
+        except queue.Full:
+            # telegram retries delivery later
+            LOGGER.warning("Webhook intake queue is full, update %s rejected", update.update_id)
+            return 503
+        return 200
+
+    def __dispatch(self):
+        while True:
+            update = self.updates.get()
+            if update is None:
+                return
+            try:
+                self.process_updates([update])
+            except Exception as e:
+                LOGGER.exception("Webhook update processing error: %s", e)
+
+    def start(self):
+        for target in (self.server.serve_forever, self.__dispatch):
+            th = threading.Thread(target=target)
+            th.daemon = True
+            th.start()
+            self.threads.append(th)
+        LOGGER.info("Webhook server listening on %s:%s", *self.server.server_address[:2])
+
+    def join(self):
+        for th in list(self.threads):
+            th.join()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.updates.put(None)
+        for th in self.threads:
+            th.join()
+        self.threads = []
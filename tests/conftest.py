@@ -0,0 +1,56 @@
+import os
+import sys
+import tempfile
+import pytest
+import telebot
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+import fake_webui
+
+# src modules import webui ones
+fake_webui.install(sampling_time=0)
+
+from src import utils
+
+# state and caches of tests don't go to the extension cache
+utils.set_cache_dir(tempfile.mkdtemp(prefix='tgtest'))
+
+from fake_api import FakeBotApi
+from src import main
+from src.journal import JobJournal
+from src.outbound import OutboundQueue
+from src.telegram_bot import SdTgBot
+
+
+@pytest.fixture
+def bot_api(tmp_path, monkeypatch):
+    """ Bot instance talking to local Bot API, not receiving updates """
+    api = FakeBotApi(error_caption=main.get_msg('telegram_bot_generated_error_msg'),
+                     result_caption=main.get_msg('telegram_bot_generated_msg', gen_data='').strip())
+    api.start()
+    monkeypatch.setattr(telebot.apihelper, 'API_URL', f'http://127.0.0.1:{api.port}/bot{{0}}/{{1}}')
+    monkeypatch.setattr(main, 'journal', JobJournal(str(tmp_path / 'jobs.db')))
+    bot = SdTgBot(token='1:test')
+    bot.outbound.start()
+    bot.delivery.start()
+    yield bot, api
+    bot.outbound.flush(10)
+    bot.outbound.stop()
+    api.stop()
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """ (client method, arguments) of calls submitted to outbound queues """
+    calls = []
+    submit = OutboundQueue.submit
+
+    def recording_submit(queue, chat_id, call, *args, **kwargs):
+        calls.append((call.func.__name__, call.keywords))
+        return submit(queue, chat_id, call, *args, **kwargs)
+
+    monkeypatch.setattr(OutboundQueue, 'submit', recording_submit)
+    return calls
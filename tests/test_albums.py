@@ -0,0 +1,43 @@
+from telebot import types
+from src import main
+
+
+def photo(chat_id:int, message_id:int, caption:str=None) -> types.Message:
+    file_id = f'photo{message_id}'
+    return types.Message.de_json({
+        'message_id': message_id,
+        'date': 0,
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'user'},
+        'media_group_id': 'album1',
+        'photo': [{'file_id': file_id, 'file_unique_id': file_id, 'width': 512, 'height': 512}],
+        'caption': caption,
+    })
+
+
+def test_user_is_told_photos_over_max_count_are_not_used(bot_api, sent):
+    bot, _ = bot_api
+    max_count = int(main.get_conf('telegram_bot_max_count'))
+    photos = [photo(1, 10, '/img2img cat')] + [photo(1, 10 + i) for i in range(1, max_count + 2)]
+    for message in photos:
+        bot.albums.add(message)
+    bot.on_img2img(photos[0])
+    assert bot.outbound.flush(10)
+
+    text = main.get_msg('telegram_bot_album_truncated_msg', count=max_count + 2, max_count=max_count)
+    assert ('send_message', {'chat_id': 1, 'reply_to_message_id': 10, 'text': text}) in sent
+    job, = bot.scheduler.detach()
+    assert job.count == max_count
+    assert [file_id for file_id, _ in job.params['album']] == [f'photo{10 + i}' for i in range(max_count)]
+
+
+def test_album_within_max_count_has_no_notice(bot_api, sent):
+    bot, _ = bot_api
+    photos = [photo(1, 10, '/img2img cat'), photo(1, 11)]
+    for message in photos:
+        bot.albums.add(message)
+    bot.on_img2img(photos[0])
+    assert bot.outbound.flush(10)
+    assert not [kwargs for method, kwargs in sent if method == 'send_message']
+    job, = bot.scheduler.detach()
+    assert job.count == 2
@@ -0,0 +1,34 @@
+from modules import shared
+from modules.processing import StableDiffusionProcessingTxt2Img
+from fake_webui import ScriptRunner
+from src import backends, generation, utils
+
+
+def test_costs_of_ephemeral_remote_are_not_kept():
+    remote = backends.RemoteBackend('http://127.0.0.1:40001')
+    assert not remote.persist
+    remote.save()
+    assert utils.load_state('cost_model_http://127.0.0.1:40001') is None
+
+
+def test_costs_of_configured_remote_are_kept():
+    for url in ('http://127.0.0.1:7861', 'http://user:pw@gpu-box:40001', 'https://gpu.example.com'):
+        assert backends.RemoteBackend(url).persist
+    remote = backends.RemoteBackend('http://127.0.0.1:7861')
+    remote.save()
+    assert utils.load_state('cost_model_http://127.0.0.1:7861') == {}
+
+
+def test_checkpoint_switch_keeps_webui_option(monkeypatch):
+    monkeypatch.setitem(shared.opts.data, 'sd_model_checkpoint', 'users choice')
+    generation.load_model('bench')
+    assert shared.opts.data['sd_model_checkpoint'] == 'users choice'
+    assert generation.loaded_model() == 'bench'
+
+
+def test_processing_of_jobs_names_their_checkpoint():
+    p = StableDiffusionProcessingTxt2Img(prompt='cat', scripts=ScriptRunner(), script_args=())
+    generation.process(p, 'bench')
+    assert p.override_settings == {'sd_model_checkpoint': 'bench'}
+    # option is the user's again after processing
+    assert p.override_settings_restore_afterwards
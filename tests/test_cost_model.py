@@ -0,0 +1,66 @@
+import pytest
+from src.cost_model import CostModel
+from src.scheduler import GenJob
+
+
+def batch(steps:int, images:int=1, size:int=512, kind:str='txt2img', sampler:str='Euler a') -> list:
+    params = {'steps': steps, 'width': size, 'height': size, 'sampler_name': sampler, 'count': images}
+    job = GenJob(1, None, None, params)
+    job.kind = kind
+    return [job]
+
+
+def seconds(jobs:list) -> float:
+    """ Backend with 0.5s overhead, 0.1s per step of first image, 0.04s of each other one """
+    steps = jobs[0].params['steps']
+    return 0.5 + 0.1 * steps + 0.04 * steps * (jobs[0].params['count'] - 1)
+
+
+def test_nothing_is_predicted_before_first_batch():
+    model = CostModel()
+    assert not model.learned()
+    assert model.predict(batch(20)) is None
+
+
+def test_fit_finds_overhead_and_batch_costs():
+    model = CostModel()
+    for steps in (10, 20, 30, 40):
+        for images in (1, 2, 4):
+            model.observe(batch(steps, images), seconds(batch(steps, images)))
+    overhead, first, other = CostModel.coefficients(model.fits['*'])
+    assert overhead == pytest.approx(0.5, abs=1e-6)
+    assert first == pytest.approx(0.1, abs=1e-6)
+    assert other == pytest.approx(0.04, abs=1e-6)
+    assert model.predict(batch(25, 3)) == pytest.approx(seconds(batch(25, 3)))
+
+
+def test_batches_of_one_size_use_prior_for_other_images():
+    model = CostModel()
+    for steps in (10, 20, 30):
+        model.observe(batch(steps), seconds(batch(steps)))
+    overhead, first, other = CostModel.coefficients(model.fits['*'])
+    assert overhead == pytest.approx(0.5, abs=1e-6)
+    assert first == pytest.approx(0.1, abs=1e-6)
+    assert other == pytest.approx(0.05, abs=1e-6)
+
+
+def test_unseen_kind_is_predicted_by_all_batches_fit():
+    model = CostModel()
+    for steps in (10, 20, 30):
+        model.observe(batch(steps), seconds(batch(steps)))
+    assert model.predict(batch(20, sampler='DDIM')) == pytest.approx(seconds(batch(20)))
+
+
+def test_state_round_trip_predicts_the_same():
+    model = CostModel()
+    for steps in (10, 20, 30, 40):
+        model.observe(batch(steps, 2), seconds(batch(steps, 2)))
+    # state is kept as json, tuples become lists
+    loaded = CostModel({k: list(v) for k, v in model.state().items()})
+    assert loaded.learned()
+    assert loaded.predict(batch(15, 2)) == model.predict(batch(15, 2))
+
+
+def test_state_of_other_size_is_dropped():
+    loaded = CostModel({'*': [1.0, 2.0]})
+    assert not loaded.learned()
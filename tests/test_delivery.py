@@ -0,0 +1,45 @@
+import pytest
+from telebot import apihelper
+from src import delivery
+
+
+def api_error(code:int) -> apihelper.ApiTelegramException:
+    return apihelper.ApiTelegramException('sendMessage', None, {'error_code': code, 'description': 'error'})
+
+
+class Step:
+    """ Call failing with given errors, then returning calls count """
+
+    def __init__(self, *errors) -> None:
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.calls
+
+
+@pytest.fixture(autouse=True)
+def no_delay(monkeypatch):
+    monkeypatch.setattr(delivery, 'RETRY_DELAY', 0)
+
+
+def test_transient_errors_are_retried():
+    step = Step(ConnectionResetError(), TimeoutError(), api_error(502))
+    assert delivery.retry(step) == 4
+
+
+def test_permanent_error_is_not_retried():
+    step = Step(api_error(400))
+    with pytest.raises(apihelper.ApiTelegramException):
+        delivery.retry(step)
+    assert step.calls == 1
+
+
+def test_retries_are_limited():
+    step = Step(*[ConnectionResetError()] * (delivery.RETRIES + 1))
+    with pytest.raises(ConnectionResetError):
+        delivery.retry(step)
+    assert step.calls == delivery.RETRIES + 1
@@ -0,0 +1,60 @@
+from telebot import types
+from src import main, utils
+from src.scheduler import GenJob
+from src.telegram_bot import SdTgBot
+
+
+def message(chat_id:int, message_id:int) -> types.Message:
+    return types.Message.de_json({
+        'message_id': message_id,
+        'date': 0,
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'user'},
+        'text': '/text2img cat',
+    })
+
+
+def queued(bot:SdTgBot) -> GenJob:
+    """ Job of stopped bot whose placeholder is still being sent """
+    job = GenJob(1, message(1, 10), None, {'prompt': 'cat'})
+    job.kind = 'txt2img'
+    job.settings = main.get_settings()
+    bot._BotBase__bind(job)
+    bot.journal.add(utils.bot_id(bot.bot.token), job)
+    bot.scheduler.submit(job)
+    bot.stop()
+    return job
+
+
+def test_job_without_placeholder_fails_on_other_bot(bot_api):
+    bot, api = bot_api
+    job = queued(bot)
+    assert bot.handover('2:other') is None
+    assert api.wait_finished(1, 10)
+    assert api.finished[(1, 10)][1] is False
+    assert job.delivered
+    assert bot.journal.pending(utils.bot_id(bot.bot.token)) == []
+    # placeholder coming after that is removed, job doesn't start
+    bot._BotBase__start(job, False, message(1, 11))
+    assert bot.scheduler.size() == 0
+
+
+def test_late_placeholder_failure_cancels_job_of_new_instance(bot_api):
+    bot, _ = bot_api
+    job = queued(bot)
+    new = SdTgBot(token=bot.bot.token, handover=bot.handover(bot.bot.token))
+    assert job.owner is new
+    assert new.scheduler.size() == 1
+    # placeholder send of old instance failed
+    bot._BotBase__start(job, True, None)
+    assert new.scheduler.size() == 0
+    assert job.delivered
+
+
+def test_late_placeholder_starts_job_on_new_instance(bot_api):
+    bot, _ = bot_api
+    job = queued(bot)
+    new = SdTgBot(token=bot.bot.token, handover=bot.handover(bot.bot.token))
+    bot._BotBase__start(job, False, message(1, 11))
+    assert job.waiting.message_id == 11
+    assert new.scheduler.detach() == [job]
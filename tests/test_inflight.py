@@ -0,0 +1,100 @@
+from telebot import types
+from fake_api import FakeBotApi
+from src import main
+from src.inflight import InFlight
+from src.scheduler import GenJob
+from src.telegram_bot import SdTgBot
+
+
+def message(chat_id:int, message_id:int) -> types.Message:
+    return types.Message.de_json({
+        'message_id': message_id,
+        'date': 0,
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'user'},
+        'text': '/text2img cat',
+    })
+
+
+def job(key:str='cat', chat_id:int=1, message_id:int=10) -> GenJob:
+    job = GenJob(chat_id, message(chat_id, message_id), None, {'prompt': key})
+    job.kind = 'txt2img'
+    job.flight_key = key
+    job.settings = main.get_settings()
+    return job
+
+
+def test_equal_request_follows_job_in_flight():
+    inflight = InFlight()
+    first, second = job(), job(message_id=11)
+    inflight.add(first)
+    inflight.add(second)
+    assert inflight.attach('cat', 'a') is first
+    assert inflight.attach('dog', 'b') is None
+    assert inflight.attach(None, 'c') is None
+    assert first.followers == ['a']
+    assert second.followers == []
+
+
+def test_landed_job_returns_followers_once():
+    inflight = InFlight()
+    first = job()
+    inflight.add(first)
+    inflight.attach('cat', 'a')
+    inflight.attach('cat', 'b')
+    assert inflight.land(first) == ['a', 'b']
+    assert inflight.land(first) == []
+    # equal request after that is generated again
+    assert inflight.attach('cat', 'c') is None
+
+
+def test_landing_other_job_keeps_followed_one():
+    inflight = InFlight()
+    first, second = job(), job(message_id=11)
+    inflight.add(first)
+    inflight.add(second)
+    inflight.land(second)
+    assert inflight.attach('cat', 'a') is first
+
+
+def follow(bot:SdTgBot, leader:GenJob, chat_id:int, message_id:int):
+    bot.inflight.add(leader)
+    assert bot.inflight.attach(leader.flight_key, (main.get_settings(), message(chat_id, message_id))) is leader
+
+
+def answers(api:FakeBotApi, count:int) -> dict:
+    """ Request key -> True if it got result, False if error """
+    assert api.wait_finished(count, 10)
+    return {key: ok for key, (_, ok) in api.finished.items()}
+
+
+def test_followers_get_result_of_job(bot_api):
+    bot, api = bot_api
+    leader = job()
+    follow(bot, leader, 2, 20)
+    follow(bot, leader, 3, 30)
+    bot._BotBase__land(leader, 'file1', 'comment')
+    assert answers(api, 2) == {(2, 20): True, (3, 30): True}
+    assert bot.inflight.attach('cat', None) is None
+
+
+def test_followers_get_error_of_failed_job(bot_api):
+    bot, api = bot_api
+    leader = job()
+    leader.waiting = message(1, 11)
+    follow(bot, leader, 2, 20)
+    bot._BotBase__error_waiting(leader)
+    assert answers(api, 1) == {(2, 20): False}
+    assert bot.inflight.attach('cat', None) is None
+
+
+def test_followers_get_error_when_placeholder_isnt_sent(bot_api):
+    bot, api = bot_api
+    leader = job()
+    bot._BotBase__bind(leader)
+    bot.scheduler.submit(leader)
+    follow(bot, leader, 2, 20)
+    bot._BotBase__start(leader, False, None)
+    assert answers(api, 1) == {(2, 20): False}
+    assert bot.scheduler.size() == 0
+    assert bot.inflight.attach('cat', None) is None
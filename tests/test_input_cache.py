@@ -0,0 +1,22 @@
+import concurrent.futures
+from PIL import Image
+from src.input_cache import InputCache
+
+
+def test_concurrent_puts_of_same_input(tmp_path):
+    cache = InputCache(tmp_path, 1 << 30)
+    images = [Image.new('RGB', (256, 256), (i, i, i)) for i in range(16)]
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda img: cache.put('same', img), images))
+
+    img = cache.get('same')
+    assert img is not None and img.size == (256, 256)
+    assert list(tmp_path.glob('*.tmp')) == []
+    assert cache.total == (tmp_path / 'same.png').stat().st_size
+
+
+def test_interrupted_writes_are_removed(tmp_path):
+    (tmp_path / 'key123.tmp').write_bytes(b'partial')
+    cache = InputCache(tmp_path, 1 << 30)
+    cache.put('key', Image.new('RGB', (8, 8)))
+    assert [f.name for f in tmp_path.iterdir()] == ['key.png']
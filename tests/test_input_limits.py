@@ -0,0 +1,48 @@
+import concurrent.futures
+import io
+import pytest
+from PIL import Image
+from telebot import types
+from src import generation, main
+from src.scheduler import GenJob
+
+
+def message(chat_id:int, message_id:int) -> types.Message:
+    return types.Message.de_json({
+        'message_id': message_id,
+        'date': 0,
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'user'},
+        'text': '/img2img cat',
+    })
+
+
+def test_input_above_pixels_is_too_large():
+    data = io.BytesIO()
+    Image.new('RGB', (2000, 1000)).save(data, format='jpeg')
+    with pytest.raises(generation.InputTooLarge):
+        generation.open_input(data.getvalue(), (512, 512), max_pixels=1000 * 1000)
+    assert generation.open_input(data.getvalue(), (512, 512), max_pixels=2000 * 1000)
+
+
+def test_input_too_large_after_download_is_told(bot_api, sent):
+    bot, _ = bot_api
+    settings = main.get_settings()
+    job = GenJob(1, message(1, 10), None, {'prompt': 'cat'})
+    job.kind = 'img2img'
+    job.settings = settings
+    job.waiting = message(1, 11)
+    job.flight_key = 'cat'
+    bot.inflight.add(job)
+    bot.inflight.attach('cat', (settings, message(2, 20)))
+    job.prepared = concurrent.futures.Future()
+    job.prepared.set_exception(generation.InputTooLarge('Input is above 1 bytes'))
+
+    # prepare error is raised before generation
+    bot._BotBase__run_jobs([job], None)
+    assert bot.outbound.flush(10)
+    too_large = settings.get_msg('telegram_bot_input_too_large_msg',
+                                 max_mb=settings.get_conf('telegram_bot_input_max_mb'),
+                                 max_mpix=settings.get_conf('telegram_bot_input_max_mpix'))
+    assert ('edit_message_caption', {'message_id': 11, 'chat_id': 1, 'caption': too_large}) in sent
+    assert ('send_message', {'chat_id': 2, 'reply_to_message_id': 20, 'text': too_large}) in sent
@@ -0,0 +1,74 @@
+from telebot import types
+from src.journal import JobJournal
+from src.scheduler import GenJob
+
+
+def message(chat_id:int, message_id:int, text:str='/text2img cat') -> types.Message:
+    return types.Message.de_json({
+        'message_id': message_id,
+        'date': 0,
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'user'},
+        'text': text,
+    })
+
+
+def job(chat_id:int, message_id:int, enqueued:float) -> GenJob:
+    job = GenJob(chat_id, message(chat_id, message_id), None, {'prompt': 'cat', 'steps': 20}, ('txt2img', 512))
+    job.kind = 'txt2img'
+    job.cache_key = f'key{message_id}'
+    job.enqueued = enqueued
+    return job
+
+
+def test_pending_jobs_are_replayed_in_enqueue_order(tmp_path):
+    journal = JobJournal(str(tmp_path / 'jobs.db'))
+    second, first, done = job(2, 20, 200.0), job(1, 10, 100.0), job(3, 30, 300.0)
+    for j in (second, first, done):
+        journal.add('bot', j)
+    journal.remove('bot', done)
+    first.waiting = message(1, 11, 'Queued')
+    journal.set_waiting('bot', first)
+    journal.set_state('bot', second, 'running')
+
+    pending = journal.pending('bot')
+    assert [(p.chat_id, p.message_id) for p in pending] == [(1, 10), (2, 20)]
+    assert pending[0].state == 'queued'
+    assert pending[0].waiting['message_id'] == 11
+    assert pending[0].params == {'prompt': 'cat', 'steps': 20}
+    assert pending[0].batch_key == ('txt2img', 512)
+    assert pending[0].cache_key == 'key10'
+    assert types.Message.de_json(pending[0].message).text == '/text2img cat'
+    assert pending[1].state == 'running'
+    assert pending[1].waiting is None
+
+
+def test_jobs_of_other_bot_are_not_replayed(tmp_path):
+    journal = JobJournal(str(tmp_path / 'jobs.db'))
+    journal.add('bot', job(1, 10, 100.0))
+    assert journal.pending('other') == []
+
+
+def test_reopened_journal_keeps_jobs_and_updates(tmp_path):
+    path = str(tmp_path / 'jobs.db')
+    journal = JobJournal(path)
+    journal.add('bot', job(1, 10, 100.0))
+    assert journal.new_update('bot', 5)
+    assert journal.new_update('bot', 7)
+    assert journal.flush(10)
+
+    # webui restart: new process opens the WAL database again
+    reopened = JobJournal(path)
+    assert [(p.chat_id, p.message_id) for p in reopened.pending('bot')] == [(1, 10)]
+    assert reopened.last_update_id('bot') == 7
+    assert reopened.last_update_id('other') == 0
+
+
+def test_replayed_update_is_not_new(tmp_path):
+    path = str(tmp_path / 'jobs.db')
+    journal = JobJournal(path)
+    assert journal.new_update('bot', 5)
+    assert not journal.new_update('bot', 5)
+    assert journal.new_update('other', 5)
+    assert journal.flush(10)
+    assert not JobJournal(path).new_update('bot', 5)
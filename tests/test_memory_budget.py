@@ -0,0 +1,37 @@
+import threading
+import time
+from src.memory_budget import MemoryBudget
+
+
+def test_held_bytes_are_counted_while_growing():
+    budget = MemoryBudget(100)
+    other = budget.acquire(60)
+    held = budget.acquire(30)
+    grown = []
+    th = threading.Thread(target=lambda: grown.append(budget.grow(held, 50)))
+    th.start()
+    time.sleep(0.1)
+    # 60 + 50 doesn't fit, the 30 held bytes are still used
+    assert not grown and budget.used == 90
+    budget.release(other)
+    th.join(10)
+    assert grown == [50] and budget.used == 50
+
+
+def test_growing_holders_dont_wait_for_each_other():
+    budget = MemoryBudget(100)
+    held = [budget.acquire(40), budget.acquire(40)]
+    done = []
+
+    def grow(size):
+        reserved = budget.grow(size, 90)
+        done.append(reserved)
+        time.sleep(0.05)
+        budget.release(reserved)
+
+    threads = [threading.Thread(target=grow, args=(size,)) for size in held]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join(10)
+    assert done == [90, 90] and budget.used == 0
@@ -0,0 +1,50 @@
+import threading
+import time
+from src import outbound
+
+
+def queue() -> outbound.OutboundQueue:
+    q = outbound.OutboundQueue(global_rate=100, chat_rate=100)
+    q.start()
+    return q
+
+
+def test_flush_waits_for_keyless_requests():
+    q = queue()
+    release = threading.Event()
+    done = []
+
+    def send():
+        release.wait(10)
+        done.append(True)
+
+    q.submit(1, send)
+    time.sleep(0.1)
+    # request is executing, nothing is pending
+    assert not q.flush(0.2)
+    release.set()
+    assert q.flush(10)
+    assert done == [True]
+    q.stop()
+
+
+def test_idle_chat_buckets_are_removed(monkeypatch):
+    monkeypatch.setattr(outbound, 'SWEEP_INTERVAL', 0)
+    q = queue()
+    for chat_id in range(1, 6):
+        q.submit(chat_id, lambda: None).result(10)
+    # refilled at 100 per second
+    time.sleep(0.1)
+    q.submit(6, lambda: None).result(10)
+    assert set(q.buckets) == {6}
+    q.stop()
+
+
+def test_skipped_request_is_not_sent():
+    q = queue()
+    sent = []
+    future = q.submit(1, lambda: sent.append(True), skip=lambda: True)
+    assert future.result(10) is None
+    assert q.flush(10)
+    assert sent == []
+    q.stop()
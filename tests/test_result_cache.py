@@ -0,0 +1,50 @@
+from src import generation, main
+from src.result_cache import ResultCache
+from src.settings import Settings
+
+
+def test_removed_result_is_not_loaded_again(tmp_path):
+    path = str(tmp_path / 'results_1.json')
+    cache = ResultCache(10, path)
+    cache.put('a', 'file_a', 'comment a')
+    cache.put('b', 'file_b', 'comment b')
+    cache.remove('a')
+    assert cache.get('a') is None
+
+    loaded = ResultCache(10, path)
+    assert loaded.get('a') is None
+    assert loaded.get('b') == ('file_b', 'comment b')
+
+
+def test_result_key_depends_on_checkpoint():
+    key = 'request'
+    assert generation.result_key(key, 'model_a') != generation.result_key(key, 'model_b')
+    assert generation.result_key(key, 'model_a') == generation.result_key(key, 'model_a')
+    assert generation.result_key(key, None) is None
+    assert generation.result_key(None, 'model_a') is None
+
+
+def settings(**conf) -> Settings:
+    return Settings(1, dict(main.DEFAULT, telegram_bot_seed=1, **conf), None, None)
+
+
+def test_request_keys_depend_on_controlnet_options():
+    params = {'prompt': 'cat', 'controlnet': True}
+    base = settings(telegram_bot_img2img_controlnet_model='canny_a')
+    changed = [
+        settings(telegram_bot_img2img_controlnet_model='canny_b'),
+        settings(telegram_bot_img2img_controlnet_model='canny_a', telegram_bot_img2img_controlnet_module='depth'),
+        settings(telegram_bot_img2img_controlnet_model='canny_a', telegram_bot_img2img_controlnet_processor_res=768),
+        settings(telegram_bot_img2img_controlnet_model='canny_a', telegram_bot_img2img_controlnet_threshold_a=50),
+        settings(telegram_bot_img2img_controlnet_model='canny_a', telegram_bot_img2img_controlnet_threshold_b=150),
+    ]
+    for other in changed:
+        assert generation.cache_key(other, params, 'photo') != generation.cache_key(base, params, 'photo')
+        assert generation.flight_key(other, params, 'photo') != generation.flight_key(base, params, 'photo')
+
+
+def test_request_keys_ignore_controlnet_options_without_controlnet():
+    params = {'prompt': 'cat', 'controlnet': False}
+    a = settings(telegram_bot_img2img_controlnet_model='canny_a')
+    b = settings(telegram_bot_img2img_controlnet_model='canny_b')
+    assert generation.cache_key(a, params, 'photo') == generation.cache_key(b, params, 'photo')
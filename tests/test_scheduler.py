@@ -0,0 +1,153 @@
+import threading
+import time
+import pytest
+from src.backends import Backend
+from src.scheduler import GenJob, GenScheduler
+
+
+class RecordingBackend(Backend):
+    """ Runs nothing, records jobs in the order the scheduler takes them """
+
+    def __init__(self, loaded:str=None) -> None:
+        super().__init__('test', 0, persist=False)
+        self.model = loaded
+        self.taken = []
+        self.done = threading.Event()
+
+    def run(self, call, jobs:list):
+        self.taken.extend(jobs)
+        self.done.set()
+
+    def loaded(self) -> str:
+        return self.model
+
+
+def job(chat_id, steps:int=20, model:str=None, enqueued:float=None) -> GenJob:
+    params = {'steps': steps, 'width': 512, 'height': 512, 'sampler_name': 'Euler a', 'model': model}
+    job = GenJob(chat_id, None, None, params)
+    job.kind = 'txt2img'
+    job.waiting = object()
+    if enqueued is not None:
+        job.enqueued = enqueued
+    return job
+
+
+def run_all(scheduler:GenScheduler, backend:RecordingBackend, count:int) -> list:
+    scheduler.start()
+    deadline = time.monotonic() + 10
+    while len(backend.taken) < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    scheduler.stop()
+    scheduler.join()
+    return backend.taken
+
+
+def test_chats_are_taken_round_robin():
+    scheduler = GenScheduler([], prepare_ahead=0)
+    a1, a2, a3, b1, c1 = job(1), job(1), job(1), job(2), job(3)
+    for j in (a1, a2, a3, b1, c1):
+        scheduler.submit(j)
+    # second job of chat 2 goes after second job of chat 1
+    assert scheduler.position(job(2)) == 5
+    assert scheduler.detach() == [a1, b1, c1, a2, a3]
+
+
+def test_shortest_first_takes_cheapest_chat_first():
+    backend = RecordingBackend()
+    for steps in (10, 20, 40):
+        backend.cost.observe([job(0, steps)], steps * 0.1)
+    scheduler = GenScheduler([backend], prepare_ahead=0, shortest_first=True)
+    long, short, middle = job(1, 50), job(2, 5), job(3, 20)
+    for j in (long, short, middle):
+        scheduler.submit(j)
+    assert scheduler.detach() == [short, middle, long]
+
+
+def test_shortest_first_doesnt_skip_long_waiting_job():
+    backend = RecordingBackend()
+    for steps in (10, 20, 40):
+        backend.cost.observe([job(0, steps)], steps * 0.1)
+    scheduler = GenScheduler([backend], prepare_ahead=0, shortest_first=True)
+    long, short = job(1, 50, enqueued=time.time() - 600), job(2, 5)
+    scheduler.submit(long)
+    scheduler.submit(short)
+    assert scheduler.detach() == [long, short]
+
+
+def test_drafts_go_before_full_jobs():
+    scheduler = GenScheduler([], prepare_ahead=0)
+    full, other = job(1), job(2)
+    draft = job(1, 5)
+    draft.draft_of = full
+    for j in (full, other, draft):
+        scheduler.submit(j)
+    assert scheduler.detach() == [draft, full, other]
+
+
+def test_jobs_for_loaded_checkpoint_are_taken_first():
+    backend = RecordingBackend(loaded='a')
+    scheduler = GenScheduler([backend], prepare_ahead=0, model_wait=60)
+    now = time.time()
+    other, loaded = job(1, model='b', enqueued=now - 1), job(2, model='a', enqueued=now)
+    scheduler.submit(other)
+    scheduler.submit(loaded)
+    assert run_all(scheduler, backend, 2) == [loaded, other]
+
+
+def test_job_for_other_checkpoint_waits_at_most_model_wait():
+    backend = RecordingBackend(loaded='a')
+    scheduler = GenScheduler([backend], prepare_ahead=0, model_wait=60)
+    now = time.time()
+    other, loaded = job(1, model='b', enqueued=now - 120), job(2, model='a', enqueued=now)
+    scheduler.submit(other)
+    scheduler.submit(loaded)
+    assert run_all(scheduler, backend, 2) == [other, loaded]
+
+
+def test_job_waits_for_its_placeholder():
+    backend = RecordingBackend()
+    scheduler = GenScheduler([backend], prepare_ahead=0)
+    pending, ready = job(1), job(2)
+    pending.waiting = None
+    scheduler.submit(pending)
+    scheduler.submit(ready)
+    scheduler.start()
+    assert backend.done.wait(10)
+    time.sleep(0.2)
+    assert backend.taken == [ready]
+    pending.waiting = object()
+    scheduler.ready(pending)
+    deadline = time.monotonic() + 10
+    while len(backend.taken) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    scheduler.stop()
+    scheduler.join()
+    assert backend.taken == [ready, pending]
+
+
+def test_wait_is_predicted_by_measured_backends():
+    measured, fresh = RecordingBackend(), RecordingBackend()
+    for steps in (10, 20, 40):
+        measured.cost.observe([job(0, steps)], steps * 0.1)
+    scheduler = GenScheduler([measured, fresh], prepare_ahead=0)
+    scheduler.submit(job(1, 20))
+    assert scheduler.predict_wait(job(2, 10)) == pytest.approx(3.0)
+
+
+def test_wait_is_unknown_before_any_backend_is_measured():
+    scheduler = GenScheduler([RecordingBackend(), RecordingBackend()], prepare_ahead=0)
+    assert scheduler.predict_wait(job(1)) is None
+
+
+def test_submit_after_stop_is_kept_for_handover():
+    scheduler = GenScheduler([], prepare_ahead=2)
+    scheduler.start()
+    scheduler.stop()
+    job = GenJob(1, None, None)
+    job.waiting = object()
+    job.prepare = lambda job: None
+    # late handler of stopped instance
+    scheduler.submit(job)
+    assert job.prepared is None
+    assert scheduler.detach() == [job]
+    scheduler.join()
@@ -0,0 +1,49 @@
+import pytest
+from modules import shared
+from src import main
+
+
+@pytest.fixture
+def opts(monkeypatch):
+    """ Change WebUI options, settings are rebuilt from the original ones after test """
+    def set_opts(**values):
+        for code, value in values.items():
+            monkeypatch.setitem(shared.opts.data, code, value)
+
+    yield set_opts
+    monkeypatch.undo()
+    main.update_overrides()
+
+
+def test_job_keeps_settings_it_was_created_with(opts):
+    opts(telegram_bot_steps=20, telegram_bot_generated_msg='Done {gen_data}')
+    main.update_overrides()
+    before = main.get_settings()
+
+    opts(telegram_bot_steps=35, telegram_bot_generated_msg='Ready {gen_data}')
+    main.update_settings()
+    after = main.get_settings()
+
+    assert after.version > before.version
+    assert (before.steps, after.steps) == (20, 35)
+    assert before.get_conf('telegram_bot_steps') == 20
+    assert before.get_msg('telegram_bot_generated_msg', gen_data='x') == 'Done x'
+    assert after.get_msg('telegram_bot_generated_msg', gen_data='x') == 'Ready x'
+
+
+def test_settings_snapshot_is_immutable():
+    settings = main.get_settings()
+    with pytest.raises(AttributeError):
+        settings.steps = 1
+    with pytest.raises(TypeError):
+        settings.conf['telegram_bot_steps'] = 1
+    with pytest.raises(TypeError):
+        settings.msgs['telegram_bot_generated_msg'] = ''
+
+
+def test_message_overrides_apply_to_new_snapshot(opts):
+    before = main.get_settings()
+    opts(telegram_bot_msgs='telegram_bot_start_msg: Hi there')
+    main.update_overrides()
+    assert main.get_settings().get_msg('telegram_bot_start_msg') == 'Hi there'
+    assert before.get_msg('telegram_bot_start_msg') != 'Hi there'
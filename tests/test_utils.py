@@ -0,0 +1,22 @@
+import pytest
+from src import utils
+
+
+@pytest.mark.parametrize('prompt', ['1girl 4', '2024', '4', '4 cats', '1girl, 2 cats 4', '--count', '--count many cats'])
+def test_numbers_in_prompt_are_not_count(prompt):
+    assert utils.split_count(prompt, 4) == (1, prompt)
+
+
+@pytest.mark.parametrize('prompt, expected', [
+    ('--count 2 a cat', (2, 'a cat')),
+    ('--count 9 a cat', (4, 'a cat')),
+    ('--count 0 a cat', (1, 'a cat')),
+    ('--count 3 2024', (3, '2024')),
+    ('--count 3', (3, '')),
+])
+def test_count_option(prompt, expected):
+    assert utils.split_count(prompt, 4) == expected
+
+
+def test_count_option_without_albums():
+    assert utils.split_count('--count 3 a cat', 1) == (1, 'a cat')
@@ -0,0 +1,114 @@
+import http.client
+import json
+import threading
+import time
+import pytest
+from src.webhook import MAX_BODY, SECRET_HEADER, WebhookServer
+
+
+def update(update_id:int) -> bytes:
+    return json.dumps({'update_id': update_id}).encode()
+
+
+class Client:
+    """ Telegram side of the webhook """
+
+    def __init__(self, server:WebhookServer) -> None:
+        self.host, self.port = server.server.server_address[:2]
+
+    def post(self, body:bytes, secret:str=None) -> int:
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=10)
+        try:
+            headers = {'Content-Type': 'application/json'}
+            if secret is not None:
+                headers[SECRET_HEADER] = secret
+            conn.request('POST', '/', body, headers)
+            return conn.getresponse().status
+        finally:
+            conn.close()
+
+    def post_length(self, length:str) -> int:
+        """ Request with Content-Length header as given and no body """
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=10)
+        try:
+            conn.putrequest('POST', '/')
+            conn.putheader('Content-Length', length)
+            conn.endheaders()
+            return conn.getresponse().status
+        finally:
+            conn.close()
+
+
+@pytest.fixture
+def webhook():
+    servers = []
+
+    def start(process_updates, secret:str='', queue_size:int=10):
+        server = WebhookServer(process_updates, '127.0.0.1', 0, secret, queue_size)
+        server.start()
+        servers.append(server)
+        return server, Client(server)
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+def test_secret_is_checked(webhook):
+    received = []
+    done = threading.Event()
+
+    def process(updates):
+        received.extend(u.update_id for u in updates)
+        done.set()
+
+    _, client = webhook(process, secret='s3cret')
+    assert client.post(update(1)) == 403
+    assert client.post(update(2), secret='wrong') == 403
+    assert client.post(update(3), secret='s3cret') == 200
+    assert done.wait(10)
+    assert received == [3]
+
+
+def test_invalid_update(webhook):
+    _, client = webhook(lambda updates: None)
+    assert client.post(b'not json') == 400
+
+
+def test_body_size_is_checked_before_reading(webhook):
+    _, client = webhook(lambda updates: None)
+    assert client.post_length(str(MAX_BODY + 1)) == 413
+    assert client.post_length(str(10 ** 12)) == 413
+    assert client.post_length('abc') == 400
+    assert client.post_length('-1') == 400
+    # update at the limit is taken
+    body = update(1)
+    assert client.post(body + b' ' * (MAX_BODY - len(body))) == 200
+
+
+def test_full_queue_is_rejected(webhook):
+    taken = threading.Event()
+    release = threading.Event()
+    received = []
+
+    def process(updates):
+        taken.set()
+        release.wait(10)
+        received.extend(u.update_id for u in updates)
+
+    _, client = webhook(process, queue_size=1)
+    assert client.post(update(1)) == 200
+    # dispatcher holds the first one, the second fills the queue
+    assert taken.wait(10)
+    assert client.post(update(2)) == 200
+    assert client.post(update(3)) == 503
+    release.set()
+    # telegram delivers rejected update again later
+    deadline = time.monotonic() + 10
+    while client.post(update(3)) == 503:
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    while len(received) < 3:
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    assert received == [1, 2, 3]